@@ -1,16 +1,44 @@
-# Imports the core libraries required for running the app, including the Flask library itself
+# Imports the core libraries required for running the app, including the Flask library itself,
+# and builds the app with 'create_app' (called from ridetime.py).
+#
+# The extensions and the 'main' blueprint are created here, unattached, so that every module
+# can register its pages, filters and hooks at import without needing the app itself. Modules
+# only needed by the 'flask' command (DB migrations, and the commands in commands.py) are left
+# out of the app served by gunicorn, which is loaded once and shared by its workers (see
+# gunicorn.conf.py). See 'flask startup-report' for how long each part takes to load.
 
 # Various libraries, plus our own configuration (loaded from config.py)
-from flask import Flask
+import os
+from flask import Blueprint, Flask
 from config import Config
 from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
 from flask_login import LoginManager
 
-app = Flask(__name__)           # Create Flask app
-app.config.from_object(Config)  # Apply configuration
-db = SQLAlchemy(app)            # SQLAlchemy for DB
-migrate = Migrate(app, db)      # DB migration tool
-lm = LoginManager(app)          # User login handler
+db = SQLAlchemy()                   # SQLAlchemy for DB
+lm = LoginManager()                 # User login handler
+bp = Blueprint('main', __name__, cli_group=None)  # Every page of the site, plus its error pages and template filters
 
-from app import routes, models, filters, errors
+
+# Creates the app. 'cli' adds the DB migration tool and our own commands, and defaults to whether
+# we are running under the 'flask' command.
+def create_app(config_class=Config, cli=None):
+    if cli is None:
+        cli = os.environ.get('FLASK_RUN_FROM_CLI') == 'true'  # Set by the 'flask' command
+
+    app = Flask(__name__)               # Create Flask app
+    app.config.from_object(config_class)  # Apply configuration
+    db.init_app(app)
+    lm.init_app(app)
+
+    from app import routes, models, filters, errors, metrics, sessions  # Register their pages and hooks on 'bp'
+    from app.calibration import calibrator
+    if cli:
+        from flask_migrate import Migrate  # Loads Alembic, which only the 'flask db' commands need
+        from app import commands
+        Migrate(app, db)                # DB migration tool
+    app.register_blueprint(bp)
+
+    calibrator.init_app(app)            # Loads route history outside requests, so needs the app to hand
+    if sessions.session_interface is not None:  # Keep sessions server-side, unless SESSION_STORE is 'cookie'
+        app.session_interface = sessions.session_interface
+    return app
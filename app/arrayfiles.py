@@ -0,0 +1,34 @@
+# Saves and opens sets of NumPy arrays kept as a directory of '.npy' files, as used for the road
+# graph (roadgraph.py) and the place index (placeindex.py). They are opened memory-mapped and
+# read-only, so every gunicorn worker on a machine shares one copy in the OS page cache, and
+# opening them is instant however large they are.
+
+import os
+import shutil
+import numpy as np
+
+
+# Opens the arrays with the given names from 'directory', returning a dict of name -> array
+def load_arrays(directory, names):
+    return {name: np.load(os.path.join(directory, name + '.npy'), mmap_mode='r') for name in names}
+
+
+# Writes a dict of name -> array to 'directory', replacing anything already there in one step (so
+# running workers keep using their open copy of the old files until restarted)
+def save_arrays(arrays, directory):
+    directory = directory.rstrip('/')
+    building, old = directory + '.building', directory + '.old'
+    shutil.rmtree(building, ignore_errors=True)
+    os.makedirs(building)
+    for name, array in arrays.items():
+        np.save(os.path.join(building, name + '.npy'), array)
+    shutil.rmtree(old, ignore_errors=True)
+    if os.path.exists(directory):
+        os.rename(directory, old)
+    os.rename(building, directory)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+# Total size in bytes of the files in 'directory'
+def directory_size(directory):
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
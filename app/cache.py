@@ -0,0 +1,70 @@
+# Small in-process caching helpers shared by the rest of the app. Each gunicorn worker
+# holds its own copy, so anything cached here must either be safe to serve slightly
+# stale, or be backed by something shared (e.g. the DB) for correctness across workers.
+
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()  # Sentinel so that falsy values (e.g. a cached 'not found') can still be cached
+
+
+# Thread-safe least-recently-used cache with an optional time-to-live per entry.
+# Hit and miss counts are kept so that cache effectiveness can be reported.
+class TTLCache(object):
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl  # Default lifetime in seconds, or None to keep entries until evicted
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # Maps key -> (expiry time, value), oldest first
+        self._lock = threading.Lock()
+
+    # Returns the cached value, or 'default' if the key is missing or has expired
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is not _MISSING:
+                expires, value = entry
+                if expires is None or expires > time.monotonic():
+                    self._data.move_to_end(key)  # Mark as most recently used
+                    self.hits += 1
+                    return value
+                del self._data[key]  # Expired, so drop it
+            self.misses += 1
+            return default
+
+    # Stores a value, optionally with its own TTL (e.g. shorter for negative results)
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)  # Evict least recently used
+
+    # Removes a single entry, returning True if it was present
+    def evict(self, key):
+        with self._lock:
+            return self._data.pop(key, _MISSING) is not _MISSING
+
+    # Removes every entry for which 'predicate(key)' is true
+    def evict_where(self, predicate):
+        with self._lock:
+            for key in [key for key in self._data if predicate(key)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    # Summary of cache effectiveness, e.g. for logging or the metrics endpoint
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'size': len(self._data), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0}
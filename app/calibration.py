@@ -0,0 +1,181 @@
+# Learns how far ORS's round trips tend to come back from the length we ask for, so we can ask
+# for a length that should come back close to what the rider wanted, rather than trying several
+# seeds (or the rider regenerating) to find one that happens to be near it.
+#
+# ORS treats the round trip 'length' as a rough guide, and how far off it is depends on the roads:
+# routes in dense city streets come back a different length from those on sparse country lanes,
+# and short routes differ from long ones. So the ratio of returned to requested length is learned
+# separately for each region 'cell' (the start rounded to CALIBRATION_PRECISION decimal places)
+# and distance band, as a running average of the ratio's logarithm (so that routes coming back 20%
+# short and 25% long balance out) which favours the last CALIBRATION_WINDOW routes.
+# Cells without CALIBRATION_MIN_SAMPLES routes yet fall back to their distance band as a whole,
+# and bands without enough fall back to no adjustment.
+#
+# Each worker learns from the routes stored in the DB when first used, then from every ORS
+# response it receives. The error of each route against the rider's target is kept, so the
+# distribution can be reported (see 'flask calibration-report', and '/metrics').
+
+import logging
+import math
+import threading
+from collections import deque
+from sqlalchemy import select
+from app import db
+from app.models import Route
+from config import Config
+
+DISTANCE_BANDS = (10, 25, 50)  # km at the top of each band; longer routes are in a band of their own
+ERROR_SAMPLES = 5000  # Recent route errors kept for reporting
+
+log = logging.getLogger(__name__)
+
+
+# Running average of the log of the returned / requested length ratio
+class RatioStats(object):
+    __slots__ = ('count', 'mean')
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+
+    # Adds a sample, weighting it equally with the others until there are 'window' of them, after
+    # which older samples fade out
+    def add(self, log_ratio, window):
+        self.count += 1
+        self.mean += (log_ratio - self.mean) / min(self.count, window)
+
+
+class DistanceCalibrator(object):
+
+    def __init__(self, enabled, precision, min_samples, window, max_adjust, history):
+        self.enabled = enabled  # If False, lengths aren't adjusted, but ratios are still learned and reported
+        self.precision = precision
+        self.min_samples = min_samples
+        self.window = window
+        self.max_adjust = max_adjust  # Most the requested length may differ from the target, as a fraction
+        self.history = history  # Stored routes to learn from when first used
+        self.listeners = []  # Functions called with (band, error, calibrated) for each route that comes back
+        self._cells = {}  # Maps (cell, band) -> RatioStats
+        self._bands = {}  # Maps band -> RatioStats
+        self._errors = deque(maxlen=ERROR_SAMPLES)  # (band, error, calibrated) for recent routes
+        self._lock = threading.Lock()
+        self._loaded = False
+        self.app = None  # Set by 'init_app', to reach the DB from threads outside any request
+
+    def init_app(self, app):
+        self.app = app
+
+    def cell(self, start_coords):
+        return round(start_coords[0], self.precision), round(start_coords[1], self.precision)
+
+    # Label for the distance band containing 'metres', e.g. '10-25km'
+    @staticmethod
+    def band(metres):
+        low = 0
+        for high in DISTANCE_BANDS:
+            if metres <= high * 1000:
+                return '{}-{}km'.format(low, high)
+            low = high
+        return '{}km+'.format(low)
+
+    # Expected returned / requested length for a route of 'target' metres from 'start_coords', or
+    # None if we haven't seen enough routes like it yet
+    def ratio(self, start_coords, target):
+        self._ensure_loaded()
+        band = self.band(target)
+        with self._lock:
+            for stats in (self._cells.get((self.cell(start_coords), band)), self._bands.get(band)):
+                if stats is not None and stats.count >= self.min_samples:
+                    return math.exp(stats.mean)
+        return None
+
+    # Length (in metres) to ask ORS for, so the route should come back close to 'target' metres
+    def requested_length(self, start_coords, target):
+        ratio = self.ratio(start_coords, target) if self.enabled else None
+        if ratio is None:
+            return target
+        requested = min(max(target / ratio, target * (1 - self.max_adjust)), target * (1 + self.max_adjust))
+        return int(round(requested))
+
+    # Learns from a route ORS returned: 'requested' is the length we asked for, 'returned' its actual
+    # length and 'target' the length the rider wanted (all in metres)
+    def record(self, start_coords, target, requested, returned):
+        self._ensure_loaded()
+        band = self.band(target)
+        error = (returned - target) / target  # Fraction by which the route misses the target, +ve if too long
+        calibrated = requested != target
+        with self._lock:
+            self._learn(start_coords, target, requested, returned)
+            self._errors.append((band, error, calibrated))
+        for listener in self.listeners:
+            listener(band, error, calibrated)
+
+    def _learn(self, start_coords, target, requested, returned):
+        if not target or not requested or not returned:
+            return
+        log_ratio = math.log(returned / requested)
+        band = self.band(target)  # As looked up by 'ratio'
+        self._cells.setdefault((self.cell(start_coords), band), RatioStats()).add(log_ratio, self.window)
+        self._bands.setdefault(band, RatioStats()).add(log_ratio, self.window)
+
+    # Learns from the most recent stored routes which recorded the length asked of ORS. Runs once,
+    # on first use, and reads the DB directly rather than through the session, as it may be called
+    # from the route pool's or candidate threads.
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            self._loaded = True  # Even if loading fails, carry on learning from new routes
+            columns = (Route.start_longitude, Route.start_latitude, Route.target_distance, Route.requested_distance,
+                       Route.distance)
+            query = select(columns).where(Route.requested_distance.isnot(None)).order_by(
+                Route.id.desc()).limit(self.history)
+            try:
+                with db.get_engine(self.app).connect() as connection:
+                    rows = connection.execute(query).fetchall()
+            except Exception:
+                log.exception('Could not load route history for distance calibration')
+                return
+            for longitude, latitude, target, requested, returned in reversed(rows):  # Oldest first, as recent count most
+                self._learn((longitude, latitude), target, requested, returned)
+
+    # Distribution of recent routes' errors against their targets (as fractions), overall and by
+    # band, plus the learned ratio for each band
+    def report(self, tolerance=None):
+        tolerance = Config.ROUTE_TOLERANCE if tolerance is None else tolerance
+        self._ensure_loaded()
+        with self._lock:
+            errors = list(self._errors)
+            bands = {band: (stats.count, math.exp(stats.mean)) for band, stats in self._bands.items()}
+            cells = len(self._cells)
+
+        report = {'routes': error_summary([error for _, error, _ in errors], tolerance), 'cells': cells, 'bands': {}}
+        for band in sorted(set(bands) | set(band for band, _, _ in errors), key=band_order):
+            summary = error_summary([error for b, error, _ in errors if b == band], tolerance)
+            summary['learned_from'], summary['ratio'] = bands.get(band, (0, None))
+            report['bands'][band] = summary
+        return report
+
+
+# Sort key putting band labels in distance order
+def band_order(band):
+    return int(band.split('-')[0].rstrip('km+'))
+
+
+# Count, mean, median and 90th percentile of the size of some errors (fractions of the target), and
+# the share of them within 'tolerance'
+def error_summary(errors, tolerance):
+    if not errors:
+        return {'count': 0}
+    sizes = sorted(abs(error) for error in errors)
+    return {'count': len(sizes), 'mean_error': round(sum(errors) / len(errors), 4),
+            'median_abs_error': round(sizes[len(sizes) // 2], 4),
+            'p90_abs_error': round(sizes[min(int(len(sizes) * 0.9), len(sizes) - 1)], 4),
+            'within_tolerance': round(sum(1 for size in sizes if size <= tolerance) / len(sizes), 3)}
+
+
+calibrator = DistanceCalibrator(Config.DISTANCE_CALIBRATION, Config.CALIBRATION_PRECISION,
+                                Config.CALIBRATION_MIN_SAMPLES, Config.CALIBRATION_WINDOW,
+                                Config.CALIBRATION_MAX_ADJUST, Config.CALIBRATION_HISTORY)
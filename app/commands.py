@@ -0,0 +1,218 @@
+# Maintenance commands, run with the 'flask' command line tool (e.g. 'flask purge-orphans')
+
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+import click
+from app import bp, db
+from app.arrayfiles import save_arrays, directory_size
+from app.calibration import calibrator, band_order, error_summary
+from app.geometry import route_stats
+from app.jobs import run_worker
+from app.models import Route
+from app.osmimport import read_osm, build_graph
+from app.placeindex import build_index
+from app.polyline import unpack_coords
+from config import Config, basedir
+
+# Run in a fresh process by 'startup-report', timing each stage of starting the app as gunicorn does
+STARTUP_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+application = app.create_app()
+created = time.perf_counter()
+response = application.test_client().get(sys.argv[1])
+finished = time.perf_counter()
+print(json.dumps({'import': imported - started, 'create_app': created - imported,
+                  'first_request': finished - created, 'status': response.status_code}))
+"""
+
+
+# Deletes routes which were generated but never saved (those with no user_id). These were stored
+# by older versions of the app; new unsaved routes are kept out of the DB (see unsaved.py).
+# Rows are deleted a batch at a time, so the table is never locked for long.
+@bp.cli.command('purge-orphans')
+@click.option('--batch-size', default=1000, help='Routes deleted per transaction')
+@click.option('--older-than', default=24, help='Only delete routes created at least this many hours ago')
+@click.option('--pause', default=0.1, help='Seconds to wait between batches, to let other queries through')
+def purge_orphans(batch_size, older_than, pause):
+    cutoff = datetime.utcnow() - timedelta(hours=older_than)
+    purged = 0
+    while True:
+        batch = [route_id for route_id, in db.session.query(Route.id)
+                 .filter(Route.user_id.is_(None), Route.timestamp < cutoff).limit(batch_size)]
+        if not batch:
+            break
+        Route.query.filter(Route.id.in_(batch)).delete(synchronize_session=False)
+        db.session.commit()
+        purged += len(batch)
+        click.echo('Purged {} unsaved routes so far'.format(purged))
+        time.sleep(pause)
+    click.echo('Done: purged {} unsaved routes'.format(purged))
+
+
+# Works out the shape summary (see 'route_stats' in geometry.py) for routes stored before it was
+# added, a batch at a time. Safe to stop and run again, as it carries on from the routes still missing it.
+@bp.cli.command('backfill-route-stats')
+@click.option('--batch-size', default=500, help='Routes updated per transaction')
+def backfill_route_stats(batch_size):
+    updated = 0
+    last_id = 0
+    while True:
+        batch = db.session.query(Route.id, Route.geometry).filter(
+            Route.point_count.is_(None), Route.geometry.isnot(None), Route.id > last_id
+        ).order_by(Route.id).limit(batch_size).all()
+        if not batch:
+            break
+        db.session.bulk_update_mappings(Route, [dict(route_stats(unpack_coords(geometry)), id=route_id)
+                                                for route_id, geometry in batch])
+        db.session.commit()
+        updated += len(batch)
+        last_id = batch[-1].id
+        click.echo('Updated {} routes so far'.format(updated))
+    click.echo('Done: updated {} routes'.format(updated))
+
+
+# Reports how far stored routes came back from the distance riders asked for, by distance band, for
+# routes whose length was adjusted by calibration (see calibration.py) and those whose wasn't, along
+# with the ratio this process has learned for each band.
+@bp.cli.command('calibration-report')
+@click.option('--limit', default=20000, help='Most recent routes to report on')
+def calibration_report(limit):
+    rows = db.session.query(Route.target_distance, Route.requested_distance, Route.distance).filter(
+        Route.target_distance.isnot(None), Route.distance.isnot(None)).order_by(Route.id.desc()).limit(limit).all()
+    errors = {}  # Maps (band, adjusted) -> list of errors, as fractions of the target
+    for target, requested, distance in rows:
+        key = (calibrator.band(target), 'yes' if requested != target else 'no')
+        errors.setdefault(key, []).append((distance - target) / target)
+    learned = calibrator.report()['bands']
+
+    click.echo('{:<10} {:>8} {:>7} {:>10} {:>10} {:>10} {:>8} {:>7}'.format(
+        'band', 'adjusted', 'routes', 'mean err', 'median |e|', 'p90 |e|', 'within', 'ratio'))
+    for band, adjusted in sorted(errors, key=lambda key: (band_order(key[0]), key[1])):
+        summary = error_summary(errors[band, adjusted], Config.ROUTE_TOLERANCE)
+        ratio = learned.get(band, {}).get('ratio')
+        click.echo('{:<10} {:>8} {count:>7} {mean_error:>+10.1%} {median_abs_error:>10.1%} {p90_abs_error:>10.1%} '
+                   '{within_tolerance:>8.0%} {ratio:>7}'.format(band, adjusted, ratio='-' if ratio is None else
+                                                                '{:.3f}'.format(ratio), **summary))
+    click.echo('{} routes; "within" is the share within ROUTE_TOLERANCE ({:.0%}) of the distance asked for'.format(
+        len(rows), Config.ROUTE_TOLERANCE))
+
+
+# Builds the road graph for the local routing backend (see roadgraph.py) from an OSM extract
+@bp.cli.command('build-road-graph')
+@click.argument('extract', type=click.Path(exists=True, dir_okay=False))
+@click.option('--output', help='Directory to write the graph to (default ROUTING_GRAPH)')
+def build_road_graph(extract, output):
+    output = output or Config.ROUTING_GRAPH
+    click.echo('Reading {}'.format(extract))
+    try:
+        ways, coordinates = read_osm(extract)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo('Building graph from {} ways'.format(len(ways)))
+    arrays = build_graph(ways, coordinates)
+    save_arrays(arrays, output)
+    click.echo('Done: {} vertices, {} edges, {:.1f} MB in {}'.format(
+        len(arrays['vertex_lon']), len(arrays['targets']), directory_size(output) / 1e6, output))
+
+
+# Builds the local place index (see placeindex.py) from postcode and place CSV files
+@bp.cli.command('build-place-index')
+@click.option('--postcodes', multiple=True, type=click.Path(exists=True, dir_okay=False),
+              help='CSV with postcode, latitude and longitude columns (may be given more than once)')
+@click.option('--places', multiple=True, type=click.Path(exists=True, dir_okay=False),
+              help='CSV with name, latitude and longitude columns, and optionally area and population')
+@click.option('--output', help='Directory to write the index to (default PLACE_INDEX)')
+def build_place_index(postcodes, places, output):
+    if not postcodes and not places:
+        raise click.UsageError('Give at least one --postcodes or --places file')
+    output = output or Config.PLACE_INDEX
+    try:
+        arrays = build_index(postcodes, places)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    save_arrays(arrays, output)
+    click.echo('Done: {} postcodes, {} places, {:.1f} MB in {}'.format(
+        len(arrays['postcode_keys']), len(arrays['place_keys']), directory_size(output) / 1e6, output))
+
+
+# Runs a worker for batch route generation jobs (see jobs.py), until stopped with Ctrl+C or SIGTERM.
+# Any number of these can run at once, on any machine with access to the DB.
+@bp.cli.command('run-worker')
+@click.option('--threads', type=int, help='Routes generated at once (default JOB_WORKER_THREADS)')
+@click.option('--poll-interval', type=float, help='Seconds to wait when there is nothing to do')
+def run_job_worker(threads, poll_interval):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())  # Sent by Heroku when stopping the dyno
+    try:
+        run_worker(threads, poll_interval, stop)
+    except KeyboardInterrupt:
+        stop.set()
+    click.echo('Worker stopped')
+
+
+# Measures how long a web process takes to start, each time in a fresh Python process (as on a new
+# dyno, or a gunicorn worker without preloading): importing the app, 'create_app', and answering its
+# first request. Also lists the packages whose imports take longest, from Python's '-X importtime'
+# (which adds a little time of its own). Run before and after a change to see what it did to start-up.
+@bp.cli.command('startup-report')
+@click.option('--runs', default=5, help='Fresh processes to time (medians are reported)')
+@click.option('--top', default=15, help='Packages to list by import time')
+@click.option('--path', default='/about', help='Page to request first')
+@click.option('--json', 'as_json', is_flag=True, help='Print the results as JSON')
+def startup_report(runs, top, path, as_json):
+    environment = dict(os.environ, METRICS_DIR='')  # Don't leave metrics files behind
+    environment.pop('FLASK_RUN_FROM_CLI', None)  # Load the app as gunicorn does, not as this command does
+    timings, packages = [], {}  # Maps package -> total import time (seconds) over all runs
+    for _ in range(runs):
+        started = time.perf_counter()
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c', STARTUP_SCRIPT, path], cwd=basedir,
+                                 env=environment, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                 universal_newlines=True)
+        elapsed = time.perf_counter() - started
+        if process.returncode != 0:
+            raise click.ClickException('The app failed to start:\n' + process.stderr[-2000:])
+        timing = json.loads(process.stdout.strip().splitlines()[-1])
+        timing['process'] = elapsed
+        timings.append(timing)
+        for line in process.stderr.splitlines():  # e.g. 'import time:       321 |      23425 |   certifi'
+            if not line.startswith('import time:') or 'imported package' in line:
+                continue
+            own_time, _, module = line[len('import time:'):].split('|')
+            module = module.strip()
+            package = module if module.split('.')[0] == 'app' else module.split('.')[0]  # Our modules one by one
+            packages[package] = packages.get(package, 0) + int(own_time) / 1e6
+
+    def median(stage):
+        values = sorted(timing[stage] for timing in timings)
+        return values[len(values) // 2]
+
+    report = {'runs': runs, 'path': path, 'status': timings[-1]['status'],
+              'seconds': {stage: round(median(stage), 4)
+                          for stage in ('process', 'import', 'create_app', 'first_request')},
+              'import_seconds': {package: round(total / runs, 4) for package, total in
+                                 sorted(packages.items(), key=lambda item: -item[1])[:top]}}
+    if as_json:
+        click.echo(json.dumps(report, indent=2))
+        return
+
+    seconds = report['seconds']
+    click.echo('Median of {} fresh processes:'.format(runs))
+    click.echo('  {:<28} {:>8.1f} ms'.format('whole process', seconds['process'] * 1000))
+    click.echo('  {:<28} {:>8.1f} ms'.format('import app', seconds['import'] * 1000))
+    click.echo('  {:<28} {:>8.1f} ms'.format('create_app()', seconds['create_app'] * 1000))
+    click.echo('  {:<28} {:>8.1f} ms  ({})'.format('first request ' + path, seconds['first_request'] * 1000,
+                                                   report['status']))
+    click.echo('Import time by package (mean per process):')
+    for package, package_seconds in report['import_seconds'].items():
+        click.echo('  {:<28} {:>8.1f} ms'.format(package, package_seconds * 1000))
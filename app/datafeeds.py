@@ -4,24 +4,121 @@
 #
 # ORS library can be found here: https://github.com/GIScience/openrouteservice-py
 
-import openrouteservice  # Using Openrouteservice library to reduce the code required to query their API
-from openrouteservice import convert, geocode
+import re
+import threading
+from datetime import datetime, timedelta
+from openrouteservice import geocode  # Using Openrouteservice library to reduce the code required to query their API
+from sqlalchemy.exc import IntegrityError
+from app import db
+from app.cache import TTLCache
+from app.models import GeocodeResult
+from app.orsclient import ResilientClient, ORSUnavailable
+from app.placeindex import place_index
+from app.polyline import decode_polyline, unpack_coords
 from config import Config
 
 ors_key = Config.ORS_KEY  # Read OpenRouteService key from config file
-ors = openrouteservice.Client(key=ors_key)  # Create client for accessing ORS
 
+# Create client for accessing ORS, shared by location searches and route generation so that
+# they share one rate limit, connection pool and circuit breaker (see orsclient.py)
+ors = ResilientClient(key=ors_key, base_url=Config.ORS_BASE_URL, timeout=Config.ORS_TIMEOUT,
+                      pool_size=Config.ORS_POOL_SIZE, rate_per_minute=Config.ORS_RATE_LIMIT, burst=Config.ORS_RATE_BURST,
+                      rate_wait=Config.ORS_RATE_WAIT, max_retries=Config.ORS_MAX_RETRIES,
+                      breaker_threshold=Config.ORS_BREAKER_THRESHOLD, breaker_reset=Config.ORS_BREAKER_RESET)
 
-# Takes input of a route (in the format of an encoded polyline), uses the Openrouteservice
-# library to decode it, then returns only the coordinates of the route, discarding the rest.
-def polyline_to_coords(encoded_polyline):
-    decoded = convert.decode_polyline(encoded_polyline)
-    return decoded['coordinates']
+# In-memory layer of the geocode cache, in front of the 'GeocodeResult' DB table
+geocode_cache = TTLCache(maxsize=Config.GEOCODE_CACHE_SIZE, ttl=Config.GEOCODE_CACHE_TTL)
+geocode_counts = {'index_hits': 0, 'db_hits': 0, 'ors_lookups': 0}  # Lookups which got past the in-memory layer
+geocode_counts_lock = threading.Lock()  # Lookups run on many threads at once, so the counts are updated under this
 
+# Decoded coordinates of recently viewed routes, so popular routes are only decoded once per worker
+coords_cache = TTLCache(maxsize=Config.COORDS_CACHE_SIZE)
 
-# Enables user to enter address, returns coordinates which are used to set route start location
+# Full UK postcode with the space removed, split into outward code (e.g. 'B15') and inward code (e.g. '2TT')
+uk_postcode = re.compile(r'^([A-Z]{1,2}[0-9][A-Z0-9]?)([0-9][A-Z]{2})$')
+
+
+# Takes input of a route (in the format of an encoded polyline), decodes it, and returns the
+# coordinates of the route as an (n, 2) array of [longitude, latitude] rows. When the route ID
+# is given, the result is cached (keyed on the polyline too, in case the route has changed).
+def polyline_to_coords(encoded_polyline, route_id=None):
+    if route_id is None:  # Unsaved routes are rarely viewed twice, so not worth caching
+        return decode_polyline(encoded_polyline)
+
+    key = (route_id, hash(encoded_polyline))
+    coords = coords_cache.get(key)
+    if coords is None:
+        coords = decode_polyline(encoded_polyline)
+        coords.flags.writeable = False  # Shared between requests, so must not be changed by any of them
+        coords_cache.set(key, coords)
+    return coords
+
+
+# As polyline_to_coords, but for a route's stored (packed) geometry rather than an encoded polyline,
+# which saves re-encoding it as a polyline only to decode it again
+def geometry_to_coords(geometry, route_id=None):
+    if route_id is None:
+        return unpack_coords(geometry)
+
+    key = (route_id, hash(geometry))
+    coords = coords_cache.get(key)
+    if coords is None:
+        coords = unpack_coords(geometry)
+        coords.flags.writeable = False
+        coords_cache.set(key, coords)
+    return coords
+
+
+# Converts a location search into a canonical form, so that e.g. 'b152tt', ' B15  2TT' and
+# 'B15 2TT' all share a single cache entry. Postcodes are given their standard spacing.
+def normalise_location(location):
+    text = ' '.join(location.upper().split()).strip(' ,.')  # Ignore case, repeated and surrounding whitespace
+    match = uk_postcode.match(text.replace(' ', ''))
+    if match:
+        return '{} {}'.format(*match.groups())
+    return text
+
+
+# Enables user to enter address, returns coordinates which are used to set route start location.
+# Most postcodes and place names are found in the local place index (see placeindex.py). Others
+# are looked up with ORS, and the results (including 'not found') are cached in memory and in the
+# DB, so ORS is only queried the first time a place is searched for, or once the stored result has
+# expired. If ORS is unavailable, an expired result is better than none, so that is used if we have one.
 def postcode_lookup(location):
-    geocode_result = geocode.pelias_search(ors, text=location, country='GBR')  # Query the API, limiting results to UK
+    query = normalise_location(location)
+
+    result = geocode_cache.get(query)  # Fastest option: this worker has looked it up recently
+    if result is not None:
+        return result
+
+    index = place_index()
+    result = index.lookup(query) if index else None  # Next best: it's in the local index
+    if result is not None:
+        count_lookup('index_hits')
+        return result
+
+    result = stored_lookup(query)  # Otherwise another worker (or a previous process) may have looked it up
+    if result is not None:
+        count_lookup('db_hits')
+    else:
+        db.session.close()  # Give the DB connection back while we wait on ORS
+        try:
+            result = ors_lookup(query)  # Otherwise fall back to asking ORS, and remember the answer
+        except ORSUnavailable:
+            result = stored_lookup(query, expired_ok=True)
+            if result is None:
+                raise
+            return result  # Don't keep the expired result in memory, so ORS is tried again next time
+        count_lookup('ors_lookups')
+        store_lookup(query, result)
+
+    geocode_cache.set(query, result, ttl=None if result[0] else Config.GEOCODE_NEGATIVE_TTL)
+    return result
+
+
+# Queries the ORS API for a location, returning whether it was found, its coordinates and a display name
+def ors_lookup(query):
+    geocode_result = geocode.pelias_search(ors, text=query, country='GBR')  # Query the API, limiting results to UK
     features = geocode_result.get('features')
 
     if len(features) > 0:  # If API returns a match, return the top match
@@ -32,3 +129,48 @@ def postcode_lookup(location):
         return True, coordinates, address_pretty
     else:  # If there are no matches, fail gracefully
         return False, (0, 0), "Not found"
+
+
+# Returns the result of a previous lookup from the DB, or None if there isn't one still within its TTL
+def stored_lookup(query, expired_ok=False):
+    stored = GeocodeResult.query.get(query)
+    if stored is None:
+        return None
+
+    ttl = Config.GEOCODE_CACHE_TTL if stored.found else Config.GEOCODE_NEGATIVE_TTL
+    if not expired_ok and stored.timestamp < datetime.utcnow() - timedelta(seconds=ttl):
+        return None  # Expired, so look it up again
+
+    if stored.found:
+        return True, [stored.longitude, stored.latitude], stored.address
+    return False, (0, 0), "Not found"
+
+
+# Saves the result of an ORS lookup to the DB, replacing any expired copy
+def store_lookup(query, result):
+    if len(query) > GeocodeResult.search.type.length:
+        return  # Too long to fit the DB column, so just keep it in memory
+
+    found, coordinates, address = result
+    stored = GeocodeResult(search=query, found=found, address=address if found else None,
+                           longitude=coordinates[0] if found else None, latitude=coordinates[1] if found else None,
+                           timestamp=datetime.utcnow())
+    try:
+        db.session.merge(stored)
+        db.session.commit()
+    except IntegrityError:  # Another worker stored the same query at the same moment, so theirs will do
+        db.session.rollback()
+
+
+# Hit/miss counts across both layers of the geocode cache
+def geocode_cache_stats():
+    stats = geocode_cache.stats()
+    with geocode_counts_lock:
+        stats.update(geocode_counts)
+    return stats
+
+
+# Counts a lookup answered by the given layer (a key of 'geocode_counts')
+def count_lookup(kind):
+    with geocode_counts_lock:
+        geocode_counts[kind] += 1
@@ -2,15 +2,15 @@
 # error pages, rather than relying on the default pages provided by Flask.
 
 from flask import render_template
-from app import app, db
+from app import bp, db
 
 
-@app.errorhandler(404)
+@bp.app_errorhandler(404)
 def not_found_error(error):
     return render_template('404.html'), 404
 
 
-@app.errorhandler(500)
+@bp.app_errorhandler(500)
 def internal_error(error):
     db.session.rollback()
     return render_template('500.html'), 500
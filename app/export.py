@@ -0,0 +1,115 @@
+# Bulk export of a user's routes, as a ZIP file of GPX files.
+#
+# The ZIP is streamed: each GPX file is added as soon as it is ready, and the bytes written so far
+# are sent straight on to the user, so the download starts immediately and memory use stays the
+# same however many routes there are. Routes are read from the DB a batch at a time, and the GPX
+# files are generated in a pool of worker processes (so several CPU cores can be used at once),
+# with only a few in progress at any moment.
+
+import os
+import threading
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from app.gpx import stream_gpx
+from app.models import Route
+from app.polyline import unpack_coords
+from config import Config
+
+_executor = None
+_executor_pid = None  # Process the pool was created in, so each gunicorn worker creates its own
+_executor_lock = threading.Lock()
+
+
+# Collects the bytes zipfile writes, so they can be passed on a chunk at a time. Having no 'seek'
+# or 'tell' makes zipfile write each entry in one pass, as a stream.
+class ZipSink(object):
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    # Returns everything written since the last call
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+# Returns the process pool for generating GPX files, or None if EXPORT_PROCESSES is 0 (generate them
+# in the request's own thread instead). Created on first use, as pools can't be shared with forked workers.
+def gpx_executor():
+    global _executor, _executor_pid
+    if Config.EXPORT_PROCESSES <= 0:
+        return None
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ProcessPoolExecutor(max_workers=Config.EXPORT_PROCESSES)
+            _executor_pid = os.getpid()
+        return _executor
+
+
+# Builds a GPX file from a route's title and stored geometry. Runs in the worker processes, so
+# takes and returns only plain values.
+def gpx_file(title, geometry):
+    return ''.join(stream_gpx(title, unpack_coords(geometry))).encode('utf-8')
+
+
+# Yields (id, title, timestamp, geometry) for every route matched by a query, reading a batch at a time
+def export_rows(query, batch_size=None):
+    batch_size = batch_size or Config.EXPORT_BATCH_SIZE
+    query = query.with_entities(Route.id, Route.title, Route.timestamp, Route.geometry)
+    last_id = 0
+    while True:
+        batch = query.filter(Route.id > last_id).order_by(Route.id).limit(batch_size).all()
+        if not batch:
+            return
+        for row in batch:
+            if row.geometry is not None:
+                yield row
+        last_id = batch[-1].id
+
+
+# Yields a ZIP file, in chunks, of a GPX file for each of the rows from 'export_rows'. Files are
+# generated by 'executor' (if given), with at most 'window' in progress at once, and added to the
+# ZIP in whatever order they are finished.
+def export_zip(rows, executor=None, window=None):
+    from slugify import slugify  # Loaded on the first export, rather than with the app
+    window = window or max(2 * Config.EXPORT_PROCESSES, 1)
+    sink = ZipSink()
+    pending = {}  # Maps future -> ZipInfo for the file it is generating
+    try:
+        with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for row in rows:
+                info = zipfile.ZipInfo('{}-{}.gpx'.format(slugify(row.title or 'route'), row.id))
+                if row.timestamp:
+                    info.date_time = row.timestamp.timetuple()[:6]
+                info.compress_type = zipfile.ZIP_DEFLATED
+                if executor is None:
+                    archive.writestr(info, gpx_file(row.title, row.geometry))
+                    yield sink.take()
+                    continue
+
+                pending[executor.submit(gpx_file, row.title, row.geometry)] = info
+                while len(pending) >= window:
+                    yield from write_finished(archive, sink, pending)
+
+            while pending:
+                yield from write_finished(archive, sink, pending)
+        yield sink.take()  # The ZIP's table of contents, written as it is closed
+    finally:
+        for future in pending:  # The download was abandoned part way through, so don't finish the rest
+            future.cancel()
+
+
+# Waits for at least one pending GPX file, adds every finished one to the ZIP, and yields the new bytes
+def write_finished(archive, sink, pending):
+    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+    for future in done:
+        archive.writestr(pending.pop(future), future.result())
+    yield sink.take()
@@ -2,37 +2,57 @@
 # our HTML code and neatly convert them into a pretty format for display there.
 # This reduces the need to manipulate data in our Python code before a page is loaded.
 
-import timeago, datetime
-from app import app
+import timeago, datetime, math
+import numpy as np
+from markupsafe import Markup
+from app import bp
+from app.polyline import decode_polyline
 
 
 # Converts a timestamp into a more user-friendly format, e.g. '5 minutes ago'
-@app.template_filter('timeago')
+@bp.app_template_filter('timeago')
 def timeago_format(timestamp):
     return timeago.format(timestamp, datetime.datetime.utcnow())
 
 
 # Converts time in seconds to minutes, rounded to the nearest minute
-@app.template_filter('duration')
+@bp.app_template_filter('duration')
 def duration_format(time_in_seconds):
     time_in_mins = time_in_seconds/60
     return round(time_in_mins)
 
 
 # Converts metre distance to kilometres, rounding to nearest 0.1km
-@app.template_filter('distance')
+@bp.app_template_filter('distance')
 def distance_format(distance_in_metres):
     distance_in_km = distance_in_metres/1000
     return round(distance_in_km, 1)
 
 
 # Displays the route title if present, else 'Untitled Route'
-@app.template_filter('routetitle')
+@bp.app_template_filter('routetitle')
 def routetitle_format(title):
     return title if title else "Untitled Route"
 
 
 # Converts boolean of 'is_public' to a more user-friendly 'Public' or 'Private'
-@app.template_filter('is_public')
+@bp.app_template_filter('is_public')
 def route_public_format(route_public):
     return 'Public' if route_public else 'Private'
+
+
+# Draws a route's stored preview line as a small inline SVG image, for route lists. Longitude is
+# scaled by the cosine of latitude, so the shape isn't stretched sideways.
+@bp.app_template_filter('preview_svg')
+def preview_svg_format(preview, width=60, height=40):
+    if not preview:
+        return ''
+    coords = decode_polyline(preview)
+    x = coords[:, 0] * math.cos(math.radians(coords[0][1]))
+    y = -coords[:, 1]  # SVG's y axis points down
+    scale = min((width - 4) / max(np.ptp(x), 1e-9), (height - 4) / max(np.ptp(y), 1e-9))
+    x = (x - x.min()) * scale + (width - np.ptp(x) * scale) / 2
+    y = (y - y.min()) * scale + (height - np.ptp(y) * scale) / 2
+    points = ' '.join('{:.1f},{:.1f}'.format(*point) for point in zip(x, y))
+    return Markup('<svg width="{0}" height="{1}" viewBox="0 0 {0} {1}"><polyline points="{2}" fill="none" '
+                  'stroke="#E84B29" stroke-width="2" stroke-linejoin="round"/></svg>'.format(width, height, points))
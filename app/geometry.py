@@ -0,0 +1,99 @@
+# Route geometry helpers, working on (n, 2) NumPy arrays of [longitude, latitude] coordinates
+# as returned by polyline_to_coords.
+
+import math
+import numpy as np
+from app.polyline import encode_polyline
+
+EARTH_RADIUS = 6371.0088  # Mean radius of the Earth in km
+MAX_ZOOM = 16  # At or beyond this map zoom level, routes are sent at full detail
+TILE_SIZE = 512  # Width in pixels of a whole-world map tile at zoom 0, as used by Mapbox GL
+PREVIEW_POINTS = 40  # Points in the small preview line stored with each route
+
+
+# Distance in degrees (of longitude at the equator) that one screen pixel covers at a map zoom level.
+# Simplifying to half of this removes detail which could not be seen on screen anyway.
+def zoom_tolerance(zoom):
+    return 360.0 / (TILE_SIZE * 2 ** zoom) / 2
+
+
+# Simplifies a line with the Douglas-Peucker algorithm: keeps the start and end points, then
+# recursively keeps whichever point lies furthest from the line between the points already kept,
+# until none lies more than 'tolerance' away. Distances are measured with longitude scaled by the
+# cosine of latitude, so that the tolerance means the same on the ground in every direction.
+def simplify(coords, tolerance):
+    if len(coords) < 3:
+        return coords
+
+    points = coords * [math.cos(math.radians(coords[0][1])), 1.0]  # Roughly equal-distance projection
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+
+    sections = [(0, len(points) - 1)]  # Work list of (first, last) index pairs still to simplify
+    while sections:
+        first, last = sections.pop()
+        if last - first < 2:
+            continue
+        distances = segment_distances(points[first + 1:last], points[first], points[last])
+        furthest = int(np.argmax(distances))
+        if distances[furthest] > tolerance:
+            middle = first + 1 + furthest
+            keep[middle] = True
+            sections.append((first, middle))
+            sections.append((middle, last))
+
+    return coords[keep]
+
+
+# Distance from each of 'points' to the line segment from 'a' to 'b'. Works when 'a' and 'b' are the
+# same point, as they are for the first and last points of a circular route.
+def segment_distances(points, a, b):
+    ab = b - a
+    length_squared = ab.dot(ab)
+    if length_squared == 0:
+        return np.hypot(*(points - a).T)
+    along = np.clip((points - a).dot(ab) / length_squared, 0, 1)  # Position of the closest point on the segment
+    closest = a + along[:, None] * ab
+    return np.hypot(*(points - closest).T)
+
+
+# Returns the route as a GeoJSON Feature, simplified for display at the given zoom level (or at
+# full detail if zoom is None)
+def route_geojson(coords, zoom=None):
+    if zoom is not None and zoom < MAX_ZOOM:
+        coords = simplify(coords, zoom_tolerance(zoom))
+    return {'type': 'Feature', 'properties': {},
+            'geometry': {'type': 'LineString', 'coordinates': coords.tolist()}}
+
+
+# Great-circle distance in km between two [longitude, latitude] points
+def haversine(a, b):
+    lng1, lat1, lng2, lat2 = map(math.radians, (a[0], a[1], b[0], b[1]))
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(h))
+
+
+# Great-circle length in km of every segment of a route at once (the haversine formula, as above)
+def segment_lengths(coords):
+    lng, lat = np.radians(coords).T
+    h = np.sin(np.diff(lat) / 2) ** 2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(lng) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(h))
+
+
+# Evenly spaced points (by distance along the route) from start to finish, for drawing small previews
+def preview_line(coords, points=PREVIEW_POINTS, lengths=None):
+    if len(coords) <= points:
+        return coords
+    lengths = segment_lengths(coords) if lengths is None else lengths
+    along = np.concatenate(([0.0], np.cumsum(lengths)))  # Distance of each point from the start
+    targets = np.linspace(0.0, along[-1], points)
+    return np.column_stack((np.interp(targets, along, coords[:, 0]), np.interp(targets, along, coords[:, 1])))
+
+
+# Summary of a route's shape, worked out once when it is created and stored with it (see the Route model):
+# its number of points, its length in metres measured along those points, and a preview line (encoded
+# as a polyline)
+def route_stats(coords):
+    lengths = segment_lengths(coords)
+    return {'point_count': len(coords), 'geo_distance': int(round(1000 * lengths.sum())),
+            'preview': encode_polyline(preview_line(coords, lengths=lengths))}
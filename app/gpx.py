@@ -1,32 +1,59 @@
-# Uses the gpxpy library to create a GPX version of the route (for use with a bike GPS device)
-
-import gpxpy
-import gpxpy.gpx
-from app.datafeeds import polyline_to_coords
+# Creates a GPX version of the route (for use with a bike GPS device)
+#
+# Rather than building the whole file in memory (one object per point, then one big string),
+# we write the XML out in chunks straight from the decoded coordinates. This means a download
+# can start immediately, and memory use stays the same however long the route is.
+
+import hashlib
+from xml.sax.saxutils import escape
+from app.datafeeds import geometry_to_coords
+
+GPX_HEADER = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+              '<gpx xmlns="http://www.topografix.com/GPX/1/1" '
+              'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+              'xsi:schemaLocation="http://www.topografix.com/GPX/1/1 http://www.topografix.com/GPX/1/1/gpx.xsd" '
+              'version="1.1" creator="RideTime">\n'
+              '  <metadata>\n'
+              '    <name>{name}</name>\n'
+              '    <desc>This is a cycling route file as GPX, generated from RideTime</desc>\n'
+              '  </metadata>\n'
+              '  <trk>\n'
+              '    <name>{name}</name>\n'
+              '    <trkseg>\n')
+GPX_POINT = '      <trkpt lat="{1:.5f}" lon="{0:.5f}"/>\n'  # Fixed point (never '1e-05'), as precise as the polyline
+GPX_FOOTER = '    </trkseg>\n  </trk>\n</gpx>\n'
+POINTS_PER_CHUNK = 500  # Points written per chunk of output
+GPX_VERSION = 2  # Increased whenever the output changes, so that clients replace their copies
+
+
+# Yields the GPX file for a route title and array of [longitude, latitude] coordinates, in chunks
+def stream_gpx(title, route_coords):
+    yield GPX_HEADER.format(name=escape(title or ''))
+    for start in range(0, len(route_coords), POINTS_PER_CHUNK):
+        chunk = route_coords[start:start + POINTS_PER_CHUNK].tolist()
+        yield ''.join([GPX_POINT.format(*coords) for coords in chunk])
+    yield GPX_FOOTER
 
 
 # We implement our own method to handle the data format we are using - the input is a
-# Route object, which is used to set the title. The polyline is extracted from the Route
-# object and decoded, with the coordinates used to construct the GPX file.
+# Route object, which is used to set the title. The geometry is extracted from the Route
+# object and unpacked, with the coordinates used to construct the GPX file.
 def route_to_gpx(route):
-    gpx = gpxpy.gpx.GPX()
-    gpx.name = route.title
-    gpx.creator = 'RideTime'
-    gpx.description = 'This is a cycling route file as GPX, generated from RideTime'
+    return ''.join(stream_gpx(route.title, geometry_to_coords(route.geometry, route.id)))
+
 
-    # Create first track in our GPX:
-    gpx_track = gpxpy.gpx.GPXTrack()
-    gpx_track.name = route.title
-    gpx.tracks.append(gpx_track)
+# Returns a generator of the GPX file for a Route object. Decoding only starts once the first chunk is
+# requested, so nothing is wasted if the response turns out not to need a body (e.g. '304 Not Modified').
+def route_gpx_stream(route):
+    title, geometry, route_id = route.title, route.geometry, route.id  # Read now, while the DB session is open
 
-    # Create first segment in our GPX track:
-    gpx_segment = gpxpy.gpx.GPXTrackSegment()
-    gpx_track.segments.append(gpx_segment)
+    def generate():
+        yield from stream_gpx(title, geometry_to_coords(geometry, route_id))
 
-    route_coords = polyline_to_coords(route.polyline)
+    return generate()
 
-    # Create points:
-    for coords in route_coords:
-        gpx_segment.points.append(gpxpy.gpx.GPXTrackPoint(longitude=coords[0], latitude=coords[1]))
 
-    return gpx.to_xml()
+# Identifies the content of a route's GPX file, so that clients can tell whether their copy is up to date
+def gpx_etag(route):
+    content = '{}\n{}\n'.format(GPX_VERSION, route.title).encode('utf-8') + (route.geometry or b'')
+    return hashlib.sha1(content).hexdigest()
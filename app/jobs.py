@@ -0,0 +1,189 @@
+# Batch route generation, for event planners who need many candidate routes at once.
+#
+# A job is created through the JSON API (see 'create_job' in routes.py) from a list of specs, each
+# a start point, distance and number of routes. The routes to generate are stored as JobTask rows,
+# which act as a persistent queue: 'flask run-worker' processes claim tasks one at a time, call ORS
+# (through the shared client, so its rate limit and circuit breaker apply) and store each finished
+# route as a Route row linked to the job. Progress, and the routes finished so far, can be polled
+# at any time.
+
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import or_
+from app import db
+from app.models import Job, JobTask, Route
+from app.orsclient import ORSUnavailable
+from app.routefinder import roundroute
+from config import Config
+
+log = logging.getLogger(__name__)
+
+
+# Raised when a job request is malformed, with a message to return to the client
+class JobSpecError(ValueError):
+    pass
+
+
+# Checks the 'routes' list of a job request, returning a list of (start coordinates, km, count)
+def parse_specs(specs):
+    if not isinstance(specs, list) or not specs:
+        raise JobSpecError("'routes' must be a non-empty list")
+
+    parsed = []
+    for spec in specs:
+        try:
+            longitude, latitude = (float(value) for value in spec['start'])
+            distance, count = int(spec['distance']), int(spec.get('count', 1))
+        except (KeyError, TypeError, ValueError):
+            raise JobSpecError("Each spec needs 'start' ([longitude, latitude]), 'distance' (km) and 'count'")
+        if not (-180 <= longitude <= 180 and -90 <= latitude <= 90):
+            raise JobSpecError("'start' must be [longitude, latitude]")
+        if not 1 <= distance <= 100:
+            raise JobSpecError("'distance' must be from 1 to 100 km")
+        if count < 1:
+            raise JobSpecError("'count' must be at least 1")
+        parsed.append(((longitude, latitude), distance, count))
+
+    if sum(count for _, _, count in parsed) > Config.JOB_MAX_ROUTES:
+        raise JobSpecError('A job can generate at most {} routes'.format(Config.JOB_MAX_ROUTES))
+    return parsed
+
+
+# Creates a job, with a queued task for every route it should generate
+def create_job(user_id, specs):
+    job = Job(user_id=user_id)
+    db.session.add(job)
+    db.session.flush()  # Assigns the job its ID
+    db.session.bulk_insert_mappings(JobTask, [
+        {'job_id': job.id, 'start_longitude': start[0], 'start_latitude': start[1], 'distance': distance,
+         'status': 'queued', 'attempts': 0}
+        for start, distance, count in parse_specs(specs) for _ in range(count)])
+    db.session.commit()
+    return job
+
+
+# Summary of a job's progress, and the routes generated so far, for the API to return
+def job_progress(job):
+    counts = dict(db.session.query(JobTask.status, db.func.count()).filter_by(job_id=job.id)
+                  .group_by(JobTask.status).all())
+    routes = job.routes.with_entities(Route.id, Route.distance, Route.duration, Route.start_longitude,
+                                      Route.start_latitude).order_by(Route.id).all()
+    return {'id': job.id, 'status': job.status, 'created_at': job.created_at.isoformat() + 'Z',
+            'finished_at': job.finished_at.isoformat() + 'Z' if job.finished_at else None,
+            'total': sum(counts.values()), 'queued': counts.get('queued', 0), 'running': counts.get('running', 0),
+            'done': counts.get('done', 0), 'failed': counts.get('failed', 0),
+            'routes': [{'id': route.id, 'distance': route.distance, 'duration': route.duration,
+                        'start': [route.start_longitude, route.start_latitude]} for route in routes]}
+
+
+# Claims the next queued task for this worker, or returns None if there are none ready. The claim
+# only succeeds if the task is still queued, so two workers can never take the same task.
+def claim_task():
+    now = datetime.utcnow()
+    candidates = db.session.query(JobTask.id).filter(
+        JobTask.status == 'queued', or_(JobTask.not_before.is_(None), JobTask.not_before <= now)
+    ).order_by(JobTask.id).limit(10).all()
+    for task_id, in candidates:
+        claimed = JobTask.query.filter_by(id=task_id, status='queued').update(
+            {'status': 'running', 'claimed_at': now}, synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            return JobTask.query.get(task_id)
+    return None
+
+
+# Puts back tasks whose worker stopped part way through (e.g. it was restarted), so another can take them
+def requeue_abandoned_tasks():
+    cutoff = datetime.utcnow() - timedelta(seconds=Config.JOB_TASK_TIMEOUT)
+    requeued = JobTask.query.filter(JobTask.status == 'running', JobTask.claimed_at < cutoff).update(
+        {'status': 'queued'}, synchronize_session=False)
+    db.session.commit()
+    return requeued
+
+
+# Generates the route for a claimed task, and stores it (or records why it couldn't be made)
+def process_task(task):
+    job = task.job
+    if job.status == 'queued':
+        job.status = 'running'
+        db.session.commit()
+
+    try:
+        route = roundroute((task.start_longitude, task.start_latitude), task.distance)
+    except ORSUnavailable:  # Over our ORS rate limit, or ORS is down, so try again later. Not the task's fault.
+        task.status = 'queued'
+        task.not_before = datetime.utcnow() + timedelta(seconds=Config.JOB_RETRY_DELAY)
+        db.session.commit()
+        return
+    except Exception as e:
+        log.warning('Job task %s failed: %s', task.id, e)
+        task.attempts += 1
+        task.error = str(e)[:200]
+        task.status = 'failed' if task.attempts >= Config.JOB_MAX_ATTEMPTS else 'queued'
+        task.not_before = datetime.utcnow() + timedelta(seconds=Config.JOB_RETRY_DELAY)
+        db.session.commit()
+        finish_job_if_complete(job)
+        return
+
+    route.user_id = job.user_id
+    route.job = job
+    route.title = 'Job {} route {} ({} km)'.format(job.id, task.id, task.distance)
+    db.session.add(route)
+    db.session.flush()  # Assigns the route its ID
+    task.route_id = route.id
+    task.status = 'done'
+    task.error = None
+    db.session.commit()
+    finish_job_if_complete(job)
+
+
+# Marks a job as done once none of its tasks are waiting or in progress
+def finish_job_if_complete(job):
+    remaining = job.tasks.filter(JobTask.status.in_(('queued', 'running'))).count()
+    if remaining == 0 and job.status != 'done':
+        job.status = 'done'
+        job.finished_at = datetime.utcnow()
+        db.session.commit()
+
+
+# Works through queued tasks on several threads until 'stop' is set. Each thread handles one task at
+# a time, so 'threads' is the number of routes generated at once by this process.
+def run_worker(threads=None, poll_interval=None, stop=None):
+    threads = threads or Config.JOB_WORKER_THREADS
+    poll_interval = poll_interval or Config.JOB_POLL_INTERVAL
+    stop = stop or threading.Event()
+    app = current_app._get_current_object()  # For the worker threads, which each need their own app context
+
+    def work():
+        with app.app_context():
+            while not stop.is_set():
+                try:
+                    task = claim_task()
+                    if task is None:
+                        stop.wait(poll_interval)  # Nothing to do yet
+                        continue
+                    process_task(task)
+                except Exception:  # e.g. lost the DB connection. Carry on with the next task.
+                    log.exception('Job worker error')
+                    db.session.rollback()
+                    stop.wait(poll_interval)
+                finally:
+                    db.session.remove()
+
+    workers = [threading.Thread(target=work, name='job-worker-{}'.format(i), daemon=True) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    log.info('Job worker %s started with %s threads', os.getpid(), threads)
+
+    with app.app_context():
+        while not stop.wait(Config.JOB_TASK_TIMEOUT / 4):  # Meanwhile, rescue tasks abandoned by other workers
+            requeued = requeue_abandoned_tasks()
+            if requeued:
+                log.info('Requeued %s abandoned job tasks', requeued)
+            db.session.remove()
+
+    for worker in workers:
+        worker.join()
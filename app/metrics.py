@@ -0,0 +1,272 @@
+# Collects timings from around the app, and serves them on '/metrics' in the Prometheus text
+# format, so we can see where the time goes in slow requests:
+#   - how long each endpoint takes to respond
+#   - how long each ORS API call takes ('directions', 'pelias_search')
+#   - how many SQL queries each request makes, and how long they take
+#   - how long each template takes to render
+#   - how far routes from ORS miss the distance asked for
+#
+# Each gunicorn worker counts its own requests in memory (just a few additions per request), and
+# every few seconds writes a copy to its own file in METRICS_DIR. Whichever worker answers
+# '/metrics' adds its own live counts to the latest copies from the other workers. Files from
+# workers which have since stopped are kept, so that totals never go backwards, and each file is
+# named by a random ID as well as the process ID, so a new worker given a stopped worker's process
+# ID can't overwrite its counts. The gunicorn master empties METRICS_DIR when it starts (see
+# 'on_starting' in gunicorn.conf.py), so totals start from zero with each server, rather than
+# including every earlier one; so each server on a machine needs its own METRICS_DIR.
+
+import bisect
+import json
+import os
+import secrets
+import threading
+import time
+from flask import g, has_request_context, request, before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from app import bp
+from app.calibration import calibrator
+from app.datafeeds import ors
+from app.sessions import session_interface
+from config import Config
+
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # Seconds
+ORS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30)  # Seconds, as ORS calls take far longer
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+ERROR_BUCKETS = (0.02, 0.05, 0.1, 0.2, 0.3, 0.5, 1)  # Fractions of the distance asked for
+
+# Name -> (type, description, histogram buckets)
+DEFINITIONS = {
+    'ridetime_requests_total': ('counter', 'Requests handled, by endpoint and status code', None),
+    'ridetime_request_seconds': ('histogram', 'Time taken to handle requests, by endpoint', TIME_BUCKETS),
+    'ridetime_ors_call_seconds': ('histogram', 'Time taken by ORS API calls (including retries), by API and outcome',
+                                  ORS_BUCKETS),
+    'ridetime_db_queries_per_request': ('histogram', 'SQL queries made while handling a request, by endpoint',
+                                        COUNT_BUCKETS),
+    'ridetime_db_query_seconds': ('histogram', 'Time taken by SQL queries, by endpoint', TIME_BUCKETS),
+    'ridetime_template_render_seconds': ('histogram', 'Time taken to render page templates, by template',
+                                         TIME_BUCKETS),
+    'ridetime_route_distance_error': ('histogram', 'How far ORS routes miss the distance asked for (as a fraction), '
+                                                   'by distance band and whether the length was calibrated',
+                                      ERROR_BUCKETS),
+    'ridetime_session_loads_total': ('counter', "Sessions loaded, by where from ('cache', 'store', or 'none' "
+                                                "for a new or expired session)", None),
+}
+
+
+# Counters and histograms for this worker, plus the files shared with the others
+class MetricsRegistry(object):
+
+    def __init__(self, definitions, directory=None, flush_interval=5):
+        self.definitions = definitions
+        self.directory = directory  # Where workers share their counts, or None for this process only
+        self.flush_interval = flush_interval  # Seconds between writing this worker's counts to its file
+        self._values = {}  # Maps (name, labels) -> count, or list of counts per bucket plus the sum, for histograms
+        self._lock = threading.Lock()
+        self._pid = None  # Process the counts belong to, so a newly forked worker can start afresh
+        self._filename = None  # This worker's file in 'directory'
+        self._thread = None
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._check_process()
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        buckets = self.definitions[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._check_process()
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(buckets) + 1) + [0.0]  # Last bucket is '+Inf'
+            counts[bisect.bisect_left(buckets, value)] += 1
+            counts[-1] += value
+
+    # Clears counts inherited from a parent process, and starts writing this worker's file
+    def _check_process(self):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._values = {}
+            self._filename = 'worker-{}-{}.json'.format(self._pid, secrets.token_hex(4))
+            if self.directory:
+                os.makedirs(self.directory, exist_ok=True)
+                self._thread = threading.Thread(target=self._run, name='metrics', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    # Writes this worker's counts to its file, replacing the old copy in one step so readers never see half of it
+    def flush(self):
+        path = os.path.join(self.directory, self._filename)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(path + '.tmp', path)
+
+    # This worker's counts, as a list of [name, labels, value]
+    def snapshot(self):
+        with self._lock:
+            return [[name, list(labels), value if isinstance(value, (int, float)) else list(value)]
+                    for (name, labels), value in self._values.items()]
+
+    # Adds up the counts from every worker (using live counts for this one)
+    def collect(self):
+        with self._lock:
+            self._check_process()  # So this worker's own file is known, and skipped below
+        snapshots = [self.snapshot()]
+        if self.directory and os.path.isdir(self.directory):
+            for filename in os.listdir(self.directory):
+                if filename.endswith('.json') and filename != self._filename:
+                    try:
+                        with open(os.path.join(self.directory, filename)) as f:
+                            snapshots.append(json.load(f))
+                    except (OSError, ValueError):  # Removed or unreadable, so skip it
+                        continue
+
+        totals = {}
+        for snapshot in snapshots:
+            for name, labels, value in snapshot:
+                key = (name, tuple(tuple(label) for label in labels))
+                if key not in totals:
+                    totals[key] = value
+                elif isinstance(value, list):
+                    totals[key] = [a + b for a, b in zip(totals[key], value)]
+                else:
+                    totals[key] += value
+        return totals
+
+    # All metrics in the Prometheus text format
+    def exposition(self):
+        totals = self.collect()
+        lines = []
+        for name, (kind, description, buckets) in self.definitions.items():
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for (metric, labels), value in sorted(totals.items()):
+                if metric != name:
+                    continue
+                if kind == 'counter':
+                    lines.append('{}{} {}'.format(name, format_labels(labels), value))
+                    continue
+                cumulative = 0
+                for bound, count in zip(list(buckets) + ['+Inf'], value[:-1]):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(name, format_labels(labels + (('le', str(bound)),)),
+                                                         cumulative))
+                lines.append('{}_sum{} {!r}'.format(name, format_labels(labels), value[-1]))
+                lines.append('{}_count{} {}'.format(name, format_labels(labels), cumulative))
+        return '\n'.join(lines) + '\n'
+
+
+# Formats labels as e.g. '{endpoint="view_route",status="200"}'
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = ('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for key, value in labels)
+    return '{' + ','.join(escaped) + '}'
+
+
+metrics = MetricsRegistry(DEFINITIONS, directory=Config.METRICS_DIR or None,
+                          flush_interval=Config.METRICS_FLUSH_INTERVAL)
+
+
+# Request timing. Counts are kept on 'g' during the request, and recorded once it is finished.
+@bp.before_app_request
+def start_request_metrics():
+    g.metrics_started = time.perf_counter()
+    g.metrics_queries = 0
+
+
+@bp.after_app_request
+def record_request_metrics(response):
+    finish_request_metrics(response.status_code)
+    return response
+
+
+# Requests which raised an error don't reach 'after_request', so are recorded here instead
+@bp.teardown_app_request
+def record_failed_request_metrics(error=None):
+    if error is not None:
+        finish_request_metrics(500)
+
+
+def finish_request_metrics(status):
+    started = g.pop('metrics_started', None)
+    if started is None:  # Already recorded
+        return
+    endpoint = endpoint_label()
+    metrics.inc('ridetime_requests_total', endpoint=endpoint, status=status)
+    metrics.observe('ridetime_request_seconds', time.perf_counter() - started, endpoint=endpoint)
+    metrics.observe('ridetime_db_queries_per_request', g.get('metrics_queries', 0), endpoint=endpoint)
+
+
+# ORS call timing, from the ORS client's own measurements (which cover any retries)
+def record_ors_call(name, seconds, error):
+    metrics.observe('ridetime_ors_call_seconds', seconds, api=name, outcome='error' if error else 'ok')
+
+
+ors.listeners.append(record_ors_call)
+
+
+# How far each route from ORS missed the rider's distance (see calibration.py)
+def record_distance_error(band, error, calibrated):
+    metrics.observe('ridetime_route_distance_error', abs(error), band=band, calibrated='yes' if calibrated else 'no')
+
+
+calibrator.listeners.append(record_distance_error)
+
+
+def record_session_load(source):
+    metrics.inc('ridetime_session_loads_total', source=source)
+
+
+if session_interface is not None:
+    session_interface.listeners.append(record_session_load)
+
+
+# Label for the current request's endpoint, e.g. 'view_route' (without the blueprint's 'main.'), or 'none'
+# if the URL didn't match one, e.g. a 404
+def endpoint_label():
+    return (request.endpoint or 'none').rpartition('.')[2]
+
+
+# SQL query timing, for every engine. Queries made outside a request (e.g. in the route pool's
+# background thread) are counted under the endpoint 'background'.
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def record_query_metrics(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - conn.info['metrics_started'].pop()
+    endpoint = 'background'
+    if has_request_context():
+        endpoint = endpoint_label()
+        g.metrics_queries = g.get('metrics_queries', 0) + 1
+    metrics.observe('ridetime_db_query_seconds', seconds, endpoint=endpoint)
+
+
+@event.listens_for(Engine, 'handle_error')
+def discard_query_timer(exception_context):
+    if exception_context.connection is not None and exception_context.connection.info.get('metrics_started'):
+        exception_context.connection.info['metrics_started'].pop()  # The query failed, so won't be recorded
+
+
+# Template render timing, using Flask's signals (sent for each 'render_template' call)
+@before_render_template.connect
+def start_template_timer(sender, template, context, **extra):
+    g.setdefault('metrics_templates', []).append(time.perf_counter())
+
+
+@template_rendered.connect
+def record_template_metrics(sender, template, context, **extra):
+    started = g.get('metrics_templates')
+    if started:
+        metrics.observe('ridetime_template_render_seconds', time.perf_counter() - started.pop(),
+                        template=template.name)
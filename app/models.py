@@ -3,7 +3,16 @@
 
 from datetime import datetime
 from app import db, lm
+from app.cache import TTLCache
+from app.polyline import decode_polyline, encode_polyline, pack_coords, unpack_coords
+from config import Config
 from flask_login import UserMixin
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+from sqlalchemy.ext.hybrid import hybrid_property
+
+# Recently seen users, so that signed in requests don't need a DB query just to find out who is signed in
+user_cache = TTLCache(maxsize=Config.USER_CACHE_SIZE, ttl=Config.USER_CACHE_TTL)
 
 
 # User class for handling user registration and login
@@ -14,14 +23,58 @@ class User(UserMixin, db.Model):
     email = db.Column(db.String(64), nullable=True)
     routes = db.relationship('Route', backref='creator', lazy='dynamic')
 
+    # Loads the signed in user for each request, as a UserSnapshot (from the cache where possible)
     @lm.user_loader
     def load_user(id):
-        return User.query.get(int(id))
+        user = user_cache.get(int(id))
+        if user is None:
+            stored = User.query.get(int(id))
+            if stored is None:
+                return None
+            user = UserSnapshot(stored)
+            user_cache.set(user.id, user)
+        return user
+
+    def __repr__(self):
+        return "User ID {}".format(self.id)
+
+
+# Read-only copy of a User's details, not attached to any DB session, so one copy can be safely
+# shared by every request (on any thread) until it expires from the cache. Code which needs to
+# change the user, or follow its relationships, should load the User itself from the DB.
+class UserSnapshot(UserMixin):
+
+    def __init__(self, user):
+        self.id = user.id
+        self.social_id = user.social_id
+        self.nickname = user.nickname
+        self.email = user.email
 
     def __repr__(self):
         return "User ID {}".format(self.id)
 
 
+# Drops a user from the cache whenever their record is changed, so the next request loads the new version.
+# (Other workers pick up the change once their copy expires, after at most USER_CACHE_TTL seconds.)
+# Changes are only noted as they are flushed, and the user dropped once they are committed: dropping
+# them any sooner would let another request cache the old record again in the meantime.
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def note_changed_user(mapper, connection, target):
+    object_session(target).info.setdefault('changed_users', set()).add(target.id)
+
+
+@event.listens_for(db.session, 'after_commit')
+def evict_cached_users(session):
+    for user_id in session.info.pop('changed_users', ()):
+        user_cache.evict(user_id)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_changed_users(session):
+    session.info.pop('changed_users', None)  # The changes were undone, so the cached copies still stand
+
+
 # Route class for storing and loading cycling routes
 class Route(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -31,8 +84,125 @@ class Route(db.Model):
     distance = db.Column(db.Integer, index=False)
     duration = db.Column(db.Integer, index=False)
     bbox = db.Column(db.String(120), index=False)
-    polyline = db.Column(db.String(10000), index=False)
+    geometry = db.Column(db.LargeBinary, index=False)  # Route coordinates, packed by 'pack_coords' (see polyline.py)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)  # Last saved or edited
+
+    # Where the route starts, and the corners of its bounding box, so routes can be searched by location
+    start_longitude = db.Column(db.Float, nullable=True)
+    start_latitude = db.Column(db.Float, nullable=True)
+    min_longitude = db.Column(db.Float, nullable=True)
+    min_latitude = db.Column(db.Float, nullable=True)
+    max_longitude = db.Column(db.Float, nullable=True)
+    max_latitude = db.Column(db.Float, nullable=True)
+
+    # Summary of the route's shape (see 'route_stats' in geometry.py), so it can be shown without unpacking 'geometry'
+    point_count = db.Column(db.Integer, nullable=True)
+    geo_distance = db.Column(db.Integer, nullable=True)  # Metres, measured along the route's points
+    preview = db.Column(db.String(500), nullable=True)  # Encoded polyline of a few points along the route
+
+    # Metres the rider asked for, and the length we asked ORS for (adjusted by calibration.py), where known
+    target_distance = db.Column(db.Integer, nullable=True)
+    requested_distance = db.Column(db.Integer, nullable=True)
+
+    job_id = db.Column(db.Integer, db.ForeignKey('job.id'), nullable=True, index=True)  # Batch job that made it, if any
+
+    # Indexes for listing a user's routes, and all public routes, newest first, and for finding routes by start point
+    __table_args__ = (db.Index('ix_route_user_id_timestamp', 'user_id', 'timestamp'),
+                      db.Index('ix_route_public_timestamp', 'public', 'timestamp'),
+                      db.Index('ix_route_start', 'start_latitude', 'start_longitude'))
+
+    # The route as an encoded polyline, as returned by ORS. Stored as packed binary 'geometry',
+    # which is smaller (from around 80% of the size for short routes, to 40% for 100 km), and has no
+    # limit on the length of the route.
+    @hybrid_property
+    def polyline(self):
+        if self.geometry is None:
+            return None
+        return encode_polyline(unpack_coords(self.geometry))
+
+    @polyline.setter
+    def polyline(self, encoded_polyline):
+        self.geometry = None if encoded_polyline is None else pack_coords(decode_polyline(encoded_polyline))
+
+    @polyline.expression
+    def polyline(cls):
+        return cls.geometry  # In queries, e.g. load_only(Route.polyline), refer to the stored column
 
     def __repr__(self):
         return "Ride {}, created by user ID {} on {}".format(self.id, self.user_id, self.timestamp)
+
+
+# Cached result of a location search, so repeated searches for the same place (by any
+# worker, and across restarts) can be answered without another call to the ORS API.
+# A row with found=False records that ORS had no match, so misses are cached too.
+class GeocodeResult(db.Model):
+    search = db.Column(db.String(120), primary_key=True)  # Normalised search text, e.g. 'B15 2TT'
+    found = db.Column(db.Boolean, default=False)
+    longitude = db.Column(db.Float, nullable=True)
+    latitude = db.Column(db.Float, nullable=True)
+    address = db.Column(db.String(120), nullable=True)
+    timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+
+    def __repr__(self):
+        return "Geocode result for '{}', looked up on {}".format(self.search, self.timestamp)
+
+
+# A route which has been generated but not (yet) saved, when unsaved routes are kept in the DB
+# (see unsaved.py). Held under a random token from the visitor's session until it expires.
+class UnsavedRoute(db.Model):
+    token = db.Column(db.String(32), primary_key=True)  # Random, e.g. 'Xq3v0Zr...'
+    record = db.Column(db.Text, nullable=False)  # The Route's columns, as JSON
+    expires = db.Column(db.DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return "Unsaved route {}, expiring {}".format(self.token, self.expires)
+
+
+# Contents of a visitor's session, when sessions are kept in the DB (see sessions.py). The session
+# cookie holds only the ID, and the version it last saw, so each worker can tell whether its copy is current.
+class StoredSession(db.Model):
+    id = db.Column(db.String(64), primary_key=True)  # Random, e.g. 'bJ0c1pQ...'
+    version = db.Column(db.Integer, nullable=False, default=1)  # Increased each time the contents change
+    data = db.Column(db.Text, nullable=False)  # Serialised as Flask serialises its session cookie
+    expires = db.Column(db.DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return "Session {}, version {}, expiring {}".format(self.id, self.version, self.expires)
+
+
+# Batch of routes requested through the job API (see jobs.py). Each route to generate is a JobTask,
+# worked through by 'flask run-worker' processes; finished routes are linked back to the job.
+class Job(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
+    status = db.Column(db.String(16), default='queued')  # 'queued', 'running' or 'done'
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    tasks = db.relationship('JobTask', backref='job', lazy='dynamic')
+    routes = db.relationship('Route', backref='job', lazy='dynamic')
+
+    def __repr__(self):
+        return "Job {}, created by user ID {} on {}".format(self.id, self.user_id, self.created_at)
+
+
+# One route for a Job to generate. The table doubles as the work queue: workers claim 'queued' tasks
+# by switching them to 'running', so any number of workers can share it safely.
+class JobTask(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.Integer, db.ForeignKey('job.id'), index=True)
+    start_longitude = db.Column(db.Float)
+    start_latitude = db.Column(db.Float)
+    distance = db.Column(db.Integer)  # km
+    status = db.Column(db.String(16), default='queued')  # 'queued', 'running', 'done' or 'failed'
+    attempts = db.Column(db.Integer, default=0)  # Failed attempts so far
+    not_before = db.Column(db.DateTime, nullable=True)  # Retry no earlier than this, after a failure
+    claimed_at = db.Column(db.DateTime, nullable=True)  # When a worker started on it, to spot abandoned tasks
+    route_id = db.Column(db.Integer, db.ForeignKey('route.id'), nullable=True)
+    error = db.Column(db.String(200), nullable=True)
+
+    __table_args__ = (db.Index('ix_job_task_status_id', 'status', 'id'),)  # For finding the next task to work on
+
+    def __repr__(self):
+        return "Task {} of job {}: {} km from {}, {}".format(self.id, self.job_id, self.distance,
+                                                            (self.start_longitude, self.start_latitude), self.status)
@@ -0,0 +1,46 @@
+# Finds existing public routes which start near a given location and are close to a given length,
+# so that we can offer riders a route straight away (without another call to ORS).
+#
+# Routes store their start point in their own columns, with an index on (latitude, longitude). We
+# first use that index to find routes starting inside a box around the location, and have the DB
+# keep the nearest few (by a quick flat-earth distance, which orders them well enough), then work
+# out the real distance to each of those and keep the closest.
+
+import math
+from sqlalchemy.orm import load_only
+from app.geometry import haversine, EARTH_RADIUS
+from app.models import Route
+from config import Config
+
+
+# Returns up to 'limit' public routes starting within 'radius' km of 'start_coords' ([longitude, latitude])
+# whose distance is within 'tolerance' (a fraction, e.g. 0.2 for 20%) of 'km_distance', closest first.
+# Each route has a 'km_away' attribute set, giving how far its start is from 'start_coords'.
+def nearby_routes(start_coords, km_distance, radius=None, tolerance=None, limit=None):
+    radius = radius or Config.NEARBY_RADIUS
+    tolerance = Config.NEARBY_TOLERANCE if tolerance is None else tolerance
+    limit = limit or Config.NEARBY_LIMIT
+
+    longitude, latitude = start_coords
+    lat_range = math.degrees(radius / EARTH_RADIUS)  # Height of the search box, either side of the start
+    lng_range = lat_range / max(math.cos(math.radians(latitude)), 0.01)  # Longitude lines converge towards the poles
+    metres = km_distance * 1000
+    lat_offset = Route.start_latitude - latitude
+    lng_offset = (Route.start_longitude - longitude) * math.cos(math.radians(latitude))  # In degrees of latitude
+
+    candidates = Route.query.filter(
+        Route.start_latitude.between(latitude - lat_range, latitude + lat_range),
+        Route.start_longitude.between(longitude - lng_range, longitude + lng_range),
+        Route.public,
+        Route.distance.between(metres * (1 - tolerance), metres * (1 + tolerance))
+    ).options(load_only(Route.id, Route.user_id, Route.public, Route.title, Route.distance, Route.duration,
+                        Route.timestamp, Route.start_longitude, Route.start_latitude, Route.preview)).order_by(
+        lat_offset * lat_offset + lng_offset * lng_offset).limit(limit * 20).all()
+
+    routes = []
+    for route in candidates:  # The box has corners beyond the radius, so check the actual distance
+        route.km_away = haversine(start_coords, (route.start_longitude, route.start_latitude))
+        if route.km_away <= radius:
+            routes.append(route)
+    routes.sort(key=lambda route: (route.km_away, abs(route.distance - metres)))
+    return routes[:limit]
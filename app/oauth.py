@@ -5,7 +5,6 @@
 # This code is adapted from: https://github.com/miguelgrinberg/flask-oauth-example
 
 import json
-from rauth import OAuth2Service
 from flask import current_app, url_for, request, redirect, session
 
 
@@ -26,7 +25,7 @@ class OAuthSignIn(object):
         pass
 
     def get_callback_url(self):
-        return url_for('oauth_callback', provider=self.provider_name,
+        return url_for('main.oauth_callback', provider=self.provider_name,
                        _external=True)
 
     @classmethod
@@ -42,6 +41,7 @@ class OAuthSignIn(object):
 # Specifics for implementing OAuth with Facebook accounts
 class FacebookSignIn(OAuthSignIn):
     def __init__(self):
+        from rauth import OAuth2Service  # Loaded on the first sign in, rather than with the app
         super(FacebookSignIn, self).__init__('facebook')
         self.service = OAuth2Service(
             name='facebook',
@@ -0,0 +1,240 @@
+# A wrapper around the Openrouteservice client which protects both us and our ORS quota.
+#
+# All ORS calls (location search and route generation) go through one client per worker, which:
+#  - reuses HTTP connections from a pool sized for the threads making calls at the same time
+#  - limits how quickly we call ORS, using a token bucket shared by every kind of call
+#  - retries rate-limited (429) and server error (5xx) responses, with jittered backoff
+#  - stops calling ORS for a while after repeated failures (a 'circuit breaker'), failing fast
+#    with ORSUnavailable so that callers can fall back to cached results instead of waiting
+#  - records how long each kind of call takes
+#
+# ORS library can be found here: https://github.com/GIScience/openrouteservice-py
+
+import random
+import threading
+import time
+from collections import deque
+import openrouteservice
+import requests
+from openrouteservice import exceptions
+from requests.adapters import HTTPAdapter
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}  # Responses worth trying again
+
+
+# Raised instead of calling ORS when it is known to be failing, or we are over our own rate limit
+class ORSUnavailable(Exception):
+    pass
+
+
+# Token bucket rate limiter: allows bursts of up to 'capacity' calls, refilling at 'rate' calls per second
+class TokenBucket(object):
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    # Takes a token, waiting for one if necessary. Gives up (returning False) if that would take over 'timeout' seconds.
+    def acquire(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+# Circuit breaker: after 'threshold' failures in a row, calls are refused for 'reset_timeout' seconds.
+# After that a single trial call is let through, and its outcome decides whether to close or reopen.
+class CircuitBreaker(object):
+
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None  # Time the breaker tripped, or None while closed
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        return 'half-open' if time.monotonic() - self.opened_at >= self.reset_timeout else 'open'
+
+    # Raises ORSUnavailable if the call should not be made
+    def check(self):
+        with self._lock:
+            state = self.state
+            if state == 'open' or (state == 'half-open' and self._trial_running):
+                raise ORSUnavailable('ORS is unavailable after {} failed calls'.format(self.failures))
+            if state == 'half-open':
+                self._trial_running = True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    # Used when a call was abandoned without reaching ORS, so tells us nothing about its health
+    def record_skipped(self):
+        with self._lock:
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial_running or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+            self._trial_running = False
+
+
+# Per-endpoint call counts, errors and timings, keeping recent samples for percentiles
+class LatencyStats(object):
+
+    def __init__(self, samples=500):
+        self.samples = samples
+        self._calls = {}  # Maps endpoint name -> dict of counts and recent durations
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds, error=False):
+        with self._lock:
+            calls = self._calls.setdefault(name, {'count': 0, 'errors': 0, 'total': 0.0, 'max': 0.0,
+                                                  'recent': deque(maxlen=self.samples)})
+            calls['count'] += 1
+            calls['errors'] += 1 if error else 0
+            calls['total'] += seconds
+            calls['max'] = max(calls['max'], seconds)
+            calls['recent'].append(seconds)
+
+    # Summary for each endpoint, with timings in milliseconds
+    def summary(self):
+        with self._lock:
+            result = {}
+            for name, calls in self._calls.items():
+                recent = sorted(calls['recent'])
+                result[name] = {
+                    'count': calls['count'], 'errors': calls['errors'],
+                    'mean_ms': round(1000 * calls['total'] / calls['count'], 1),
+                    'p50_ms': round(1000 * recent[len(recent) // 2], 1),
+                    'p95_ms': round(1000 * recent[int(len(recent) * 0.95)], 1),
+                    'max_ms': round(1000 * calls['max'], 1)}
+            return result
+
+
+# Drop-in replacement for openrouteservice.Client, so the library's own 'directions', 'pelias_search' etc.
+# can still be used with it. Only the 'request' method, which every API call ends up in, is replaced.
+class ResilientClient(openrouteservice.Client):
+
+    def __init__(self, key=None, base_url='https://api.openrouteservice.org', timeout=20, pool_size=10,
+                 rate_per_minute=40, burst=10, rate_wait=5, max_retries=2, breaker_threshold=5, breaker_reset=30):
+        super(ResilientClient, self).__init__(key=key, base_url=base_url, timeout=timeout,
+                                              retry_over_query_limit=False)
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)  # Keep-alive connections to reuse
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+
+        self.limiter = TokenBucket(rate_per_minute / 60.0, burst)
+        self.rate_wait = rate_wait  # Seconds a call may wait for the rate limiter before giving up
+        self.max_retries = max_retries
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_reset)
+        self.latency = LatencyStats()
+        self.listeners = []  # Functions called with (endpoint name, seconds, error) after each API call
+
+    def request(self, url, get_params=None, first_request_time=None, retry_counter=0, requests_kwargs=None,
+                post_json=None, dry_run=None):
+        if dry_run:
+            return super(ResilientClient, self).request(url, get_params, requests_kwargs=requests_kwargs,
+                                                        post_json=post_json, dry_run=dry_run)
+
+        self.breaker.check()  # Fail fast if ORS is known to be down
+        name = endpoint_name(url)
+        started = time.perf_counter()
+        try:
+            result = self._request_with_retries(url, get_params, requests_kwargs, post_json)
+        except ORSUnavailable:  # Held back by our own rate limit
+            self.breaker.record_skipped()
+            self._record(name, time.perf_counter() - started, error=True)
+            raise
+        except Exception as e:
+            if is_outage(e):
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()  # e.g. a 404 for an impossible route. ORS itself is fine.
+            self._record(name, time.perf_counter() - started, error=True)
+            raise
+        self.breaker.record_success()
+        self._record(name, time.perf_counter() - started)
+        return result
+
+    def _record(self, name, seconds, error=False):
+        self.latency.record(name, seconds, error)
+        for listener in self.listeners:
+            listener(name, seconds, error)
+
+    # Makes the HTTP call, retrying rate-limited/failed responses with exponential backoff and full jitter
+    def _request_with_retries(self, url, get_params, requests_kwargs, post_json):
+        final_requests_kwargs = dict(self._requests_kwargs, **(requests_kwargs or {}))
+        requests_method = self._session.get
+        if post_json is not None:
+            requests_method = self._session.post
+            final_requests_kwargs['json'] = post_json
+
+        attempt = 0
+        while True:
+            if not self.limiter.acquire(self.rate_wait):
+                raise ORSUnavailable('Over the ORS rate limit')
+
+            try:
+                response = requests_method(self._base_url + self._generate_auth_url(url, get_params),
+                                           **final_requests_kwargs)
+                self._req = response.request
+            except requests.exceptions.Timeout:
+                if attempt >= self.max_retries:
+                    raise exceptions.Timeout()
+                response = None
+            except requests.exceptions.ConnectionError:
+                if attempt >= self.max_retries:
+                    raise
+                response = None
+
+            if response is not None and (response.status_code not in RETRY_STATUSES or attempt >= self.max_retries):
+                return self._get_body(response)
+
+            time.sleep(retry_delay(attempt, response))
+            attempt += 1
+
+
+# Seconds to wait before the next attempt, honouring the server's Retry-After header if it sends one
+def retry_delay(attempt, response):
+    retry_after = response.headers.get('Retry-After') if response is not None else None
+    if retry_after and retry_after.isdigit():
+        return min(int(retry_after), 10)
+    return random.uniform(0, min(0.5 * 2 ** attempt, 8))
+
+
+# Short name for an ORS API path, e.g. '/v2/directions/cycling-road/json' -> 'directions'
+def endpoint_name(url):
+    if '/directions/' in url:
+        return 'directions'
+    if url.startswith('/geocode/search'):
+        return 'pelias_search'
+    return url.strip('/').split('/')[0]
+
+
+# Whether an error means ORS is struggling (and so counts towards tripping the circuit breaker)
+def is_outage(error):
+    if isinstance(error, exceptions.ApiError):
+        return error.status in RETRY_STATUSES
+    return not isinstance(error, exceptions.ValidationError)
@@ -0,0 +1,224 @@
+# Builds the road graph for the local routing backend (see roadgraph.py) from an OpenStreetMap
+# extract, e.g. a county from https://download.geofabrik.de. Run with 'flask build-road-graph'.
+#
+# OSM XML files ('.osm') are read with the standard library. PBF files ('.osm.pbf', far smaller)
+# need the 'osmium' package, which isn't in requirements.txt as only this command uses it.
+#
+# Only roads a road bike may use are kept, each with a speed and a cost factor (how much we'd
+# rather avoid it, as ORS's 'cycling-road' profile does). Ways are split into segments at
+# junctions, which become the graph's vertices, while the points in between are kept as each
+# segment's shape. Finally only the largest connected part of the network is kept, so that a
+# start point never snaps to an isolated stretch of road with nowhere to go.
+
+import xml.etree.ElementTree as ElementTree
+import numpy as np
+from app.geometry import segment_lengths
+from app.roadgraph import COORD_SCALE, grid_key
+
+# highway tag -> (km/h, cost factor)
+HIGHWAYS = {
+    'trunk': (25, 3.0), 'trunk_link': (25, 3.0),
+    'primary': (25, 1.8), 'primary_link': (25, 1.8),
+    'secondary': (25, 1.4), 'secondary_link': (25, 1.4),
+    'tertiary': (25, 1.1), 'tertiary_link': (25, 1.1),
+    'unclassified': (24, 1.0), 'residential': (22, 1.0), 'road': (20, 1.2),
+    'living_street': (12, 1.3), 'service': (15, 1.6), 'cycleway': (22, 1.0),
+}
+# Paths which are only used if cycling is allowed on them (with these speeds and factors)
+CYCLE_PATHS = {'path': (15, 1.5), 'footway': (10, 2.0), 'pedestrian': (10, 2.0), 'bridleway': (12, 2.0),
+               'track': (14, 2.5)}
+PAVED = {'asphalt', 'paved', 'concrete', 'paving_stones', 'sett', 'chipseal', 'metal', 'wood'}
+CYCLING_ALLOWED = {'yes', 'designated', 'permissive', 'destination'}
+
+
+# Whether cycling is allowed on a way, and if so, its (km/h, cost factor, forwards, backwards)
+def way_profile(tags):
+    highway = tags.get('highway')
+    bicycle = tags.get('bicycle')
+    if bicycle in ('no', 'dismount') or tags.get('area') == 'yes':
+        return None
+    if tags.get('access') in ('no', 'private') and bicycle not in CYCLING_ALLOWED:
+        return None
+    if highway in HIGHWAYS:
+        speed, factor = HIGHWAYS[highway]
+    elif highway in CYCLE_PATHS and (bicycle in CYCLING_ALLOWED or highway == 'track'):
+        if highway == 'track' and tags.get('surface') not in PAVED:
+            return None  # Not for a road bike
+        speed, factor = CYCLE_PATHS[highway]
+    else:
+        return None
+
+    oneway = tags.get('oneway', 'yes' if tags.get('junction') == 'roundabout' else 'no')
+    forwards, backwards = oneway != '-1', oneway not in ('yes', 'true', '1')
+    if tags.get('oneway:bicycle') == 'no' or tags.get('cycleway', '').startswith('opposite'):
+        forwards = backwards = True
+    return speed, factor, forwards, backwards
+
+
+# Reads the cyclable ways from an OSM XML file, in two passes: the ways first, then only the
+# nodes they use. Returns (ways, coordinates) where each way is (node ids, profile) and
+# coordinates maps node id -> (longitude, latitude).
+def read_osm_xml(path):
+    ways = []
+    needed = set()
+    for _, element in ElementTree.iterparse(path):
+        if element.tag == 'way':
+            profile = way_profile({tag.get('k'): tag.get('v') for tag in element.iter('tag')})
+            refs = [int(nd.get('ref')) for nd in element.iter('nd')]
+            if profile and len(refs) > 1:
+                ways.append((refs, profile))
+                needed.update(refs)
+        if element.tag in ('node', 'way', 'relation'):
+            element.clear()  # Keep memory use down on large files
+
+    coordinates = {}
+    for _, element in ElementTree.iterparse(path):
+        if element.tag == 'node':
+            node_id = int(element.get('id'))
+            if node_id in needed:
+                coordinates[node_id] = (float(element.get('lon')), float(element.get('lat')))
+        if element.tag in ('node', 'way', 'relation'):
+            element.clear()
+    return ways, coordinates
+
+
+# As read_osm_xml, for a PBF file (which needs the 'osmium' package)
+def read_osm_pbf(path):
+    try:
+        import osmium
+    except ImportError:
+        raise ValueError("Reading .osm.pbf files needs the 'osmium' package (pip install osmium), "
+                         "or convert the extract to OSM XML first")
+
+    class WayReader(osmium.SimpleHandler):
+        def __init__(self):
+            super(WayReader, self).__init__()
+            self.ways = []
+            self.coordinates = {}
+
+        def way(self, way):
+            profile = way_profile({tag.k: tag.v for tag in way.tags})
+            if not profile or len(way.nodes) < 2:
+                return
+            refs = []
+            for node in way.nodes:
+                if not node.location.valid():  # Node missing from the extract, so stop the way here
+                    break
+                refs.append(node.ref)
+                self.coordinates[node.ref] = (node.location.lon, node.location.lat)
+            if len(refs) > 1:
+                self.ways.append((refs, profile))
+
+    reader = WayReader()
+    reader.apply_file(path, locations=True)
+    return reader.ways, reader.coordinates
+
+
+def read_osm(path):
+    if path.endswith('.pbf'):
+        return read_osm_pbf(path)
+    return read_osm_xml(path)
+
+
+# Turns ways into arrays in the format described in roadgraph.py
+def build_graph(ways, coordinates):
+    # Junctions (nodes used more than once) and the ends of ways become vertices
+    uses = {}
+    for refs, _ in ways:
+        refs[:] = [ref for ref in refs if ref in coordinates]  # Drop nodes missing from the extract
+        for ref in refs:
+            uses[ref] = uses.get(ref, 0) + 1
+    vertex_ids = {}
+    for refs, _ in ways:
+        if len(refs) < 2:
+            continue
+        for i, ref in enumerate(refs):
+            if (i == 0 or i == len(refs) - 1 or uses[ref] > 1) and ref not in vertex_ids:
+                vertex_ids[ref] = len(vertex_ids)
+
+    # Split each way into segments between vertices, with an edge for each direction allowed
+    shapes, sources, targets, lengths, costs, durations, edge_segments = [], [], [], [], [], [], []
+    for refs, (speed, factor, forwards, backwards) in ways:
+        start = 0
+        for i in range(1, len(refs)):
+            if refs[i] not in vertex_ids:
+                continue
+            shape = np.array([coordinates[ref] for ref in refs[start:i + 1]])
+            u, v = vertex_ids[refs[start]], vertex_ids[refs[i]]
+            start = i
+            if u == v:  # A loop back to the same junction is never the shortest way anywhere
+                continue
+            length = float(segment_lengths(shape).sum()) * 1000
+            segment = len(shapes)
+            shapes.append(shape)
+            for allowed, source, target, backwards_flag in ((forwards, u, v, 0), (backwards, v, u, 1)):
+                if allowed:
+                    sources.append(source)
+                    targets.append(target)
+                    lengths.append(length)
+                    costs.append(length * factor)
+                    durations.append(length / (speed / 3.6))
+                    edge_segments.append(segment * 2 + backwards_flag)
+
+    sources, targets = np.array(sources, dtype=np.int64), np.array(targets, dtype=np.int64)
+    vertex_coords = np.empty((len(vertex_ids), 2))
+    for ref, index in vertex_ids.items():
+        vertex_coords[index] = coordinates[ref]
+
+    # Keep only the largest connected part of the network, renumbering its vertices from 0
+    keep = largest_component(len(vertex_ids), sources, targets)
+    new_index = np.full(len(vertex_ids), -1, dtype=np.int64)
+    new_index[keep] = np.arange(keep.sum())
+    kept_edges = keep[sources]
+    sources, targets = new_index[sources[kept_edges]], new_index[targets[kept_edges]]
+    vertex_coords = vertex_coords[keep]
+
+    # Order the edges by the vertex they leave from (compressed sparse row format)
+    order = np.argsort(sources, kind='stable')
+    offsets = np.zeros(len(vertex_coords) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=len(vertex_coords)), out=offsets[1:])
+
+    # Keep the shapes of the segments still used, renumbered in order
+    edge_segments = np.array(edge_segments, dtype=np.int64)[kept_edges][order]
+    used_segments, remapped = np.unique(edge_segments // 2, return_inverse=True)
+    edge_segments = remapped * 2 + edge_segments % 2
+    shape_sizes = np.array([len(shapes[s]) for s in used_segments], dtype=np.int64)
+    segment_offsets = np.zeros(len(used_segments) + 1, dtype=np.int64)
+    np.cumsum(shape_sizes, out=segment_offsets[1:])
+    shape_points = np.concatenate([shapes[s] for s in used_segments]) if len(used_segments) else np.empty((0, 2))
+
+    keys = grid_key(vertex_coords[:, 0], vertex_coords[:, 1])
+    grid_order = np.argsort(keys, kind='stable')
+    return {
+        'vertex_lon': vertex_coords[:, 0].copy(), 'vertex_lat': vertex_coords[:, 1].copy(),
+        'offsets': offsets,
+        'targets': targets[order].astype(np.int32),
+        'lengths': np.array(lengths, dtype=np.float32)[kept_edges][order],
+        'costs': np.array(costs, dtype=np.float32)[kept_edges][order],
+        'durations': np.array(durations, dtype=np.float32)[kept_edges][order],
+        'edge_segments': edge_segments.astype(np.int32),
+        'segment_offsets': segment_offsets,
+        'shape_lon': np.round(shape_points[:, 0] * COORD_SCALE).astype(np.int32),
+        'shape_lat': np.round(shape_points[:, 1] * COORD_SCALE).astype(np.int32),
+        'grid_keys': keys[grid_order], 'grid_vertices': grid_order.astype(np.int64),
+    }
+
+
+# Boolean array marking the vertices in the largest connected part of the network (ignoring one-way restrictions)
+def largest_component(vertex_count, sources, targets):
+    parent = list(range(vertex_count))
+
+    def root(vertex):
+        while parent[vertex] != vertex:
+            parent[vertex] = parent[parent[vertex]]  # Shorten the path as we go
+            vertex = parent[vertex]
+        return vertex
+
+    for u, v in zip(sources.tolist(), targets.tolist()):
+        ru, rv = root(u), root(v)
+        if ru != rv:
+            parent[ru] = rv
+    roots = np.array([root(vertex) for vertex in range(vertex_count)], dtype=np.int64)
+    if not vertex_count:
+        return np.zeros(0, dtype=bool)
+    return roots == np.bincount(roots).argmax()
@@ -0,0 +1,227 @@
+# Local index of UK postcodes and place names, so that most location searches (and the
+# suggestions shown while typing one) are answered without calling ORS.
+#
+# Built offline with 'flask build-place-index' from open data CSV files, e.g. the ONS Postcode
+# Directory or Code-Point Open (converted to latitude/longitude) for postcodes, and a gazetteer
+# such as OS Open Names for places. The index is a set of arrays (see arrayfiles.py), sorted by
+# key, so that every entry starting with some text is a contiguous run found by binary search:
+#   postcode_keys               bytes [postcodes]   e.g. b'B152TT' (without the space, so 'B152' matches it)
+#   postcode_lon, postcode_lat  float64 [postcodes]
+#   place_keys                  bytes [places]      upper case words, e.g. b'SELLY OAK'
+#   place_labels                bytes [places]      UTF-8 name to show, e.g. b'Selly Oak, Birmingham'
+#   place_lon, place_lat        float64 [places]
+#   place_rank                  int64 [places]      e.g. population, so bigger places are suggested first
+#   label_keys                  bytes [labelled]    the keys of labels with an area, e.g. b'SELLY OAK BIRMINGHAM',
+#   label_places                int64 [labelled]    and each one's position in the place arrays, so that a
+#                                                   suggestion chosen from the list is found again by 'lookup'
+
+import csv
+import os
+import re
+import threading
+import numpy as np
+from app.arrayfiles import load_arrays
+from config import Config
+
+ARRAYS = ('postcode_keys', 'postcode_lon', 'postcode_lat', 'place_keys', 'place_labels', 'place_lon', 'place_lat',
+          'place_rank', 'label_keys', 'label_places')
+MAX_RANKED = 5000  # Places starting with a prefix to sort by rank; beyond this, the first alphabetically are used
+
+# Column names recognised in the CSV files, in order of preference
+POSTCODE_COLUMNS = ('pcds', 'pcd', 'postcode')
+NAME_COLUMNS = ('name', 'name1', 'place')
+AREA_COLUMNS = ('area', 'district', 'county_unitary', 'county', 'region')
+LATITUDE_COLUMNS = ('lat', 'latitude')
+LONGITUDE_COLUMNS = ('long', 'lon', 'lng', 'longitude')
+RANK_COLUMNS = ('rank', 'population')
+
+uk_postcode = re.compile(r'^[A-Z]{1,2}[0-9][A-Z0-9]?[0-9][A-Z]{2}$')
+not_word = re.compile(r'[^\w]+')
+
+_index = None
+_index_lock = threading.Lock()
+
+
+# Key for a postcode, or the start of one: upper case with no spaces
+def postcode_key(text):
+    return ''.join(text.upper().split())
+
+
+# Key for a place name: upper case words, with punctuation removed (so 'St. Albans' is 'ST ALBANS')
+def place_key(text):
+    return ' '.join(not_word.sub(' ', text.upper()).split())
+
+
+# Formats a postcode key with its standard spacing, e.g. 'B15 2TT'
+def format_postcode(key):
+    return '{} {}'.format(key[:-3], key[-3:])
+
+
+class PlaceIndex(object):
+
+    def __init__(self, path):
+        arrays = load_arrays(path, ARRAYS)
+        self.postcode_keys, self.postcode_lon, self.postcode_lat = (
+            arrays['postcode_keys'], arrays['postcode_lon'], arrays['postcode_lat'])
+        self.place_keys, self.place_labels = arrays['place_keys'], arrays['place_labels']
+        self.place_lon, self.place_lat, self.place_rank = arrays['place_lon'], arrays['place_lat'], arrays['place_rank']
+        self.label_keys, self.label_places = arrays['label_keys'], arrays['label_places']
+
+    # The range of positions in 'keys' of the entries starting with 'prefix'
+    @staticmethod
+    def _range(keys, prefix):
+        prefix = prefix.encode('utf-8')
+        if len(prefix) > keys.dtype.itemsize:  # Longer than any key, so can't match
+            return 0, 0
+        first = int(np.searchsorted(keys, prefix))
+        last = int(np.searchsorted(keys, prefix + b'\xff'))  # 0xff never appears in UTF-8
+        return first, last
+
+    # The positions in 'keys' of the entries equal to 'key'
+    def _matches(self, keys, key):
+        first, last = self._range(keys, key)
+        return [i for i in range(first, last) if keys[i] == key.encode('utf-8')]
+
+    # Looks up a whole postcode or place name (or a place's label, as suggested by 'suggest'),
+    # returning (True, [longitude, latitude], name) like 'ors_lookup' in datafeeds.py, or None if
+    # it isn't in the index. Of several places with the same name, the highest ranked is used.
+    def lookup(self, text):
+        key = postcode_key(text)
+        if uk_postcode.match(key):
+            first, last = self._range(self.postcode_keys, key)
+            if first < last and self.postcode_keys[first] == key.encode('utf-8'):
+                return True, [float(self.postcode_lon[first]), float(self.postcode_lat[first])], format_postcode(key)
+            return None
+
+        key = place_key(text)
+        if not key:
+            return None
+        matches = self._matches(self.place_keys, key) or \
+            [int(self.label_places[i]) for i in self._matches(self.label_keys, key)]
+        if not matches:
+            return None
+        best = max(matches, key=lambda i: self.place_rank[i])
+        return True, [float(self.place_lon[best]), float(self.place_lat[best])], self.place_labels[best].decode('utf-8')
+
+    # Up to 'limit' places and postcodes starting with 'text', as dicts for the autocomplete API.
+    # Places come first, largest first; postcodes follow in order.
+    def suggest(self, text, limit=10):
+        results = []
+        key = place_key(text)
+        if key:
+            first, last = self._range(self.place_keys, key)
+            if last - first > MAX_RANKED:
+                positions = np.arange(first, first + limit)
+            else:
+                ranks = np.asarray(self.place_rank[first:last])
+                positions = first + np.argsort(-ranks, kind='stable')[:limit]
+            results += [{'label': self.place_labels[i].decode('utf-8'), 'kind': 'place',
+                         'longitude': float(self.place_lon[i]), 'latitude': float(self.place_lat[i])}
+                        for i in positions]
+
+        key = postcode_key(text)
+        if len(results) < limit and len(key) >= 2 and key[0].isalpha() and any(c.isdigit() for c in key):
+            first, last = self._range(self.postcode_keys, key)
+            results += [{'label': format_postcode(self.postcode_keys[i].decode('ascii')), 'kind': 'postcode',
+                         'longitude': float(self.postcode_lon[i]), 'latitude': float(self.postcode_lat[i])}
+                        for i in range(first, min(last, first + limit - len(results)))]
+        return results
+
+
+# The index at PLACE_INDEX, opened on first use, or None if it hasn't been built
+def place_index():
+    global _index
+    if _index is None and os.path.isdir(Config.PLACE_INDEX):
+        with _index_lock:
+            if _index is None:
+                _index = PlaceIndex(Config.PLACE_INDEX)
+    return _index
+
+
+# Returns the position in 'header' of the first of 'names' present (ignoring case), or None
+def find_column(header, names, required=True, filename=''):
+    lowered = [column.strip().lower() for column in header]
+    for name in names:
+        if name in lowered:
+            return lowered.index(name)
+    if required:
+        raise ValueError("{} has none of the columns: {}".format(filename, ', '.join(names)))
+    return None
+
+
+# Reads a CSV of postcodes, returning (keys, longitudes, latitudes) for those with a location
+def read_postcodes(path):
+    keys, longitudes, latitudes = [], [], []
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        rows = csv.reader(f)
+        header = next(rows)
+        postcode = find_column(header, POSTCODE_COLUMNS, filename=path)
+        latitude = find_column(header, LATITUDE_COLUMNS, filename=path)
+        longitude = find_column(header, LONGITUDE_COLUMNS, filename=path)
+        for row in rows:
+            try:
+                key, lat, lng = postcode_key(row[postcode]), float(row[latitude]), float(row[longitude])
+            except (IndexError, ValueError):
+                continue
+            if uk_postcode.match(key) and -90 <= lat <= 90:  # The ONS directory marks unknown locations as 99.999999
+                keys.append(key)
+                longitudes.append(lng)
+                latitudes.append(lat)
+    return keys, longitudes, latitudes
+
+
+# Reads a CSV of places, returning (keys, labels, longitudes, latitudes, ranks)
+def read_places(path):
+    keys, labels, longitudes, latitudes, ranks = [], [], [], [], []
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        rows = csv.reader(f)
+        header = next(rows)
+        name = find_column(header, NAME_COLUMNS, filename=path)
+        latitude = find_column(header, LATITUDE_COLUMNS, filename=path)
+        longitude = find_column(header, LONGITUDE_COLUMNS, filename=path)
+        area = find_column(header, AREA_COLUMNS, required=False)
+        rank = find_column(header, RANK_COLUMNS, required=False)
+        for row in rows:
+            try:
+                label, lat, lng = row[name].strip(), float(row[latitude]), float(row[longitude])
+                place_rank = int(float(row[rank] or 0)) if rank is not None else 0
+            except (IndexError, ValueError):
+                continue
+            if not place_key(label):
+                continue
+            if area is not None and row[area].strip() and row[area].strip() != label:
+                label = '{}, {}'.format(label, row[area].strip())
+            keys.append(place_key(row[name]))
+            labels.append(label)
+            longitudes.append(lng)
+            latitudes.append(lat)
+            ranks.append(place_rank)
+    return keys, labels, longitudes, latitudes, ranks
+
+
+# Builds the index's arrays from the postcode and place CSV files (either may be None)
+def build_index(postcode_files=(), place_files=()):
+    postcodes = {}  # Maps key -> (longitude, latitude); later files replace earlier ones
+    for path in postcode_files:
+        keys, longitudes, latitudes = read_postcodes(path)
+        postcodes.update(zip(keys, zip(longitudes, latitudes)))
+    places = []
+    for path in place_files:
+        places += zip(*read_places(path))
+
+    postcode_keys = sorted(postcodes)
+    places.sort(key=lambda place: (place[0].encode('utf-8'), -place[4]))  # Byte order, as searched
+    labels = sorted((place_key(place[1]).encode('utf-8'), i) for i, place in enumerate(places)
+                    if place_key(place[1]) != place[0])
+    return {
+        'postcode_keys': np.array([key.encode('ascii') for key in postcode_keys], dtype=bytes),
+        'postcode_lon': np.array([postcodes[key][0] for key in postcode_keys], dtype=np.float64),
+        'postcode_lat': np.array([postcodes[key][1] for key in postcode_keys], dtype=np.float64),
+        'place_keys': np.array([place[0].encode('utf-8') for place in places], dtype=bytes),
+        'place_labels': np.array([place[1].encode('utf-8') for place in places], dtype=bytes),
+        'place_lon': np.array([place[2] for place in places], dtype=np.float64),
+        'place_lat': np.array([place[3] for place in places], dtype=np.float64),
+        'place_rank': np.array([place[4] for place in places], dtype=np.int64),
+        'label_keys': np.array([label[0] for label in labels], dtype=bytes),
+        'label_places': np.array([label[1] for label in labels], dtype=np.int64),
+    }
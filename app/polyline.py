@@ -0,0 +1,110 @@
+# Fast encoding and decoding of route geometry.
+#
+# ORS describes routes as encoded polylines: strings of variable-length integers (5 bits per
+# character), holding the change in latitude and longitude (in units of 1e-5 degrees) from one
+# point to the next. Rather than walking the string character by character in Python, we decode
+# every character at once with NumPy, and return the coordinates as a compact (n, 2) array of
+# [longitude, latitude] rows.
+#
+# In the DB, routes are stored in a similar but more compact binary form: the same changes in
+# coordinates, as variable-length integers of 7 bits per byte, compressed with zlib.
+#
+# Format reference: https://developers.google.com/maps/documentation/utilities/polylinealgorithm
+
+import zlib
+import numpy as np
+
+PACKED_FORMAT = b'\x01'  # First byte of packed geometry, so the format can be changed in future
+
+
+# Splits each non-negative integer into 'bits'-sized pieces, least significant first. Returns the
+# pieces, and whether each one is the last piece of its integer.
+def _split_varints(values, bits):
+    pieces_per_value = np.ones(len(values), dtype=np.int64)
+    for size in range(1, 64 // bits + 1):
+        pieces_per_value += values >= (1 << (bits * size))
+    value_index = np.repeat(np.arange(len(values)), pieces_per_value)
+    first_piece = np.repeat(np.cumsum(pieces_per_value) - pieces_per_value, pieces_per_value)
+    position = np.arange(len(value_index)) - first_piece
+    pieces = (values[value_index] >> (bits * position)) & ((1 << bits) - 1)
+    return pieces, position == pieces_per_value[value_index] - 1
+
+
+# Joins 'bits'-sized pieces back into integers, given which pieces are the last of each integer
+def _join_varints(pieces, is_last, bits):
+    starts = np.flatnonzero(np.concatenate(([True], is_last[:-1])))  # Index of the first piece of each value
+    position = np.arange(len(pieces)) - np.repeat(starts, np.diff(np.append(starts, len(pieces))))
+    return np.add.reduceat(pieces << (bits * position), starts)
+
+
+# Converts (n, 2) coordinates to the change from each point to the next, in units of 1e-5 degrees
+def _coordinate_deltas(coords):
+    ints = np.round(np.asarray(coords, dtype=np.float64) * 1e5).astype(np.int64)
+    return np.diff(ints, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel()
+
+
+# Decodes an encoded polyline into an (n, 2) NumPy array of [longitude, latitude] pairs. Gives the
+# same coordinates as the ORS library's 'convert.decode_polyline', in a fraction of the time.
+def decode_polyline(encoded_polyline):
+    chunks = np.frombuffer(encoded_polyline.encode('ascii'), dtype=np.uint8).astype(np.int64) - 63
+    if len(chunks) == 0:
+        return np.empty((0, 2))
+
+    is_last = chunks < 0x20  # Characters without the 'continue' bit end a value
+    if not is_last[-1] or np.count_nonzero(is_last) % 2:
+        raise ValueError('Invalid polyline: does not contain complete pairs of values')
+
+    values = _join_varints(chunks & 0x1f, is_last, 5)
+    deltas = np.where(values & 1, ~(values >> 1), values >> 1)  # Undo the zig-zag sign encoding
+    lat_lng = np.cumsum(deltas.reshape(-1, 2), axis=0)  # Values alternate latitude, longitude
+    return lat_lng[:, ::-1] / 1e5  # Swap to [longitude, latitude], as used by GeoJSON and the rest of the app
+
+
+# Encodes (n, 2) [longitude, latitude] coordinates as a polyline string, the reverse of decode_polyline
+def encode_polyline(coords):
+    if len(coords) == 0:
+        return ''
+    deltas = _coordinate_deltas(np.asarray(coords)[:, ::-1])  # Polylines hold latitude first
+    values = np.where(deltas < 0, ~(deltas << 1), deltas << 1)
+    pieces, is_last = _split_varints(values, 5)
+    chunks = pieces + np.where(is_last, 0, 0x20) + 63
+    return chunks.astype(np.uint8).tobytes().decode('ascii')
+
+
+# Packs (n, 2) [longitude, latitude] coordinates into compressed bytes, for storing in the DB
+def pack_coords(coords):
+    deltas = _coordinate_deltas(coords) if len(coords) else np.empty(0, dtype=np.int64)
+    values = (deltas << 1) ^ (deltas >> 63)  # Zig-zag, so small negative numbers stay small
+    pieces, is_last = _split_varints(values, 7)
+    data = (pieces | np.where(is_last, 0, 0x80)).astype(np.uint8).tobytes()
+    return PACKED_FORMAT + zlib.compress(data)
+
+
+# Unpacks bytes made by pack_coords back into an (n, 2) array of [longitude, latitude] coordinates
+def unpack_coords(packed):
+    if packed[:1] != PACKED_FORMAT:
+        raise ValueError('Unknown packed geometry format')
+    data = np.frombuffer(zlib.decompress(packed[1:]), dtype=np.uint8).astype(np.int64)
+    if len(data) == 0:
+        return np.empty((0, 2))
+
+    values = _join_varints(data & 0x7f, data < 0x80, 7)
+    deltas = (values >> 1) ^ -(values & 1)
+    return np.cumsum(deltas.reshape(-1, 2), axis=0) / 1e5
+
+
+# Decodes only the first point of an encoded polyline, as [longitude, latitude]. Much cheaper than
+# decoding the whole route when all we need is where it starts (e.g. to place a map marker).
+def decode_start(encoded_polyline):
+    values = []
+    value = shift = 0
+    for char in encoded_polyline:
+        chunk = ord(char) - 63
+        value |= (chunk & 0x1f) << shift
+        shift += 5
+        if chunk < 0x20:  # Last character of this value
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            if len(values) == 2:
+                return [values[1] / 1e5, values[0] / 1e5]
+            value = shift = 0
+    raise ValueError('Invalid polyline: fewer than two values')
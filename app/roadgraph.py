@@ -0,0 +1,216 @@
+# The local routing backend: plans circular routes on a road graph built from an OpenStreetMap
+# extract (see osmimport.py), in this process, instead of asking the ORS API. Chosen with
+# ROUTING_BACKEND=local; ORS remains the default.
+#
+# The graph is a directory of NumPy arrays, opened memory-mapped (see arrayfiles.py) so that every
+# gunicorn worker on a machine shares one copy:
+#   vertex_lon, vertex_lat      float64 [vertices]   junctions and dead ends, in degrees
+#   offsets                     int64 [vertices + 1] the edges leaving vertex v are offsets[v]:offsets[v + 1]
+#   targets                     int32 [edges]        vertex each edge leads to
+#   lengths                     float32 [edges]      metres
+#   costs                       float32 [edges]      metres, scaled up for roads less pleasant to cycle on
+#   durations                   float32 [edges]      seconds
+#   edge_segments               int32 [edges]        segment * 2, plus 1 if the edge runs against its shape
+#   segment_offsets             int64 [segments + 1] shape points of segment s are segment_offsets[s]:[s + 1]
+#   shape_lon, shape_lat        int32 [points]       degrees * 1e7 (as OSM stores them)
+#   grid_keys, grid_vertices    int64 [vertices]     vertices sorted by grid cell, to find the nearest
+#
+# Shortest paths use A* with the straight-line distance as its estimate. A round trip is made,
+# much as ORS does, by placing waypoints on a circle through the start (its size set by the
+# requested length, its direction by the seed) and routing between them in turn, with roads
+# already used made more costly, so the route doesn't come back the way it went out.
+
+import math
+import os
+import random
+import threading
+from heapq import heappush, heappop
+import numpy as np
+from app.arrayfiles import load_arrays
+from app.geometry import EARTH_RADIUS
+from config import Config
+
+GRID_SIZE = 0.01  # Degrees per grid cell, roughly 1 km
+COORD_SCALE = 1e7  # Shape points are stored as integer degrees * COORD_SCALE
+REUSE_PENALTY = 4  # Cost multiplier for roads already used by an earlier leg of a round trip
+ROUND_TRIP_POINTS = 3  # Waypoints on the circle, as well as the start
+CIRCUITY = 1.3  # Typical road distance / straight line distance, to size the circle
+MAX_SNAP = 2000  # Metres from a point to the nearest vertex before we say the graph doesn't cover it
+
+ARRAYS = ('vertex_lon', 'vertex_lat', 'offsets', 'targets', 'lengths', 'costs', 'durations', 'edge_segments',
+          'segment_offsets', 'shape_lon', 'shape_lat', 'grid_keys', 'grid_vertices')
+
+_graph = None
+_graph_lock = threading.Lock()
+
+
+# Raised when a route can't be planned on the graph, e.g. the start is outside the area it covers
+class NoRouteFound(Exception):
+    pass
+
+
+# Grid cell key for each of the given coordinates (NumPy arrays, or plain numbers)
+def grid_key(longitude, latitude):
+    row = np.floor(np.asarray(latitude) / GRID_SIZE).astype(np.int64) + 100000
+    column = np.floor(np.asarray(longitude) / GRID_SIZE).astype(np.int64) + 100000
+    return row * 1000000 + column
+
+
+class RoadGraph(object):
+
+    def __init__(self, path):
+        self.path = path
+        arrays = self.arrays = load_arrays(path, ARRAYS)
+        self.vertex_lon, self.vertex_lat = arrays['vertex_lon'], arrays['vertex_lat']
+        self.grid_keys, self.grid_vertices = arrays['grid_keys'], arrays['grid_vertices']
+        self.edge_segments, self.segment_offsets = arrays['edge_segments'], arrays['segment_offsets']
+        self.shape_lon, self.shape_lat = arrays['shape_lon'], arrays['shape_lat']
+
+        # Memoryviews of the arrays used in the search loop, which read single values much faster than NumPy
+        self._offsets = memoryview(arrays['offsets'])
+        self._targets = memoryview(arrays['targets'])
+        self._costs = memoryview(arrays['costs'])
+        self._segments = memoryview(arrays['edge_segments'])
+        self._lon = memoryview(self.vertex_lon)
+        self._lat = memoryview(self.vertex_lat)
+
+    @property
+    def vertex_count(self):
+        return len(self.vertex_lon)
+
+    @property
+    def edge_count(self):
+        return len(self._targets)
+
+    # The vertex nearest to a point, searching the point's grid cell and those around it
+    def nearest_vertex(self, longitude, latitude):
+        row_keys = grid_key(longitude, latitude) + np.array([-1000000, 0, 1000000])
+        candidates = []
+        for key in row_keys:  # Each row of three cells is a contiguous run of keys
+            first, last = np.searchsorted(self.grid_keys, [key - 1, key + 2])
+            candidates.append(self.grid_vertices[first:last])
+        candidates = np.concatenate(candidates)
+        if not len(candidates):
+            raise NoRouteFound('No roads near {:.5f}, {:.5f}'.format(longitude, latitude))
+
+        x = (self.vertex_lon[candidates] - longitude) * math.cos(math.radians(latitude))
+        y = self.vertex_lat[candidates] - latitude
+        nearest = np.argmin(x * x + y * y)
+        if math.radians(math.hypot(x[nearest], y[nearest])) * EARTH_RADIUS * 1000 > MAX_SNAP:
+            raise NoRouteFound('No roads near {:.5f}, {:.5f}'.format(longitude, latitude))
+        return int(candidates[nearest])
+
+    # Cheapest path between two vertices, as a list of edges. Edges on segments in 'used' cost
+    # REUSE_PENALTY times as much. Raises NoRouteFound if the target can't be reached.
+    def shortest_path(self, source, target, used=()):
+        offsets, targets, costs, segments = self._offsets, self._targets, self._costs, self._segments
+        lon, lat = self._lon, self._lat
+        target_lon, target_lat = lon[target], lat[target]
+        x_scale = math.cos(math.radians(target_lat))
+        metres_per_degree = math.radians(1) * EARTH_RADIUS * 1000 * 0.99  # Slightly low, so never overestimates
+
+        def estimate(vertex):
+            return metres_per_degree * math.hypot((lon[vertex] - target_lon) * x_scale, lat[vertex] - target_lat)
+
+        best = {source: 0.0}
+        previous = {}  # Maps vertex -> edge it was reached by
+        queue = [(estimate(source), 0.0, source)]
+        while queue:
+            _, cost, vertex = heappop(queue)
+            if vertex == target:
+                break
+            if cost > best[vertex]:  # Already reached more cheaply
+                continue
+            for edge in range(offsets[vertex], offsets[vertex + 1]):
+                step = costs[edge]
+                if used and segments[edge] >> 1 in used:
+                    step *= REUSE_PENALTY
+                neighbour = targets[edge]
+                new_cost = cost + step
+                if new_cost < best.get(neighbour, math.inf):
+                    best[neighbour] = new_cost
+                    previous[neighbour] = edge
+                    heappush(queue, (new_cost + estimate(neighbour), new_cost, neighbour))
+        else:
+            raise NoRouteFound('No route between vertices {} and {}'.format(source, target))
+
+        edges = []
+        vertex = target
+        while vertex != source:
+            edge = previous[vertex]
+            edges.append(edge)
+            vertex = self.edge_source(edge)
+        edges.reverse()
+        return edges
+
+    # The vertex an edge leaves from (the one whose range of 'offsets' contains it)
+    def edge_source(self, edge):
+        return int(np.searchsorted(self.arrays['offsets'], edge, side='right')) - 1
+
+    # Coordinates along a path of edges, as an (n, 2) array of [longitude, latitude] rows
+    def path_coords(self, edges):
+        parts = []
+        for i, edge in enumerate(edges):
+            segment, backwards = divmod(int(self.edge_segments[edge]), 2)
+            first, last = self.segment_offsets[segment], self.segment_offsets[segment + 1]
+            points = np.column_stack((self.shape_lon[first:last], self.shape_lat[first:last]))
+            if backwards:
+                points = points[::-1]
+            parts.append(points if i == 0 else points[1:])  # Each edge starts where the last one finished
+        return np.concatenate(parts) / COORD_SCALE
+
+    # Plans a circular route of roughly 'length' metres from 'start_coords', in a direction chosen
+    # by 'seed'. Returns its coordinates, length (metres) and duration (seconds).
+    def round_trip(self, start_coords, length, seed=0):
+        rng = random.Random(seed)
+        heading = rng.uniform(0, 2 * math.pi)  # Direction of the circle's centre from the start
+        sides = ROUND_TRIP_POINTS + 1
+        radius = length / CIRCUITY / (2 * sides * math.sin(math.pi / sides))  # Polygon's perimeter is the length
+        centre = offset_point(start_coords, heading, radius)
+        waypoints = [offset_point(centre, heading + math.pi + 2 * math.pi * i / sides, radius)
+                     for i in range(1, sides)]
+
+        start = self.nearest_vertex(*start_coords)
+        stops = [start]
+        for waypoint in waypoints:
+            try:
+                stops.append(self.nearest_vertex(*waypoint))
+            except NoRouteFound:  # e.g. out at sea, so skip it and head for the next one
+                continue
+        stops.append(start)
+
+        edges, used = [], set()
+        for source, target in zip(stops, stops[1:]):
+            if source == target:
+                continue
+            leg = self.shortest_path(source, target, used)
+            edges.extend(leg)
+            used.update(int(self.edge_segments[edge]) >> 1 for edge in leg)
+        if not edges:
+            raise NoRouteFound('No roads to make a round trip from {}, {}'.format(*start_coords))
+
+        edges = np.array(edges)
+        distance = float(self.arrays['lengths'][edges].sum())
+        duration = float(self.arrays['durations'][edges].sum())
+        return self.path_coords(edges), distance, duration
+
+
+# The point 'metres' from 'coords' ([longitude, latitude]) in the direction 'bearing' (radians from north)
+def offset_point(coords, bearing, metres):
+    latitude = coords[1] + math.degrees(metres * math.cos(bearing) / (EARTH_RADIUS * 1000))
+    longitude = coords[0] + math.degrees(metres * math.sin(bearing) / (EARTH_RADIUS * 1000 *
+                                                                       math.cos(math.radians(coords[1]))))
+    return longitude, latitude
+
+
+# The graph at ROUTING_GRAPH, opened on first use
+def road_graph():
+    global _graph
+    if _graph is None:
+        with _graph_lock:
+            if _graph is None:
+                if not os.path.isdir(Config.ROUTING_GRAPH):
+                    raise NoRouteFound("No road graph at '{}' (build one with 'flask build-road-graph')".format(
+                        Config.ROUTING_GRAPH))
+                _graph = RoadGraph(Config.ROUTING_GRAPH)
+    return _graph
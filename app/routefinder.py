@@ -5,34 +5,175 @@
 # ORS library can be found here: https://github.com/GIScience/openrouteservice-py
 
 import json
-from random import randint
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError
+from random import randint, sample
+from app.calibration import calibrator
 from app.datafeeds import ors
+from app.geometry import route_stats
 from app.models import Route
+from app.polyline import decode_polyline, pack_coords
+from app.roadgraph import NoRouteFound, road_graph
+from config import Config
 from openrouteservice.directions import directions
 
+# Shared, bounded set of threads for asking ORS for several candidate routes at once
+candidate_executor = ThreadPoolExecutor(max_workers=Config.ROUTE_CANDIDATE_THREADS,
+                                        thread_name_prefix='route-candidate')
+
 
 # Takes input of the user's start location and desired route distance, and converts
 # these into the format required by the ORS API. Then builds the API query and calls
 # the API (using the ORS library). The API result is parsed into a more useful format
 # for our purposes - which we do by creating a new Route object and returning that.
-def ors_roundroute(start_coords, km_distance):
-    start_coords = [list(start_coords)]  # ORS requires 2D array, so converting coordinates into list
-    metre_distance = int(km_distance) * 1000  # ORS requires distance in metres, so convert that here
-    seed = randint(0, 5000)  # Seed value passed to ORS to randomise the route
+# The length asked of ORS is adjusted by what we have learned of how far off its routes come back
+# near this start (see calibration.py), and the result is fed back in to learn from.
+def ors_roundroute(start_coords, km_distance, seed=None):
+    target = int(km_distance) * 1000  # ORS requires distance in metres, so convert that here
+    requested = calibrator.requested_length(start_coords, target)
+    if seed is None:
+        seed = randint(0, 5000)  # Seed value passed to ORS to randomise the route
 
-    circular_params = {"round_trip": {"length": metre_distance, "seed": seed}}  # Params dict to pass with ORS API call
+    circular_params = {"round_trip": {"length": requested, "seed": seed}}  # Params dict to pass with ORS API call
 
     # Use ORS to create a circular route, and store the API response as 'route' for now
-    route = directions(client=ors, coordinates=start_coords, profile='cycling-road', options=circular_params,
+    # (ORS requires a 2D array of coordinates, so the start is put in a list)
+    route = directions(client=ors, coordinates=[list(start_coords)], profile='cycling-road', options=circular_params,
                        instructions='true', instructions_format='html', geometry='true')
 
     # Parse the API response into the components we require to store the route
     distance = route['routes'][0]['summary']['distance']
     duration = route['routes'][0]['summary']['duration']
-    bbox = json.dumps(route.get('bbox'))
-    geometry = route['routes'][0]['geometry']
+    bbox = route.get('bbox')
+    coords = decode_polyline(route['routes'][0]['geometry'])
+    calibrator.record(start_coords, target, requested, distance)
+
+    return make_route(coords, distance, duration, bbox, target_distance=target, requested_distance=requested)
+
+
+# As ors_roundroute, but planned in this process on the road graph built from a local OSM extract
+# (see roadgraph.py). The graph is asked for the target length itself, as calibration is for ORS.
+def local_roundroute(start_coords, km_distance, seed=None):
+    target = int(km_distance) * 1000
+    if seed is None:
+        seed = randint(0, 5000)
+    coords, distance, duration = road_graph().round_trip(start_coords, target, seed)
+    bbox = [coords[:, 0].min(), coords[:, 1].min(), coords[:, 0].max(), coords[:, 1].max()]
+    return make_route(coords, distance, duration, [float(value) for value in bbox], target_distance=target)
+
+
+# Creates a Route object from a planned route, with its start and bounding box stored for location
+# searches, and a summary of its shape for route lists
+def make_route(coords, distance, duration, bbox, **columns):
+    return Route(distance=round(distance), duration=round(duration), bbox=json.dumps(bbox),
+                 geometry=pack_coords(coords), start_longitude=coords[0][0], start_latitude=coords[0][1],
+                 min_longitude=bbox[0], min_latitude=bbox[1], max_longitude=bbox[2], max_latitude=bbox[3],
+                 **columns, **route_stats(coords))
+
+
+# Routing backends, chosen with ROUTING_BACKEND
+ROUTING_BACKENDS = {'ors': ors_roundroute, 'local': local_roundroute}
+
+
+# Makes one circular route with whichever backend is configured
+def roundroute(start_coords, km_distance, seed=None):
+    try:
+        backend = ROUTING_BACKENDS[Config.ROUTING_BACKEND]
+    except KeyError:
+        raise ValueError("Unknown ROUTING_BACKEND '{}'".format(Config.ROUTING_BACKEND))
+    return backend(start_coords, km_distance, seed)
+
+
+# ORS often returns a route some way off the requested length, depending on the seed. Here we
+# ask for several routes at once (each with a different seed) and return whichever is closest to
+# the requested distance. We stop waiting as soon as one is within tolerance, or once the deadline
+# has passed (or, if none had come back by then, as soon as the first does), and ignore the rest -
+# so this is usually about as quick as a single ORS call.
+def best_roundroute(start_coords, km_distance, candidates=None, tolerance=None, deadline=None):
+    candidates = candidates or Config.ROUTE_CANDIDATES
+    tolerance = Config.ROUTE_TOLERANCE if tolerance is None else tolerance
+    deadline = Config.ROUTE_DEADLINE if deadline is None else deadline
+
+    if candidates <= 1:  # Nothing to choose between, so just make the one call
+        return roundroute(start_coords, km_distance)
+    if Config.ROUTING_BACKEND == 'local' and under_gevent():
+        return best_local_roundroute(start_coords, km_distance, candidates, tolerance, deadline)
+
+    target = int(km_distance) * 1000
+    futures = [candidate_executor.submit(roundroute, start_coords, km_distance, seed)
+               for seed in sample(range(5001), candidates)]  # Distinct seeds, so we get different routes
+
+    best_route, best_error, last_exception = None, None, None
+    seen, past_deadline = set(), False
+    pending = as_completed(futures, timeout=deadline)
+    try:
+        while True:
+            try:
+                future = next(pending)
+            except StopIteration:  # Every candidate has come back
+                break
+            except TimeoutError:  # Deadline passed. Settle for the best so far, else take the next one back
+                if best_route is not None:
+                    break
+                past_deadline = True
+                pending = as_completed([f for f in futures if f not in seen])
+                continue
+            seen.add(future)
+
+            try:
+                route = future.result()
+            except Exception as e:  # One bad candidate shouldn't fail the request while others may succeed
+                last_exception = e
+                continue
+
+            error = abs(route.distance - target) / target  # Fraction by which the route misses the target
+            if best_route is None or error < best_error:
+                best_route, best_error = route, error
+            if best_error <= tolerance or past_deadline:  # Good enough, or too late to wait for the stragglers
+                break
+    finally:
+        for future in futures:
+            future.cancel()  # Drops any candidates not yet sent; those already in flight are ignored
+
+    if best_route is None:
+        raise last_exception or RuntimeError('No route candidates came back')  # Every candidate failed, so report why
+    return best_route
+
+
+# Whether gevent has patched threading (see gunicorn.conf.py), making the candidate 'threads' greenlets
+def under_gevent():
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('threading')
+
+
+# As best_roundroute, for the local backend under gevent. Planning on the road graph is pure Python
+# and never waits on the network, so a greenlet running it holds up every other request on the
+# worker until it finishes: running candidates side by side gains nothing, and stalls the worker for
+# all of them at once. Instead they are tried one at a time, in the request's own greenlet, letting
+# other requests run between them, and stopping at the first within tolerance or once past the deadline.
+def best_local_roundroute(start_coords, km_distance, candidates, tolerance, deadline):
+    target = int(km_distance) * 1000
+    give_up = time.monotonic() + deadline
+    best_route, best_error, last_exception = None, None, None
+    for seed in sample(range(5001), candidates):
+        try:
+            route = roundroute(start_coords, km_distance, seed)
+        except NoRouteFound:
+            raise  # The start isn't on the graph, so no other seed will do better
+        except Exception as e:
+            last_exception = e
+            continue
 
-    # Create a Route object based on the API response
-    ors_route = Route(distance=round(distance), duration=round(duration), bbox=bbox, polyline=geometry)
+        error = abs(route.distance - target) / target
+        if best_route is None or error < best_error:
+            best_route, best_error = route, error
+        if best_error <= tolerance or time.monotonic() > give_up:
+            break
+        time.sleep(0)  # Let the worker's other requests run before planning the next
 
-    return ors_route
+    if best_route is None:
+        raise last_exception or RuntimeError('No route candidates came back')
+    return best_route
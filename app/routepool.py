@@ -0,0 +1,198 @@
+# Keeps a small stock of ready-made circular routes for the start locations and distances
+# people ask for most often, so that '/route' can usually respond without waiting on ORS.
+#
+# Start locations are grouped into 'cells' by rounding their coordinates, and demand for each
+# (cell, distance) pair is counted as requests come in. A background thread (one per worker,
+# started on first use) then tops up the most popular pairs, one ORS call at a time.
+#
+# Stocking a pair costs 'size' ORS calls, so it is only worth it for pairs asked for repeatedly:
+# a pair is stocked once it has been requested 'min_demand' times, and every count is halved each
+# 'decay_interval' seconds (and dropped at zero), so a one-off request never costs more than
+# itself, and a worker whose traffic dies down soon stops calling ORS altogether.
+
+import logging
+import threading
+import time
+from collections import Counter, deque
+from app.orsclient import ORSUnavailable
+from app.roadgraph import NoRouteFound
+from app.routefinder import roundroute, best_roundroute
+from config import Config
+
+log = logging.getLogger(__name__)
+
+
+class RoutePool(object):
+
+    def __init__(self, generate, size, ttl, refill_interval, max_cells, precision, min_demand, decay_interval):
+        self.generate = generate  # Function taking (start_coords, km_distance) and returning a new Route
+        self.size = size  # Routes to keep ready for each (cell, distance)
+        self.ttl = ttl  # Seconds before a pooled route is considered stale and discarded
+        self.refill_interval = refill_interval  # Seconds between background route generations
+        self.max_cells = max_cells  # Number of (cell, distance) pairs to keep routes ready for
+        self.precision = precision  # Decimal places used when rounding coordinates into cells
+        self.min_demand = min_demand  # Requests for a (cell, distance) before routes are kept ready for it
+        self.decay_interval = decay_interval  # Seconds between halving the demand counts
+        self.hits = 0
+        self.misses = 0
+        self._routes = {}  # Maps (cell, distance) -> deque of (time created, Route)
+        self._starts = {}  # Maps (cell, distance) -> start coordinates to generate new routes from
+        self._demand = Counter()  # Maps (cell, distance) -> number of recent requests (see '_decay')
+        self._decayed = time.monotonic()  # When the demand counts were last halved
+        self._lock = threading.Lock()
+        self._thread = None
+
+    # Groups nearby start locations together, so they can share pooled routes
+    def key(self, start_coords, km_distance):
+        cell = (round(start_coords[0], self.precision), round(start_coords[1], self.precision))
+        return cell, int(km_distance)
+
+    # Returns a ready-made route for this start location and distance, or None if the pool has none.
+    # Either way, the request counts towards demand so the pool learns what to prepare next.
+    def pop(self, start_coords, km_distance):
+        key = self.key(start_coords, km_distance)
+        with self._lock:
+            self._decay()
+            self._demand[key] += 1
+            self._starts.setdefault(key, list(start_coords))
+            self._forget_unpopular(keep=key)
+            route = self._take_fresh(key)
+            if route is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        self._ensure_running()
+        return route
+
+    # Fallback for when ORS is unavailable: returns a pooled route from the same start area with the
+    # closest distance to the one requested, or None if there are none. Doesn't count towards demand.
+    def pop_closest(self, start_coords, km_distance):
+        cell, km_distance = self.key(start_coords, km_distance)
+        with self._lock:
+            keys = sorted((key for key in self._routes if key[0] == cell and self._routes[key]),
+                          key=lambda key: abs(key[1] - km_distance))
+            for key in keys:
+                route = self._take_fresh(key)
+                if route is not None:
+                    return route
+        return None
+
+    # Removes and returns the oldest unexpired route for a key, discarding any stale ones on the way
+    def _take_fresh(self, key):
+        routes = self._routes.get(key)
+        while routes:
+            created, route = routes.popleft()
+            if created > time.monotonic() - self.ttl:
+                return route
+        return None
+
+    # Halves every demand count for each 'decay_interval' passed since the last time, so the pool
+    # follows what is popular now, and stops tracking pairs whose count reaches zero
+    def _decay(self):
+        periods = int((time.monotonic() - self._decayed) // self.decay_interval)
+        if periods <= 0:
+            return
+        self._decayed += periods * self.decay_interval
+        for key, count in list(self._demand.items()):
+            count >>= min(periods, 63)
+            if count:
+                self._demand[key] = count
+            else:
+                self._forget(key)
+
+    def _forget(self, key):
+        del self._demand[key]
+        self._starts.pop(key, None)
+        self._routes.pop(key, None)
+
+    # Stops tracking the least requested pairs once there are more than we are willing to keep stocked.
+    # The pair just requested is always kept, so that new start areas get a chance to build up demand.
+    def _forget_unpopular(self, keep):
+        if len(self._demand) <= self.max_cells:
+            return
+        candidates = [key for key, count in self._demand.most_common() if key != keep]
+        for key in candidates[self.max_cells - 1:]:
+            self._forget(key)
+
+    # Chooses the most requested (cell, distance) that is short of routes, or None if all are stocked
+    # (or nothing has been asked for often enough to be worth stocking)
+    def _next_to_fill(self):
+        with self._lock:
+            self._decay()
+            for key, count in self._demand.most_common():
+                if count < self.min_demand:
+                    break  # Neither this nor any after it are popular enough
+                routes = self._routes.setdefault(key, deque())
+                while routes and routes[0][0] <= time.monotonic() - self.ttl:
+                    routes.popleft()  # Clear out stale routes so they are replaced
+                if len(routes) < self.size:
+                    return key
+        return None
+
+    # Generates a single route for the pair most in need of one. Returns False if there was nothing to do.
+    def refill_once(self):
+        key = self._next_to_fill()
+        if key is None:
+            return False
+
+        try:
+            route = self.generate(self._starts[key], key[1])  # Each call uses a new random seed
+        except NoRouteFound:  # Outside the local road graph, so no point trying again
+            with self._lock:
+                if key in self._demand:
+                    self._forget(key)
+            return True
+        with self._lock:
+            if key in self._demand:  # May have been forgotten while we were waiting on ORS
+                self._routes.setdefault(key, deque()).append((time.monotonic(), route))
+        return True
+
+    # Background loop which keeps the pool topped up, backing off after errors (e.g. ORS unavailable)
+    def _run(self):
+        while True:
+            try:
+                self.refill_once()
+                time.sleep(self.refill_interval)
+            except ORSUnavailable:  # Expected while ORS is down or we are at our rate limit, so just wait
+                time.sleep(self.refill_interval * 10)
+            except Exception:
+                log.exception('Route pool refill failed')
+                time.sleep(self.refill_interval * 10)
+
+    # Starts the background thread on first use. This happens lazily (rather than at import) so
+    # that each gunicorn worker gets its own thread after forking.
+    def _ensure_running(self):
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name='route-pool', daemon=True)
+                    self._thread.start()
+
+    # Summary of how often requests were served from the pool, and how much it is holding
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+                'pooled_routes': sum(len(routes) for routes in self._routes.values()),
+                'tracked_starts': len(self._demand)}
+
+
+route_pool = RoutePool(roundroute, size=Config.ROUTE_POOL_SIZE, ttl=Config.ROUTE_POOL_TTL,
+                       refill_interval=Config.ROUTE_POOL_REFILL_INTERVAL, max_cells=Config.ROUTE_POOL_MAX_CELLS,
+                       precision=Config.ROUTE_POOL_PRECISION, min_demand=Config.ROUTE_POOL_MIN_DEMAND,
+                       decay_interval=Config.ROUTE_POOL_DECAY_INTERVAL)
+
+
+# Returns a route for the given start and distance, from the pool if one is ready, otherwise from ORS directly
+# (trying several seeds at once, so the user isn't kept waiting for a route of the wrong length).
+# If ORS is unavailable, a pooled route of a different length is offered rather than nothing.
+def get_route(start_coords, km_distance):
+    route = route_pool.pop(start_coords, km_distance) if Config.ROUTE_POOL_ENABLED else None
+    if route is None:
+        try:
+            route = best_roundroute(start_coords, km_distance)
+        except ORSUnavailable:
+            route = route_pool.pop_closest(start_coords, km_distance)
+            if route is None:
+                raise
+    return route
@@ -12,34 +12,60 @@
 #
 # Each method has a brief explanation of how it is implemented.
 
+import gzip
+import hashlib
+import hmac
 import json
-from flask import render_template, flash, redirect, url_for, request, session, Response
-from app import app, db, routefinder
+import time
+from datetime import datetime
+from flask import render_template, flash, redirect, url_for, request, session, Response, abort, jsonify, \
+    stream_with_context
+from app import bp, db, routepool
 from app.forms import LocationSearch
 from config import Config
 from flask_login import login_user, logout_user, current_user, login_required
-from slugify import slugify
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import load_only
 from app.oauth import OAuthSignIn
-from app.models import User, Route
-from app.datafeeds import postcode_lookup, polyline_to_coords
-from app.gpx import route_to_gpx
+from app.models import User, Route, Job
+from app.datafeeds import postcode_lookup, geometry_to_coords
+from app.orsclient import ORSUnavailable
+from app.placeindex import place_index
+from app.roadgraph import NoRouteFound
+from app.cache import TTLCache
+from app.geometry import route_geojson, MAX_ZOOM
+from app.nearby import nearby_routes
+from app.gpx import route_gpx_stream, gpx_etag
+from app.export import export_rows, export_zip, gpx_executor
+from app.jobs import create_job, job_progress, JobSpecError
+from app.unsaved import unsaved_routes
+from app.sessions import regenerate_session
+from app.metrics import metrics
 
 mapbox_key = Config.MAPBOX_KEY  # Read Mapbox key from config file
+geojson_cache = TTLCache(maxsize=Config.GEOJSON_CACHE_SIZE)  # Encoded route geometry, per route and zoom level
+page_cache = TTLCache(maxsize=Config.PAGE_CACHE_SIZE, ttl=Config.PAGE_CACHE_TTL)  # Rendered public route pages
 
 
 # Serves the website homepage, both on the base '/' and '/index' URLs.
 #
 # Also handles POST requests, which are received when the user inputs the
 # start location for a cycling route on the webpage.
-@app.route('/', methods=['GET', 'POST'])
-@app.route('/index', methods=['GET', 'POST'])
+@bp.route('/', methods=['GET', 'POST'])
+@bp.route('/index', methods=['GET', 'POST'])
 def homepage(header=True):  # Can be called with parameter 'False' for page to load with header hidden
     form = LocationSearch()
     if form.validate_on_submit():  # Handle form submission (containing start location)
-        result_found, coords, address = postcode_lookup(form.location.data)  # Look up location using ORS API
+        try:
+            result_found, coords, address = postcode_lookup(form.location.data)  # Look up location using ORS API
+        except ORSUnavailable:  # ORS is down or busy, and we haven't looked up this location before
+            flash("Location search is busy right now, please try again shortly", 'danger')
+            return render_template('index.html', header=header, no_location=True, location_input=form,
+                                   mapbox_key=mapbox_key, start=None)
+
         if result_found:  # If a matching location is found, move to next page
-            session['start_location'] = address  # Store location input in the cookie
-            session['start_coords'] = coords  # Store corresponding coordinates in the cookie
+            session['start_location'] = address  # Store location input in the session
+            session['start_coords'] = coords  # Store corresponding coordinates in the session
             return render_template('index.html', header=False, location_input=form, mapbox_key=mapbox_key,
                                    start=coords)  # Reload the homepage, updating the map view to the user's location
         else:  # If no location found, display an error
@@ -52,16 +78,16 @@ def homepage(header=True):  # Can be called with parameter 'False' for page to l
 
 
 # Same view as homepage, but with intro header hidden (header:False)
-@app.route('/start', methods=['GET', 'POST'])
+@bp.route('/start', methods=['GET', 'POST'])
 def start_page():
     return homepage(False)
 
 
 # This is called when the user clicks 'Continue' on the homepage,
 # after entering start location and route length.
-@app.route('/route')
+@bp.route('/route')
 def generate_route():
-    start_coords = session.get('start_coords')  # Fetch start location coordinates from the cookie
+    start_coords = session.get('start_coords')  # Fetch start location coordinates from the session
 
     # In case user reaches this page without coordinates set, fallback location of Uni Birmingham campus
     if not start_coords:
@@ -82,115 +108,136 @@ def generate_route():
     if not distance_requested or distance_requested < 1 or distance_requested > 100:
         distance_requested = 20
 
-    # Call the ORS API, passing the parameters for our route, and store the response
-    route = routefinder.ors_roundroute(start_coords, distance_requested)
+    # Look for public routes which other users have already made nearby, to suggest alongside the new route
+    nearby = nearby_routes(start_coords, distance_requested)
+    db.session.close()  # Give the DB connection back while we wait on ORS (the nearby routes' columns are loaded)
 
-    address = session.get('start_location')  # Fetch start location name (e.g. 'Birmingham') from the user's cookie
+    # Take a ready-made route from the pool if there is one, else call the ORS API, passing the
+    # parameters for our route, and store the response
+    try:
+        route = routepool.get_route(start_coords, distance_requested)
+    except ORSUnavailable:  # ORS is down or busy, and there are no ready-made routes to offer instead
+        if nearby:  # Show the closest existing route instead
+            flash("Route planning is busy right now, so here is a route shared by another rider nearby", 'warning')
+            return redirect(url_for('main.view_route', route_id=nearby[0].id))
+        flash("Route planning is busy right now, please try again shortly", 'danger')
+        return redirect(url_for('main.start_page'))
+    except NoRouteFound:  # Using the local road graph (see roadgraph.py), which doesn't cover this start
+        flash("Sorry, we can't plan routes from there yet", 'danger')
+        return redirect(url_for('main.start_page'))
+
+    address = session.get('start_location')  # Fetch start location name (e.g. 'Birmingham') from the user's session
     if address:
         route.title = "Route near {}".format(address)  # If name found, title the route (e.g. 'Route near Birmingham')
 
-    # Storing Route to DB without user_id set
-    db.session.add(route)
-    db.session.commit()
-
-    # By storing the route to DB, a route ID has been created. We store this in the user's cookie
-    # so that we can locate the route, should they choose to save it to their account
-    session['unsaved_route_id'] = route.id
-
-    route_coords = polyline_to_coords(route.polyline)  # Convert route coordinates from polyline to coordinate list
+    # Keep the route in the unsaved route store (see unsaved.py) rather than the DB, as most routes are
+    # never saved. We store its token in the user's session so that we can locate the route, should
+    # they choose to save it to their account
+    token = unsaved_routes.add(route)
+    session['unsaved_route'] = token
 
     # Load the page, using the template 'create.html', passing the Mapbox key along with the
-    # Route object and a list of the route coordinates
+    # Route object, its start point, and any nearby routes to suggest. The map fetches the rest
+    # of the route from 'unsaved_route_geometry'.
     return render_template('create.html', header=False, title='View Route', mapbox_key=mapbox_key,
-                           route=route, coords=route_coords)
+                           route=route, route_start=[route.start_longitude, route.start_latitude], nearby=nearby,
+                           geometry_url=url_for('main.unsaved_route_geometry', token=token))
 
 
 # Loads the 'About' page using 'about.html'
-@app.route('/about')
+@bp.route('/about')
 def about():
     return render_template('about.html', header=True, title='About')
 
 
 # Login page with Facebook login button to launch OAuth login process
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 def login():
     return render_template('login.html', header=True, title='Login')
 
 
 # Used where user wants to save a route, but needs to log in first
-@app.route('/loginsaveroute')
+@bp.route('/loginsaveroute')
 def login_then_save_route():
     session['save_route'] = True  # Set flag for login method
-    return redirect(url_for('oauth_authorize', provider='facebook'))
+    return redirect(url_for('main.oauth_authorize', provider='facebook'))
 
 
 # Login method for Facebook, extensible to support other OAuth
-@app.route('/authorize/<provider>')
+@bp.route('/authorize/<provider>')
 def oauth_authorize(provider):
     # If user is already signed in, redirect them to the home page
     if not current_user.is_anonymous:
-        return redirect(url_for('homepage'))
+        return redirect(url_for('main.homepage'))
     oauth = OAuthSignIn.get_provider(provider)
     return oauth.authorize()
 
 
 # After user logs in on Facebook/OAuth, this brings them back to the app,
 # (on first visit) logs their details, and updates their status to logged in
-@app.route('/callback/<provider>')
+@bp.route('/callback/<provider>')
 def oauth_callback(provider):
     # If user is already signed in before this process, redirect them to the home page
     if not current_user.is_anonymous:
-        return redirect(url_for('homepage'))
+        return redirect(url_for('main.homepage'))
 
     # Retrieve details from the OAuth process
     oauth = OAuthSignIn.get_provider(provider)
     social_id = oauth.callback()
     if social_id is None:  # OAuth provider does not pass user details (invalid login, or user cancelled process)
         flash('Login failed', 'danger')  # Display error to user
-        return redirect(url_for('homepage'))  # Redirect user to the home page
+        return redirect(url_for('main.homepage'))  # Redirect user to the home page
 
     user = User.query.filter_by(social_id=social_id).first()  # Search DB to see if this user already exists
     if not user:  # If not then add them to DB
         user = User(social_id=social_id)
         db.session.add(user)
         db.session.commit()
+    regenerate_session()  # A session ID from before logging in mustn't carry the login
     login_user(user, True)  # Update user status to logged in (using flask_login library)
 
     # Direct user to the appropriate page after logging in
     if session.get('save_route', False):  # If user is logging in to save a route, direct them to that page
-        return redirect(url_for('save_route'))
+        return redirect(url_for('main.save_route'))
     else:  # Else if standard login, go to their view of all saved routes
-        return redirect(url_for('saved'))
+        return redirect(url_for('main.saved'))
 
 
 # Logout button
-@app.route("/logout")
+@bp.route("/logout")
 @login_required  # User must be logged in to proceed
 def logout():
     logout_user()  # Update user status to logged out (using flask_login library)
-    return redirect(url_for('homepage'))  # Redirect user to the home page
+    regenerate_session()  # Nor should the ID used while logged in outlive it
+    return redirect(url_for('main.homepage'))  # Redirect user to the home page
 
 
 # This is called when the user has created a route and clicks the 'Save' button
-@app.route('/saveroute', methods=['GET'])
+@bp.route('/saveroute', methods=['GET'])
 @login_required  # User must be logged in to proceed
 def save_route():
-    unsaved_route_id = session.get('unsaved_route_id')  # Fetch the route ID from the user's cookie
+    token = session.get('unsaved_route')  # Fetch the unsaved route's token from the user's session
+    route = unsaved_routes.get(token) if token else None  # Locate the corresponding route in the unsaved store
 
-    if unsaved_route_id:  # If a route ID is found, save that route to the user's account
-        route = Route.query.get(unsaved_route_id)  # Locate the corresponding route in DB
-        route.user_id = current_user.id  # Update the 'user_id' for that record to the current user
+    if route:  # If the route is found, save that route to the user's account
+        route.user_id = current_user.id  # Set the 'user_id' for the route to the current user
+        db.session.add(route)  # This is the first time the route is stored to the DB
         db.session.commit()  # Commit changes to DB
+        unsaved_routes.discard(token)  # Now saved, so no longer needed in the unsaved store
+        evict_route_page(route.id)  # In case a deleted route had the same ID
+        session.pop('unsaved_route', None)
         session['save_route'] = False  # Clear flag for login method
         flash('Route saved', 'success')  # Display confirmation to user
-        return redirect(url_for('view_route', route_id=unsaved_route_id))  # Redirect user to the newly-saved route
-    else:  # Otherwise if no route ID found, redirect user to a list of their saved routes
-        return redirect(url_for('saved'))
+        return redirect(url_for('main.view_route', route_id=route.id))  # Redirect user to the newly-saved route
+    else:  # Otherwise if no route found, redirect user to a list of their saved routes
+        if token:  # The route was kept too long without saving, so has been discarded
+            flash('That route has expired, please create a new one', 'warning')
+        return redirect(url_for('main.saved'))
 
 
 # This handles edits made to a saved route, i.e. renaming and changing public/private status.
 # These are received as a 'POST' request containing JSON.
-@app.route('/editroute/<route_id>', methods=['POST'])
+@bp.route('/editroute/<route_id>', methods=['POST'])
 @login_required  # User must be logged in to proceed
 def edit_route(route_id):
     # Load the Route from DB, and check the corresponding user_id matches the currently logged in user
@@ -203,75 +250,285 @@ def edit_route(route_id):
             route.title = new_title  # Update title in DB record
             route.public = new_public  # Update public/private status in DB record
             db.session.commit()  # Commit changes to DB
+            evict_route_page(route.id)  # Remove the old version of the page from this worker's cache
 
     # Redirect user to the newly-saved route
-    return redirect(url_for('view_route', route_id=route_id))
+    return redirect(url_for('main.view_route', route_id=route_id))
 
 
-# Allows the user to view a list of routes they have saved, and routes others have shared
-@app.route('/saved')
+# Removes every cached copy of a route's page. Other workers will notice the change to 'updated_at'.
+def evict_route_page(route_id):
+    page_cache.evict_where(lambda key: key[0] == route_id)
+
+
+# Allows the user to view a list of routes they have saved, and routes others have shared.
+#
+# Each list is shown a page at a time, newest first. Rather than counting through earlier pages
+# (which gets slower the further back you go), each 'Older routes' link carries a cursor holding
+# the timestamp and ID of the last route shown, and the next page starts from just after it.
+@bp.route('/saved')
 @login_required  # User must be logged in to proceed
 def saved():
-    # Query DB for a list of all routes created by this user, newest first
-    own_routes = list(Route.query.filter_by(user_id=current_user.id).order_by(Route.timestamp.desc()))
+    # Query DB for a page of routes created by this user, newest first
+    own_routes, own_next = route_page(Route.query.filter_by(user_id=current_user.id), request.args.get('own'))
 
-    # Query DB for a list of all public routes created by other users, newest first
-    all_routes = list(
-        Route.query.filter(Route.public, Route.user_id != current_user.id).order_by(
-            Route.timestamp.desc()).all())
+    # Query DB for a page of public routes created by other users, newest first
+    all_routes, all_next = route_page(Route.query.filter(Route.public, Route.user_id != current_user.id),
+                                      request.args.get('shared'))
 
     # Load the page using the 'allroutes.html' template, passing in the DB results for this
-    # user's routes and other users' routes
+    # user's routes and other users' routes, and the cursors for the next page of each
     return render_template('allroutes.html', header=False, title='Saved Routes', own_routes=own_routes,
-                           all_routes=all_routes)
-
-
-# Loads a specific route with map display
-@app.route('/route/<int:route_id>')
+                           all_routes=all_routes, own_next=own_next, all_next=all_next)
+
+
+# Returns one page of routes from a query, newest first, starting after the route identified by
+# 'cursor' (or from the newest if None). Also returns the cursor for the following page, or None
+# if this is the last page. Only the columns shown in route lists are loaded.
+def route_page(query, cursor, per_page=None):
+    per_page = per_page or Config.ROUTES_PER_PAGE
+    query = query.options(load_only(Route.id, Route.user_id, Route.public, Route.title, Route.distance,
+                                    Route.duration, Route.timestamp, Route.preview))
+
+    if cursor:
+        try:
+            timestamp, route_id = cursor.split('_')
+            timestamp, route_id = datetime.strptime(timestamp, '%Y%m%d%H%M%S%f'), int(route_id)
+        except ValueError:  # Not a cursor we made, so start from the beginning
+            timestamp = None
+        if timestamp:
+            query = query.filter(or_(Route.timestamp < timestamp,
+                                     and_(Route.timestamp == timestamp, Route.id < route_id)))
+
+    routes = query.order_by(Route.timestamp.desc(), Route.id.desc()).limit(per_page + 1).all()
+    if len(routes) <= per_page:
+        return routes, None
+    routes = routes[:per_page]  # We asked for one extra just to find out whether there is another page
+    return routes, '{}_{}'.format(routes[-1].timestamp.strftime('%Y%m%d%H%M%S%f'), routes[-1].id)
+
+
+# Loads a specific route with map display.
+#
+# Public routes can be shared widely, so their pages are cached once rendered, with one copy for
+# each kind of viewer (signed out, signed in, or the route's owner), and tagged so that browsers
+# can check whether their copy is still current. As the page says how long ago the route was made
+# ('Created 5 minutes ago'), a copy is only current for PAGE_CACHE_TTL seconds, even if the route
+# hasn't changed. Only a few columns are loaded to make that
+# check; the whole route is only loaded if the page has to be rendered.
+@bp.route('/route/<int:route_id>')
 def view_route(route_id):  # Pass in the route_id from the end of the URL (e.g. /route/23)
-    route = Route.query.filter_by(id=route_id).first_or_404()  # Load route from DB, return error if not found
+    # Load route details from DB, return error if not found
+    summary = db.session.query(Route.public, Route.user_id, Route.updated_at).filter_by(id=route_id).first_or_404()
 
-    if not route.public:  # If route is not public, check user has permission before allowing access
+    if not summary.public:  # If route is not public, check user has permission before allowing access
         if current_user.is_anonymous:  # Must sign in before viewing non-public routes
             flash('Sign in required', 'warning')  # Display warning to user
-            return redirect(url_for('login'))  # Redirect user to the login page
+            return redirect(url_for('main.login'))  # Redirect user to the login page
 
-        if current_user.id != route.user_id:  # Must be route owner in order to view it
+        if current_user.id != summary.user_id:  # Must be route owner in order to view it
             flash('This route is not shared with you', 'warning')  # Display error to user
-            return redirect(url_for('saved'))  # Redirect user to a list of their saved routes
+            return redirect(url_for('main.saved'))  # Redirect user to a list of their saved routes
 
     # If we get here: route is either public, or user has permission to view, so we display it
-    route_coords = polyline_to_coords(route.polyline)  # Convert route coordinates from polyline to coordinate list
-
     # We use an 'own_route' boolean so that the page template can adapt to whether the route
     # belongs to the current user or a different user
     if current_user.is_anonymous:  # If user not logged in, set to False
         own_route = False
     else:  # Else, evaluate whether current user matches route owner and return True/False
-        own_route = current_user.id == route.user_id
+        own_route = current_user.id == summary.user_id
+
+    # Pages with a message waiting to be shown (e.g. 'Route saved') are one-offs, so aren't cached
+    if not summary.public or session.get('_flashes'):
+        return render_route_page(route_id, own_route)
+
+    viewer = 'owner' if own_route else 'anonymous' if current_user.is_anonymous else 'signed_in'
+    period = int(time.time() // Config.PAGE_CACHE_TTL)  # So the relative times shown are re-rendered
+    key = (route_id, summary.updated_at, viewer, period)  # Last update included, in case another worker edited it
+    etag = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+    if request.if_none_match.contains(etag):  # The browser's copy is current, so there's no need to render
+        page = None
+    else:
+        page = page_cache.get(key)
+        if page is None:
+            page = render_route_page(route_id, own_route)
+            page_cache.set(key, page)
+
+    response = Response(page, mimetype='text/html')
+    response.set_etag(etag)
+    rendered_since = datetime.utcfromtimestamp(period * Config.PAGE_CACHE_TTL)
+    response.last_modified = max(summary.updated_at or rendered_since, rendered_since)
+    response.cache_control.no_cache = True  # Browsers must check with us (using the ETag) before reusing a copy
+    if viewer != 'anonymous':
+        response.cache_control.private = True  # Only the user's own browser may keep a copy
+    response.vary.add('Cookie')  # Signed in users see a different page
+    return response.make_conditional(request)
+
+
+# Renders the page for a route, which the current user has already been checked to have access to
+def render_route_page(route_id, own_route):
+    route = Route.query.get(route_id)
 
     # Loads the page using the 'route.html' template, passing the Mapbox key, along with the Route
-    # object, a list of the route coordinates, and the boolean of whether current user is route owner.
-    return render_template('route.html', header=False, mapbox_key=mapbox_key, route=route, coords=route_coords,
-                           own_route=own_route)
+    # object, its start point, and the boolean of whether current user is route owner.
+    return render_template('route.html', header=False, mapbox_key=mapbox_key, route=route,
+                           route_start=[route.start_longitude, route.start_latitude], own_route=own_route,
+                           geometry_url=url_for('main.route_geometry', route_id=route.id))
+
+
+# Serves the geometry of a route as GeoJSON, for the map on the route pages to load. With '?zoom=',
+# the line is simplified to the detail visible at that map zoom level, which is much smaller for
+# long routes. Results are cached per route and zoom level, compressed, and tagged for browser caching.
+@bp.route('/route/<int:route_id>.geojson')
+def route_geometry(route_id):
+    route = Route.query.filter_by(id=route_id).first_or_404()  # Load route from DB, return error if not found
+    if not can_view_route(route):
+        abort(404)  # Don't reveal that a private route exists
+    return geojson_response(route, route.id, public=route.public)
+
+
+# As 'route_geometry', for the route the user has just generated (which is only in the unsaved route store)
+@bp.route('/route/unsaved/<token>.geojson')
+def unsaved_route_geometry(token):
+    route = unsaved_routes.get(token) if token == session.get('unsaved_route') else None
+    if route is None:
+        abort(404)
+    return geojson_response(route, token, public=False)
+
+
+# Builds the GeoJSON response for a route, simplified to the '?zoom=' level. 'cache_id' identifies
+# the route in the cache: its ID, or its token if unsaved.
+def geojson_response(route, cache_id, public):
+    zoom = request.args.get('zoom', type=int)
+    if zoom is not None:
+        zoom = min(max(zoom, 0), MAX_ZOOM)
+
+    key = (cache_id, hash(route.geometry), zoom)  # Geometry included in case the route has changed
+    cached = geojson_cache.get(key)
+    if cached is None:
+        geojson = json.dumps(route_geojson(geometry_to_coords(route.geometry, route.id), zoom),
+                             separators=(',', ':')).encode('utf-8')
+        cached = (geojson, gzip.compress(geojson), hashlib.sha1(geojson).hexdigest())
+        geojson_cache.set(key, cached)
+    geojson, compressed, etag = cached
+
+    if 'gzip' in request.accept_encodings:  # Nearly all browsers, so send the compressed version
+        response = Response(compressed, mimetype='application/geo+json')
+        response.headers['Content-Encoding'] = 'gzip'
+        response.set_etag(etag + '-gzip')
+    else:
+        response = Response(geojson, mimetype='application/geo+json')
+        response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    response.cache_control.max_age = 300
+    if public:  # Shared caches may only keep public routes
+        response.cache_control.public = True
+    else:
+        response.cache_control.private = True
+    return response.make_conditional(request)
+
+
+# Whether the current user may see a route: it must be public, or their own
+def can_view_route(route):
+    if route.public:
+        return True
+    return not current_user.is_anonymous and current_user.id == route.user_id
 
 
 # This is called where the user clicks the 'Download GPX' button on a route page. It loads the
 # requested route, converts it to GPX format (for use with bike GPS devices) and serves it
 # as a file for the user to download.
 #
+# The file is streamed as it is generated, and tagged with an ETag based on the route content,
+# so that a client which already has an up-to-date copy gets an empty '304 Not Modified' reply.
+#
 # Adapted from: https://stackoverflow.com/questions/28011341/create-and-download-a-csv-file-from-a-flask-view
-@app.route('/gpx/<int:route_id>')
+@bp.route('/gpx/<int:route_id>')
 @login_required  # User must be logged in to proceed
 def download_gpx(route_id):
 
     route = Route.query.filter_by(id=route_id).first_or_404()  # Load route from DB, return error if not found
-    route_gpx = route_to_gpx(route)  # Call the method from gpx.py to convert the Route object into a GPX file
+    route_gpx = route_gpx_stream(route)  # Call the method from gpx.py to stream the Route object as a GPX file
 
     # Create a response and set the file content type
     response = Response(route_gpx, mimetype='application/gpx+xml')
+    response.set_etag(gpx_etag(route))
+    response.cache_control.private = True  # Only the user's own browser may keep a copy...
+    response.cache_control.no_cache = True  # ...and it must check with us (using the ETag) before reusing it
 
     # Remove whitespace/symbols from route title using the 'slugify' library, set that as filename
+    from slugify import slugify  # Loaded on the first download, rather than with the app
     safe_filename = "{}.gpx".format(slugify(route.title))
     response.headers.set("Content-Disposition", "attachment", filename=safe_filename)
+    return response.make_conditional(request)  # Replaces the body with '304 Not Modified' if the ETag matches
+
+
+# Downloads all of the user's routes at once, as a ZIP file of GPX files (see export.py). The
+# routes can be narrowed down with '?ids=1,2,3' and/or '?public=true' (or 'false').
+@bp.route('/export')
+@login_required  # User must be logged in to proceed
+def export_routes():
+    query = Route.query.filter_by(user_id=current_user.id)  # Only ever the user's own routes
+    if request.args.get('ids'):
+        try:
+            ids = [int(route_id) for route_id in request.args['ids'].split(',')]
+        except ValueError:
+            abort(400)
+        query = query.filter(Route.id.in_(ids))
+    if request.args.get('public') in ('true', 'false'):
+        query = query.filter(Route.public == (request.args['public'] == 'true'))
+
+    # Stream the file, keeping the request context (and so the DB session) open until it has all been sent
+    response = Response(stream_with_context(export_zip(export_rows(query), gpx_executor())),
+                        mimetype='application/zip')
+    response.headers.set('Content-Disposition', 'attachment', filename='ridetime-routes.zip')
     return response
+
+
+# Suggests places and postcodes starting with what the user has typed so far ('?q='), from the
+# local place index (see placeindex.py), for the location search box. Returns an empty list if
+# there is no index.
+@bp.route('/api/places')
+def place_suggestions():
+    text = request.args.get('q', '')[:100]
+    index = place_index()
+    results = index.suggest(text, Config.PLACE_SUGGESTIONS) if index and text.strip() else []
+    response = jsonify(query=text, results=results)
+    response.cache_control.public = True  # The same for everyone, so browsers and proxies may keep it
+    response.cache_control.max_age = 86400
+    return response
+
+
+# Starts a batch job to generate many routes at once (see jobs.py). Takes JSON such as
+#   {"routes": [{"start": [-1.93, 52.45], "distance": 30, "count": 20}, ...]}
+# and returns the new job's ID and where to check on its progress.
+@bp.route('/api/jobs', methods=['POST'])
+@login_required  # User must be logged in to proceed
+def create_route_job():
+    body = request.get_json(silent=True) or {}
+    try:
+        job = create_job(current_user.id, body.get('routes'))
+    except JobSpecError as e:
+        return jsonify(error=str(e)), 400
+    response = jsonify(job_progress(job))
+    response.status_code = 202  # Accepted, but not finished
+    response.headers['Location'] = url_for('main.route_job', job_id=job.id)
+    return response
+
+
+# Progress of a batch job, and the routes it has generated so far
+@bp.route('/api/jobs/<int:job_id>')
+@login_required  # User must be logged in to proceed
+def route_job(job_id):
+    job = Job.query.filter_by(id=job_id, user_id=current_user.id).first_or_404()  # Only the user's own jobs
+    return jsonify(job_progress(job))
+
+
+# Serves performance metrics (see metrics.py) in the Prometheus text format. They show how busy
+# each page is and how often ORS fails, so aren't public: requests must include METRICS_TOKEN in
+# an 'Authorization: Bearer <token>' header, and without a METRICS_TOKEN the page is switched off.
+@bp.route('/metrics')
+def metrics_page():
+    expected = 'Bearer {}'.format(Config.METRICS_TOKEN)
+    if not Config.METRICS_TOKEN or not hmac.compare_digest(request.headers.get('Authorization', ''), expected):
+        abort(404)  # Don't reveal that the page exists
+    return Response(metrics.exposition(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,284 @@
+# Server-side sessions. Flask normally keeps the whole session (start location, unsaved route
+# token, login details, flashed messages) in a signed cookie, which every request then carries,
+# and which is checked and re-signed on every response. Instead, the cookie holds only a random
+# session ID and a version number (signed, so they can't be guessed or forged), and the contents
+# are kept in a store, chosen with SESSION_STORE:
+#   'database'          - the 'stored_session' table in the app's DB, shared by every machine (the default)
+#   'sqlite:///<path>'  - a local SQLite file, shared by every worker on one machine
+#   'memory'            - each worker's own memory, so only for a single worker
+#   'cookie'            - Flask's usual signed cookie, without a store
+#
+# Sessions are loaded lazily: the store is only read the first time a request uses 'session',
+# so requests that never do (and visitors without a session cookie) cost nothing. Each worker
+# keeps recently used sessions in memory, keyed by ID and version; as every change gets a new
+# version (sent back in the cookie), a copy held by one worker can't hide a change made by another.
+#
+# A session is written back only when its contents change, or when it is half way to expiring.
+# Expired sessions are swept out in batches, every PURGE_EVERY writes.
+
+import secrets
+import threading
+import time
+from datetime import datetime
+from flask import session
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import BadSignature, Signer
+from sqlalchemy import select
+from app import db
+from app.cache import TTLCache
+from app.models import StoredSession
+from app.unsaved import SQLiteStore
+from config import Config
+
+EPOCH = datetime(1970, 1, 1)
+UNCHANGING_TYPES = (bool, int, float, str, type(None))
+
+
+# A session whose contents are only fetched from the store when first used
+class ServerSideSession(SessionMixin):  # SessionMixin is a MutableMapping, built on the methods below
+
+    def __init__(self, interface, sid=None, version=0):
+        self.sid = sid  # None until the session has been stored
+        self.version = version
+        self.had_cookie = sid is not None
+        self.expires = None  # When the stored copy expires (seconds since the epoch)
+        self.accessed = False
+        self.modified = False
+        self._interface = interface
+        self._data = None
+
+    @property
+    def loaded(self):
+        return self._data is not None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = self._interface.load(self)
+        self.accessed = True
+        return self._data
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        previous = self.data.get(key)
+        self.data[key] = value
+        # Setting a plain value to what it already was (as Flask-Login does with '_fresh' on every request)
+        # isn't a change. Anything else may be a list or dict changed in place, so is counted as one.
+        if not (type(value) in UNCHANGING_TYPES and type(previous) is type(value) and previous == value):
+            self.modified = True
+
+    def __delitem__(self, key):
+        del self.data[key]
+        self.modified = True
+
+    # Moves the contents to a new ID, dropping the old one from the store, so that an ID handed out
+    # (or planted) before logging in or out can't be used afterwards
+    def regenerate(self):
+        data = self.data
+        if self.sid is not None:
+            self._interface.backend.delete(self.sid)
+            self._interface.cache.evict((self.sid, self.version))
+        self.sid, self.expires = None, None
+        self._data = data
+        self.modified = True
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+
+# Keeps sessions in this worker's memory
+class MemoryBackend(object):
+
+    def __init__(self):
+        self._sessions = {}  # Maps ID -> (version, expires, payload)
+        self._lock = threading.Lock()
+
+    def get(self, sid):
+        return self._sessions.get(sid)
+
+    def set(self, sid, version, expires, payload):
+        with self._lock:
+            self._sessions[sid] = (version, expires, payload)
+
+    def delete(self, sid):
+        with self._lock:
+            self._sessions.pop(sid, None)
+
+    def purge(self, now, limit):
+        with self._lock:
+            expired = [sid for sid, (_, expires, _) in self._sessions.items() if expires <= now][:limit]
+            for sid in expired:
+                del self._sessions[sid]
+
+
+# Keeps sessions in a SQLite file, shared by the workers on this machine
+class SQLiteBackend(SQLiteStore):
+    SCHEMA = ('CREATE TABLE IF NOT EXISTS session '
+              '(id TEXT PRIMARY KEY, version INTEGER NOT NULL, expires REAL NOT NULL, data TEXT NOT NULL)',
+              'CREATE INDEX IF NOT EXISTS ix_session_expires ON session (expires)')
+
+    def get(self, sid):
+        rows = self._execute('SELECT version, expires, data FROM session WHERE id = ?', (sid,))
+        return rows[0] if rows else None
+
+    def set(self, sid, version, expires, payload):
+        self._execute('INSERT OR REPLACE INTO session (id, version, expires, data) VALUES (?, ?, ?, ?)',
+                      (sid, version, expires, payload))
+
+    def delete(self, sid):
+        self._execute('DELETE FROM session WHERE id = ?', (sid,))
+
+    def purge(self, now, limit):
+        self._execute('DELETE FROM session WHERE id IN (SELECT id FROM session WHERE expires <= ? LIMIT ?)',
+                      (now, limit))
+
+
+# Keeps sessions in the 'stored_session' table. Uses its own connections rather than the request's
+# DB session, so storing the session never commits (or rolls back) the request's own changes.
+class DatabaseBackend(object):
+    table = StoredSession.__table__
+
+    def get(self, sid):
+        table = self.table
+        with db.engine.connect() as connection:
+            row = connection.execute(select([table.c.version, table.c.expires, table.c.data]).where(
+                table.c.id == sid)).first()
+        if row is None:
+            return None
+        return row.version, (row.expires - EPOCH).total_seconds(), row.data
+
+    def set(self, sid, version, expires, payload):
+        table = self.table
+        values = {'version': version, 'expires': datetime.utcfromtimestamp(expires), 'data': payload}
+        with db.engine.begin() as connection:
+            if not connection.execute(table.update().where(table.c.id == sid).values(**values)).rowcount:
+                connection.execute(table.insert().values(id=sid, **values))
+
+    def delete(self, sid):
+        with db.engine.begin() as connection:
+            connection.execute(self.table.delete().where(self.table.c.id == sid))
+
+    def purge(self, now, limit):
+        table = self.table
+        expired = select([table.c.id]).where(table.c.expires <= datetime.utcfromtimestamp(now)).limit(limit)
+        with db.engine.begin() as connection:
+            connection.execute(table.delete().where(table.c.id.in_(expired)))
+
+
+class ServerSideSessionInterface(SessionInterface):
+    PURGE_EVERY = 100  # Writes between sweeping out expired sessions
+    PURGE_BATCH = 500  # Most expired sessions removed in each sweep
+    serializer = TaggedJSONSerializer()  # As for Flask's cookie, so tuples, bytes, Markup etc. survive
+    salt = 'ridetime-session-id'
+
+    def __init__(self, backend, ttl, cache_size):
+        self.backend = backend
+        self.ttl = ttl  # Seconds a session that isn't 'permanent' is kept after it was last used
+        self.cache = TTLCache(maxsize=cache_size)  # Maps (ID, version) -> (payload, expires)
+        self.listeners = []  # Functions called with where each session was loaded from ('cache', 'store' or 'none')
+        self._writes = 0
+
+    def open_session(self, app, request):
+        if not app.secret_key:
+            return None  # Flask then uses a NullSession, which explains that SECRET_KEY is needed
+        value = request.cookies.get(app.session_cookie_name)
+        if value:
+            try:
+                sid, version = Signer(app.secret_key, salt=self.salt).unsign(value).decode('ascii').rsplit('.', 1)
+                return ServerSideSession(self, sid, int(version))
+            except (BadSignature, ValueError):
+                pass  # e.g. a cookie from before sessions were stored, so start afresh
+        return ServerSideSession(self)
+
+    # Fetches a session's contents (from this worker's memory if it has the version the cookie
+    # names), noting when the stored copy expires. A session missing from the store, or expired,
+    # starts afresh and empty.
+    def load(self, session):
+        source, now = 'none', time.time()
+        if session.sid is not None:
+            entry = self.cache.get((session.sid, session.version))
+            if entry is not None and entry[1] > now:
+                source = 'cache'
+            else:
+                stored = self.backend.get(session.sid)
+                if stored is not None and stored[1] > now:
+                    session.version, entry = stored[0], (stored[2], stored[1])  # Newest, if the cookie was behind
+                    self.cache.set((session.sid, session.version), entry)
+                    source = 'store'
+        for listener in self.listeners:
+            listener(source)
+        if source == 'none':
+            session.sid, session.expires = None, None
+            return {}
+        session.expires = entry[1]
+        return self.serializer.loads(entry[0])
+
+    def save_session(self, app, session, response):
+        if not session.loaded:  # Never used during this request, so can't have changed
+            return
+        response.vary.add('Cookie')
+        cookie = {'domain': self.get_cookie_domain(app), 'path': self.get_cookie_path(app)}
+
+        if not session:
+            if session.modified and session.sid is not None:  # Emptied, e.g. on logging out
+                self.backend.delete(session.sid)
+            if session.had_cookie:
+                response.delete_cookie(app.session_cookie_name, **cookie)
+            return
+
+        now = time.time()
+        lifetime = app.permanent_session_lifetime.total_seconds() if session.permanent else self.ttl
+        if not session.modified and session.expires is not None and session.expires - now > lifetime / 2:
+            return  # Unchanged, and not near expiring
+
+        new_id = session.sid is None
+        if new_id:
+            session.sid, session.version = secrets.token_urlsafe(24), 0
+        if session.modified:
+            session.version += 1
+        payload = self.serializer.dumps(dict(session.data))
+        self.backend.set(session.sid, session.version, now + lifetime, payload)
+        self.cache.set((session.sid, session.version), (payload, now + lifetime))
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            self.backend.purge(now, self.PURGE_BATCH)
+
+        # The cookie only needs sending again if it names a new ID or version, or (for a permanent
+        # session) to push back its expiry date
+        if new_id or session.modified or session.permanent:
+            value = Signer(app.secret_key, salt=self.salt).sign('{}.{}'.format(session.sid, session.version))
+            response.set_cookie(app.session_cookie_name, value.decode('ascii'),
+                                expires=self.get_expiration_time(app, session), httponly=self.get_cookie_httponly(app),
+                                secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app), **cookie)
+
+
+# Gives the current session a new ID when logging in or out. A cookie session has no ID to
+# steal, so is left alone.
+def regenerate_session():
+    current = session._get_current_object()  # 'session' is a proxy, so check what it stands for
+    if isinstance(current, ServerSideSession):
+        current.regenerate()
+
+
+# Creates the backend described by a SESSION_STORE setting, or None to keep sessions in the cookie
+def make_backend(url):
+    if url == 'cookie':
+        return None
+    if url == 'database':
+        return DatabaseBackend()
+    if url == 'memory':
+        return MemoryBackend()
+    if url.startswith('sqlite:///'):
+        return SQLiteBackend(url[len('sqlite:///'):])
+    raise ValueError("Unknown SESSION_STORE '{}'".format(url))
+
+
+_backend = make_backend(Config.SESSION_STORE)
+session_interface = ServerSideSessionInterface(_backend, Config.SESSION_TTL, Config.SESSION_CACHE_SIZE) \
+    if _backend is not None else None
@@ -0,0 +1,202 @@
+# Short-term storage for routes which have been generated but not (yet) saved. Most generated
+# routes are never saved, so rather than writing every one to the main DB, we keep them here
+# for a limited time, under a random token held in the user's session. Only '/saveroute' copies
+# a route into the DB.
+#
+# Three backends are available, chosen with UNSAVED_ROUTE_STORE:
+#   'sqlite:///<path>'  - a local SQLite file, shared by every worker on one machine (the default)
+#   'memory'            - fastest, but each worker has its own copy, so only for a single worker
+#   'database'          - the 'unsaved_route' table in the app's DB, shared by every machine. Needed
+#                         when there is more than one (e.g. several web dynos), as '/saveroute' may be
+#                         answered by a different one from the request which made the route, but it
+#                         means a write to the main DB for every route made.
+
+import base64
+import json
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import select
+from app import db
+from app.cache import TTLCache
+from app.models import Route, UnsavedRoute
+from config import Config
+
+# Route columns kept for an unsaved route (the ID and owner are only set once it is saved)
+ROUTE_FIELDS = ('title', 'distance', 'duration', 'bbox', 'start_longitude', 'start_latitude',
+                'min_longitude', 'min_latitude', 'max_longitude', 'max_latitude', 'point_count', 'geo_distance',
+                'preview', 'target_distance', 'requested_distance')
+
+
+# Keeps unsaved routes in this worker's memory, dropping the oldest beyond 'maxsize'
+class MemoryBackend(object):
+
+    def __init__(self, maxsize, ttl):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def get(self, token):
+        return self._cache.get(token)
+
+    def set(self, token, record):
+        self._cache.set(token, record)
+
+    def delete(self, token):
+        self._cache.evict(token)
+
+
+# A SQLite file shared by every worker on the machine, holding the tables created by SCHEMA.
+# Each worker process keeps a few open connections, which requests borrow one at a time. (Rather than
+# one per thread, as under gevent every request runs in a new greenlet, which would open its own.)
+class SQLiteStore(object):
+    SCHEMA = ()  # Statements run on each new connection, to create the tables if needed
+    MAX_IDLE = 8  # Open connections kept per worker when not in use
+
+    def __init__(self, path):
+        self.path = path
+        self._idle = []
+        self._pid = None  # Process the idle connections belong to, so a newly forked worker opens its own
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=5, isolation_level=None,  # Commit each statement
+                                     check_same_thread=False)  # Passed between threads through '_idle'
+        connection.execute('PRAGMA journal_mode=WAL')  # Readers don't wait for writers
+        for statement in self.SCHEMA:
+            connection.execute(statement)
+        return connection
+
+    # Runs 'sql' on an idle connection (opening one if there are none), and returns all the rows
+    def _execute(self, sql, parameters=()):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._idle, self._pid = [], os.getpid()
+            connection = self._idle.pop() if self._idle else None
+        connection = connection or self._connect()
+        try:
+            return connection.execute(sql, parameters).fetchall()
+        finally:
+            with self._lock:
+                if len(self._idle) < self.MAX_IDLE and self._pid == os.getpid():
+                    self._idle.append(connection)
+                else:
+                    connection.close()
+
+
+# Keeps unsaved routes in a SQLite file, so that any worker can answer for a route generated by another
+class SQLiteBackend(SQLiteStore):
+    SCHEMA = ('CREATE TABLE IF NOT EXISTS unsaved_route '
+              '(token TEXT PRIMARY KEY, expires REAL NOT NULL, record TEXT NOT NULL)',
+              'CREATE INDEX IF NOT EXISTS ix_unsaved_route_expires ON unsaved_route (expires)')
+    PURGE_EVERY = 100  # Writes between clearing out expired routes
+
+    def __init__(self, path, maxsize, ttl):
+        super(SQLiteBackend, self).__init__(path)
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._writes = 0
+
+    def get(self, token):
+        rows = self._execute('SELECT record FROM unsaved_route WHERE token = ? AND expires > ?', (token, time.time()))
+        return json.loads(rows[0][0]) if rows else None
+
+    def set(self, token, record):
+        self._execute('INSERT OR REPLACE INTO unsaved_route (token, expires, record) VALUES (?, ?, ?)',
+                      (token, time.time() + self.ttl, json.dumps(record)))
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            self.purge()
+
+    def delete(self, token):
+        self._execute('DELETE FROM unsaved_route WHERE token = ?', (token,))
+
+    # Removes expired routes, then the oldest routes beyond 'maxsize'
+    def purge(self):
+        self._execute('DELETE FROM unsaved_route WHERE expires <= ?', (time.time(),))
+        self._execute('DELETE FROM unsaved_route WHERE token IN (SELECT token FROM unsaved_route '
+                      'ORDER BY expires DESC LIMIT -1 OFFSET ?)', (self.maxsize,))
+
+
+# Keeps unsaved routes in the 'unsaved_route' table, so that any worker on any machine can answer for
+# them. Like the session store, uses its own connections rather than the request's DB session, so
+# storing a route never commits (or rolls back) the request's own changes.
+class DatabaseBackend(object):
+    table = UnsavedRoute.__table__
+    PURGE_EVERY = 100  # Writes between clearing out expired routes
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._writes = 0
+
+    def get(self, token):
+        table = self.table
+        with db.engine.connect() as connection:
+            record = connection.execute(select([table.c.record]).where(
+                (table.c.token == token) & (table.c.expires > datetime.utcnow()))).scalar()
+        return json.loads(record) if record is not None else None
+
+    def set(self, token, record):
+        expires = datetime.utcfromtimestamp(time.time() + self.ttl)
+        with db.engine.begin() as connection:
+            connection.execute(self.table.insert().values(token=token, expires=expires, record=json.dumps(record)))
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            self.purge()
+
+    def delete(self, token):
+        with db.engine.begin() as connection:
+            connection.execute(self.table.delete().where(self.table.c.token == token))
+
+    # Removes expired routes, then the oldest routes beyond 'maxsize'
+    def purge(self):
+        table = self.table
+        with db.engine.begin() as connection:
+            connection.execute(table.delete().where(table.c.expires <= datetime.utcnow()))
+            cutoff = connection.execute(select([table.c.expires]).order_by(table.c.expires.desc())
+                                        .offset(self.maxsize).limit(1)).scalar()
+            if cutoff is not None:
+                connection.execute(table.delete().where(table.c.expires <= cutoff))
+
+
+# Stores Route objects in a backend as plain dictionaries, under new random tokens
+class UnsavedRouteStore(object):
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    # Stores a route, returning the token to fetch it with
+    def add(self, route):
+        token = secrets.token_urlsafe(16)
+        record = {field: getattr(route, field) for field in ROUTE_FIELDS}
+        record['geometry'] = base64.b64encode(route.geometry).decode('ascii')
+        self.backend.set(token, record)
+        return token
+
+    # Returns a new (not yet added to the DB session) Route object for a token, or None if it has expired
+    def get(self, token):
+        record = self.backend.get(token)
+        if record is None:
+            return None
+        record = dict(record, geometry=base64.b64decode(record['geometry']))
+        return Route(**record)
+
+    def discard(self, token):
+        self.backend.delete(token)
+
+
+# Creates the backend described by a UNSAVED_ROUTE_STORE setting
+def make_backend(url, maxsize, ttl):
+    if url == 'database':
+        return DatabaseBackend(maxsize, ttl)
+    if url == 'memory':
+        return MemoryBackend(maxsize, ttl)
+    if url.startswith('sqlite:///'):
+        return SQLiteBackend(url[len('sqlite:///'):], maxsize, ttl)
+    raise ValueError("Unknown UNSAVED_ROUTE_STORE '{}'".format(url))
+
+
+unsaved_routes = UnsavedRouteStore(make_backend(Config.UNSAVED_ROUTE_STORE, Config.UNSAVED_ROUTE_LIMIT,
+                                                Config.UNSAVED_ROUTE_TTL))
@@ -0,0 +1,52 @@
+# Compares our NumPy polyline decoder with the ORS library's pure-Python one, on synthetic
+# 100 km routes, and checks that both give the same coordinates.
+#
+# Usage (from the repository root):
+#   python -m benchmarks.bench_polyline --routes 50 --spacing 25
+
+import argparse
+import os
+import timeit
+import numpy as np
+from openrouteservice import convert
+from benchmarks.synthetic import encode_polyline, synthetic_loop
+
+os.environ.setdefault('ORS_KEY', 'benchmark')  # Importing the app creates an ORS client, though we never call it
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Polyline decoding benchmark')
+    parser.add_argument('--routes', type=int, default=20, help='number of different routes to decode')
+    parser.add_argument('--km', type=float, default=100, help='length of each route')
+    parser.add_argument('--spacing', type=float, default=25, help='metres between points on each route')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    from app.datafeeds import polyline_to_coords, coords_cache
+    from app.polyline import decode_polyline
+
+    polylines = [encode_polyline(synthetic_loop((-1.93, 52.45), args.km, seed=i, spacing=args.spacing))
+                 for i in range(args.routes)]
+    for polyline in polylines:  # Make sure we're comparing like with like
+        assert np.array_equal(decode_polyline(polyline), convert.decode_polyline(polyline)['coordinates'])
+
+    def time_per_route(decode):
+        best = min(timeit.repeat(lambda: [decode(p) for p in polylines], number=1, repeat=args.repeat))
+        return 1000 * best / len(polylines)
+
+    coords_cache.clear()
+    print('{} routes of {} km, {} points and {} characters each on average'.format(
+        args.routes, args.km, sum(len(decode_polyline(p)) for p in polylines) // args.routes,
+        sum(len(p) for p in polylines) // args.routes))
+    results = [
+        ('ORS convert.decode_polyline', time_per_route(convert.decode_polyline)),
+        ('NumPy decode_polyline', time_per_route(decode_polyline)),
+        ('polyline_to_coords (cached)', time_per_route(lambda p: polyline_to_coords(p, route_id=1))),
+    ]
+    baseline = results[0][1]
+    for name, ms in results:
+        print('{:<30} {:>9.3f} ms/route  {:>7.1f}x'.format(name, ms, baseline / ms))
+
+
+if __name__ == '__main__':
+    main()
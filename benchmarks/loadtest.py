@@ -0,0 +1,202 @@
+# End-to-end load test for RideTime. Seeds a throwaway database with users and routes, runs the
+# app on a local threaded server with ORS replaced by the stand-in (see ors_standin.py), then
+# drives the main pages at a set concurrency and reports latency percentiles and throughput.
+#
+# Usage (from the repository root):
+#   python -m benchmarks.loadtest --concurrency 16 --duration 30 --ors-latency 0.8
+#   python -m benchmarks.loadtest --output baseline.json
+
+import argparse
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+import requests
+from benchmarks.ors_standin import Fixtures, StandinSettings, start_standin
+from benchmarks.synthetic import synthetic_directions
+
+BIRMINGHAM = (-1.930556, 52.450556)
+LOCATIONS = ['B15 2TT', 'b152tt', 'Birmingham', 'Edgbaston', 'Selly Oak', 'Harborne', 'B29 6BD', 'Moseley']
+
+# Relative frequency of each kind of request in the default mix
+SCENARIOS = {
+    'index': 20,  # GET /
+    'search': 10,  # POST / with a start location
+    'generate': 20,  # GET /route
+    'view': 25,  # GET /route/<id>
+    'saved': 10,  # GET /saved
+    'gpx': 15,  # GET /gpx/<id>
+}
+
+
+# Fills the database with users and synthetic routes around Birmingham. Returns (public ids, own ids)
+# where 'own' routes belong to user 1, whom the load test is signed in as.
+def seed_database(db, User, Route, users, routes):
+    from app.geometry import route_stats  # Only once the app has been configured
+    from app.polyline import decode_polyline, pack_coords
+
+    db.drop_all()
+    db.create_all()
+    db.session.bulk_insert_mappings(User, [{'id': i, 'social_id': 'loadtest${}'.format(i)}
+                                           for i in range(1, users + 1)])
+    rng = random.Random(0)
+    mappings = []
+    for i in range(1, routes + 1):
+        start = (BIRMINGHAM[0] + rng.uniform(-0.3, 0.3), BIRMINGHAM[1] + rng.uniform(-0.2, 0.2))
+        response = synthetic_directions(start, rng.randint(5, 100) * 1000, seed=i)
+        summary = response['routes'][0]['summary']
+        coords = decode_polyline(response['routes'][0]['geometry'])
+        mapping = {'id': i, 'user_id': rng.randint(1, users), 'public': rng.random() < 0.5,
+                   'title': 'Load test route {}'.format(i), 'distance': round(summary['distance']),
+                   'duration': round(summary['duration']), 'bbox': json.dumps(response['bbox']),
+                   'geometry': pack_coords(coords), 'start_longitude': start[0], 'start_latitude': start[1],
+                   'min_longitude': response['bbox'][0], 'min_latitude': response['bbox'][1],
+                   'max_longitude': response['bbox'][2], 'max_latitude': response['bbox'][3]}
+        mapping.update(route_stats(coords))
+        mappings.append(mapping)
+    db.session.bulk_insert_mappings(Route, mappings)
+    db.session.commit()
+    public_ids = [m['id'] for m in mappings if m['public']]
+    own_ids = [m['id'] for m in mappings if m['user_id'] == 1]
+    return public_ids, own_ids
+
+
+# Session cookie for a signed-in user who has already chosen a start location, made by whichever
+# session interface the app uses (so it is stored server-side, unless SESSION_STORE is 'cookie')
+def signed_in_cookie(app, user_id):
+    from flask import session
+    with app.test_request_context():
+        session.update({'_user_id': str(user_id), '_fresh': True, 'start_location': 'Birmingham',
+                        'start_coords': list(BIRMINGHAM)})
+        response = app.response_class()
+        app.session_interface.save_session(app, session, response)
+    return response.headers['Set-Cookie'].split(';')[0].split('=', 1)[1]
+
+
+# Value at the given percentile (0-100) of an already sorted list
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    return values[min(int(len(values) * pct / 100.0), len(values) - 1)]
+
+
+# Runs requests from one simulated user until the deadline, recording (scenario, seconds, status) for each
+def run_client(base_url, cookie_name, cookie, public_ids, own_ids, scenarios, deadline, results):
+    session = requests.Session()
+    session.cookies.set(cookie_name, cookie, domain=urlparse(base_url).hostname)  # Replaced by any new cookie set
+    names, weights = zip(*scenarios.items())
+    while time.monotonic() < deadline:
+        scenario = random.choices(names, weights)[0]
+        if scenario == 'index':
+            request = ('get', '/', None)
+        elif scenario == 'search':
+            request = ('post', '/', {'location': random.choice(LOCATIONS)})
+        elif scenario == 'generate':
+            request = ('get', '/route?dist={}'.format(random.choice([10, 20, 20, 30, 50])), None)
+        elif scenario == 'view':
+            request = ('get', '/route/{}'.format(random.choice(public_ids + own_ids)), None)
+        elif scenario == 'saved':
+            request = ('get', '/saved', None)
+        else:
+            request = ('get', '/gpx/{}'.format(random.choice(public_ids + own_ids)), None)
+
+        method, path, data = request
+        started = time.perf_counter()
+        response = session.request(method, base_url + path, data=data, allow_redirects=False)
+        results.append((scenario, time.perf_counter() - started, response.status_code))
+
+
+# Latency percentiles (in milliseconds), throughput and error count, per scenario and overall
+def summarise(results, elapsed):
+    report = {}
+    for scenario in sorted(set(r[0] for r in results)) + ['all']:
+        rows = [r for r in results if scenario in ('all', r[0])]
+        latencies = sorted(r[1] for r in rows)
+        report[scenario] = {
+            'requests': len(rows),
+            'errors': sum(1 for r in rows if r[2] >= 500),
+            'throughput_rps': round(len(rows) / elapsed, 1),
+            'p50_ms': round(1000 * percentile(latencies, 50), 1),
+            'p95_ms': round(1000 * percentile(latencies, 95), 1),
+            'p99_ms': round(1000 * percentile(latencies, 99), 1)}
+    return report
+
+
+def print_report(report):
+    print('{:<10} {:>9} {:>7} {:>9} {:>9} {:>9} {:>9}'.format('scenario', 'requests', 'errors', 'req/s',
+                                                             'p50 ms', 'p95 ms', 'p99 ms'))
+    for scenario, row in report.items():
+        print('{:<10} {requests:>9} {errors:>7} {throughput_rps:>9} {p50_ms:>9} {p95_ms:>9} {p99_ms:>9}'.format(
+            scenario, **row))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end load test for RideTime')
+    parser.add_argument('--concurrency', type=int, default=8, help='simulated users making requests at once')
+    parser.add_argument('--duration', type=float, default=20, help='seconds to run for')
+    parser.add_argument('--users', type=int, default=50, help='users to seed the database with')
+    parser.add_argument('--routes', type=int, default=2000, help='routes to seed the database with')
+    parser.add_argument('--scenarios', help='comma-separated subset of: ' + ', '.join(SCENARIOS))
+    parser.add_argument('--ors-url', help='use an already-running ORS stand-in instead of starting one')
+    parser.add_argument('--ors-fixtures', help='recorded ORS responses for the stand-in to replay')
+    parser.add_argument('--ors-latency', type=float, default=0.5, help='mean seconds the stand-in takes')
+    parser.add_argument('--ors-jitter', type=float, default=0.2)
+    parser.add_argument('--ors-error-rate', type=float, default=0.0)
+    parser.add_argument('--output', help='write the report to this JSON file')
+    args = parser.parse_args()
+
+    if not args.ors_url:
+        settings = StandinSettings(Fixtures(args.ors_fixtures), latency=args.ors_latency, jitter=args.ors_jitter,
+                                   error_rate=args.ors_error_rate)
+        args.ors_url = start_standin(settings).url
+
+    # Configure the app before it is imported, as config.py reads the environment at import time
+    db_path = os.path.join(tempfile.mkdtemp(prefix='ridetime-loadtest-'), 'loadtest.db')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + db_path
+    os.environ['ORS_BASE_URL'] = args.ors_url
+    os.environ.setdefault('ORS_RATE_LIMIT', '100000')  # The stand-in has no quota to protect
+
+    from werkzeug.serving import make_server
+    from app import create_app, db
+    from app.models import User, Route
+
+    app = create_app()
+    app.config['WTF_CSRF_ENABLED'] = False  # So the location search form can be posted directly
+    with app.app_context():
+        public_ids, own_ids = seed_database(db, User, Route, args.users, args.routes)
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)  # Don't log every request
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='ridetime', daemon=True).start()
+    base_url = 'http://127.0.0.1:{}'.format(server.server_port)
+
+    scenarios = SCENARIOS
+    if args.scenarios:
+        scenarios = {name: SCENARIOS[name] for name in args.scenarios.split(',')}
+
+    cookie = signed_in_cookie(app, 1)
+    results = []
+    started = time.monotonic()
+    deadline = started + args.duration
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        clients = [executor.submit(run_client, base_url, app.session_cookie_name, cookie, public_ids, own_ids,
+                                   scenarios, deadline, results) for _ in range(args.concurrency)]
+        for client in clients:
+            client.result()  # Raises if a client failed, rather than silently reporting fewer requests
+    elapsed = time.monotonic() - started
+    server.shutdown()
+
+    report = summarise(results, elapsed)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'settings': vars(args), 'results': report}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
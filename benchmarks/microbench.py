@@ -0,0 +1,312 @@
+# Micro-benchmarks for RideTime's hot paths, on synthetic routes of 5 to 100 km (see synthetic.py),
+# so that changes to them can be measured without ORS or real data. Groups (choose with --only):
+#   polyline    - polyline_to_coords and geometry_to_coords, with and without the coordinates cache
+#   gpx         - route_to_gpx
+#   pages       - rendering route.html and create.html, and the GeoJSON their maps load
+#   routetable  - rendering _routetable.html (with its filters) for 1k and 10k rows
+#   saved       - the queries behind '/saved', and the whole page, on a DB of a million routes
+#
+# Each benchmark is run in batches until a batch takes a fair fraction of a second, then the batch
+# is repeated; the best and median times per call are reported. Use --output to save the results
+# as JSON, and --compare to check them against an earlier file: any benchmark more than
+# --threshold slower than before is reported as a regression, and the exit status is 1.
+#
+# The million-route DB takes a while to build, so it is kept (in the temp directory, or --db) and
+# reused by later runs with the same --db-routes.
+#
+# Usage (from the repository root):
+#   python -m benchmarks.microbench --output baseline.json
+#   python -m benchmarks.microbench --compare baseline.json --output new.json
+#   python -m benchmarks.microbench --only polyline,gpx --compare baseline.json
+#   python -m benchmarks.microbench --compare baseline.json --input new.json  (compare two files only)
+
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import timeit
+from datetime import datetime, timedelta
+from benchmarks.synthetic import encode_polyline, synthetic_loop
+
+GROUPS = ('polyline', 'gpx', 'pages', 'routetable', 'saved')
+ROUTE_KMS = (5, 20, 50, 100)
+TABLE_ROWS = (1000, 10000)
+START = (-1.930556, 52.450556)
+
+
+# Times 'func', returning the best and median milliseconds per call over 'repeat' batches
+def measure(func, repeat, min_time):
+    timer = timeit.Timer(func)
+    number = 1
+    while timer.timeit(number) < min_time:  # Find a batch size which takes at least 'min_time'
+        number *= 2
+    times = [t / number for t in timer.repeat(repeat=repeat, number=number)]
+    return {'best_ms': round(1000 * min(times), 4), 'median_ms': round(1000 * statistics.median(times), 4),
+            'calls': number * repeat}
+
+
+# Synthetic routes as transient (not stored) Route objects, one for each length in ROUTE_KMS
+def synthetic_routes(Route):
+    from app.geometry import route_stats
+    from app.polyline import pack_coords, decode_polyline
+
+    routes = {}
+    for i, km in enumerate(ROUTE_KMS):
+        coords = decode_polyline(encode_polyline(synthetic_loop(START, km, seed=i)))
+        lngs, lats = coords[:, 0], coords[:, 1]
+        routes[km] = Route(id=i + 1, user_id=1, public=True, title='Benchmark route ({} km)'.format(km),
+                           distance=km * 1000, duration=km * 160, timestamp=datetime.utcnow() - timedelta(days=3),
+                           bbox=json.dumps([lngs.min(), lats.min(), lngs.max(), lats.max()]),
+                           geometry=pack_coords(coords), start_longitude=coords[0][0], start_latitude=coords[0][1],
+                           **route_stats(coords))
+    return routes
+
+
+def polyline_benchmarks(routes):
+    from app.datafeeds import polyline_to_coords, geometry_to_coords
+
+    for km, route in routes.items():
+        polyline, geometry = route.polyline, route.geometry
+        yield 'polyline_to_coords/{}km'.format(km), lambda polyline=polyline: polyline_to_coords(polyline)
+        yield 'polyline_to_coords_cached/{}km'.format(km), lambda polyline=polyline, km=km: polyline_to_coords(
+            polyline, route_id=km)
+        yield 'geometry_to_coords/{}km'.format(km), lambda geometry=geometry: geometry_to_coords(geometry)
+
+
+def gpx_benchmarks(routes):
+    from app.gpx import route_to_gpx
+
+    for km, route in routes.items():
+        unsaved = type(route)(title=route.title, geometry=route.geometry)  # No ID, so never cached
+        yield 'route_to_gpx/{}km'.format(km), lambda unsaved=unsaved: route_to_gpx(unsaved)
+
+
+# Renders templates the way the views do, inside a request for a signed out user
+def page_benchmarks(app, routes):
+    from flask import render_template
+    from app.datafeeds import geometry_to_coords
+    from app.geometry import route_geojson
+
+    def in_request(func):
+        def run():
+            with app.test_request_context('/'):
+                return func()
+        return run
+
+    nearby = list(routes.values())  # Suggested alongside each new route, as 'nearby_routes' would
+    for route in nearby:
+        route.km_away = 1.5
+
+    for km, route in routes.items():
+        start = [route.start_longitude, route.start_latitude]
+        coords = geometry_to_coords(route.geometry)
+        yield 'render_route_html/{}km'.format(km), in_request(lambda route=route, start=start: render_template(
+            'route.html', header=False, mapbox_key='benchmark', route=route, route_start=start, own_route=False,
+            geometry_url='/route/{}.geojson'.format(route.id)))
+        yield 'render_create_html/{}km'.format(km), in_request(lambda route=route, start=start: render_template(
+            'create.html', header=False, title='View Route', mapbox_key='benchmark', route=route,
+            route_start=start, nearby=nearby, geometry_url='/route/unsaved/benchmark.geojson'))
+        for zoom in (None, 12):
+            yield 'route_geojson/{}km/zoom-{}'.format(km, zoom or 'full'), lambda coords=coords, zoom=zoom: json.dumps(
+                route_geojson(coords, zoom), separators=(',', ':'))
+
+
+def routetable_benchmarks(app, routes, Route):
+    from flask import render_template
+
+    rng = random.Random(0)
+    samples = list(routes.values())
+    now = datetime.utcnow()
+    for rows in TABLE_ROWS:
+        table = []
+        for i in range(rows):
+            sample = samples[i % len(samples)]
+            table.append(Route(id=i + 1, public=rng.random() < 0.5, title='Route near Birmingham {}'.format(i),
+                               distance=rng.randint(5000, 100000), duration=rng.randint(900, 20000),
+                               timestamp=now - timedelta(minutes=rng.randint(1, 2000000)), preview=sample.preview))
+
+        def render(table=table):
+            with app.test_request_context('/saved'):
+                return render_template('_routetable.html', routes=table)
+        yield 'render_routetable/{}rows'.format(rows), render
+
+
+# Fills the DB with 'count' routes for 1000 users, spread over the last three years, in batches.
+# Every route shares one short geometry, to keep the file a manageable size ('/saved' never reads it).
+def seed_routes(db, User, Route, routes, count, batch_size=20000):
+    from app.polyline import pack_coords
+
+    db.drop_all()
+    db.create_all()
+    users = 1000
+    db.session.bulk_insert_mappings(User, [{'id': i, 'social_id': 'benchmark${}'.format(i)}
+                                           for i in range(1, users + 1)])
+    db.session.commit()
+
+    rng = random.Random(0)
+    samples = list(routes.values())
+    geometry = pack_coords(synthetic_loop(START, 5, seed=0))
+    now = datetime.utcnow()
+    for first in range(1, count + 1, batch_size):
+        batch = []
+        for i in range(first, min(first + batch_size, count + 1)):
+            sample = samples[i % len(samples)]
+            timestamp = now - timedelta(seconds=rng.randint(0, 3 * 365 * 86400))
+            batch.append({'id': i, 'user_id': rng.randint(1, users), 'public': rng.random() < 0.5,
+                          'title': 'Route near Birmingham', 'distance': sample.distance, 'duration': sample.duration,
+                          'bbox': sample.bbox, 'geometry': geometry, 'timestamp': timestamp, 'updated_at': timestamp,
+                          'start_longitude': sample.start_longitude, 'start_latitude': sample.start_latitude,
+                          'min_longitude': sample.min_longitude, 'min_latitude': sample.min_latitude,
+                          'max_longitude': sample.max_longitude, 'max_latitude': sample.max_latitude,
+                          'point_count': sample.point_count, 'geo_distance': sample.geo_distance,
+                          'preview': sample.preview})
+        db.session.execute(Route.__table__.insert(), batch)
+        db.session.commit()
+        print('  seeded {} of {} routes'.format(min(first + batch_size - 1, count), count), file=sys.stderr)
+    db.session.execute('ANALYZE')  # So SQLite's planner knows which indexes are selective
+    db.session.commit()
+
+
+def saved_benchmarks(app, db, User, Route, routes, count):
+    from flask_login import login_user
+    from app.routes import route_page
+
+    user_id = 1  # The user '/saved' is shown for
+    with app.app_context():
+        if not db.engine.has_table('route') or db.session.query(Route.id).count() != count:
+            print('Building benchmark DB of {} routes (reused by later runs)'.format(count), file=sys.stderr)
+            seed_routes(db, User, Route, routes, count)
+        # Cursor for a page a quarter of the way through the shared routes
+        timestamp, route_id = db.session.query(Route.timestamp, Route.id).filter(
+            Route.public, Route.user_id != user_id).order_by(Route.timestamp.desc(), Route.id.desc()).offset(
+            count // 8).first()
+        middle = '{}_{}'.format(timestamp.strftime('%Y%m%d%H%M%S%f'), route_id)
+        db.session.remove()
+
+    def in_request(func):
+        def run():
+            with app.test_request_context('/saved'):
+                login_user(User.load_user(user_id))
+                try:
+                    return func()
+                finally:
+                    db.session.remove()  # As at the end of each request, so nothing is reused from the last call
+        return run
+
+    yield 'saved_own_page', in_request(lambda: route_page(Route.query.filter_by(user_id=user_id), None))
+    yield 'saved_shared_page', in_request(
+        lambda: route_page(Route.query.filter(Route.public, Route.user_id != user_id), None))
+    yield 'saved_shared_deep_page', in_request(
+        lambda: route_page(Route.query.filter(Route.public, Route.user_id != user_id), middle))
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+
+    def get_saved():
+        response = client.get('/saved')
+        assert response.status_code == 200, response.status_code
+    yield 'saved_view', get_saved
+
+
+# Prints each benchmark's change against the baseline, returning the names of those which regressed
+def compare(baseline, results, threshold):
+    regressions = []
+    print('{:<40} {:>12} {:>12} {:>9}'.format('benchmark', 'baseline ms', 'now ms', 'change'))
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            print('{:<40} {:>12} {:>12.4f} {:>9}'.format(name, '-', result['best_ms'], 'new'))
+            continue
+        change = result['best_ms'] / before['best_ms'] - 1 if before['best_ms'] else 0.0
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        elif change < -threshold:
+            flag = '  faster'
+        print('{:<40} {:>12.4f} {:>12.4f} {:>+8.1f}%{}'.format(name, before['best_ms'], result['best_ms'],
+                                                               100 * change, flag))
+    not_run = [name for name in baseline if name not in results]
+    if not_run:
+        print('({} benchmarks in the baseline were not run)'.format(len(not_run)))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmarks for RideTime hot paths')
+    parser.add_argument('--only', help='comma-separated subset of: ' + ', '.join(GROUPS))
+    parser.add_argument('--filter', help='only run benchmarks whose name contains this text')
+    parser.add_argument('--repeat', type=int, default=5, help='batches timed for each benchmark')
+    parser.add_argument('--min-time', type=float, default=0.2, help='minimum seconds per batch')
+    parser.add_argument('--db', help='SQLite file for the saved() benchmarks (kept between runs)')
+    parser.add_argument('--db-routes', type=int, default=1000000, help='routes in the saved() benchmark DB')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON results file to compare against')
+    parser.add_argument('--input', help='with --compare, compare this results file instead of running')
+    parser.add_argument('--threshold', type=float, default=0.1, help='slowdown (as a fraction) counted as a regression')
+    args = parser.parse_args()
+
+    if args.input:
+        if not args.compare:
+            parser.error('--input needs --compare')
+        with open(args.compare) as f, open(args.input) as g:
+            sys.exit(1 if compare(json.load(f)['results'], json.load(g)['results'], args.threshold) else 0)
+
+    groups = args.only.split(',') if args.only else GROUPS
+    unknown = set(groups) - set(GROUPS)
+    if unknown:
+        parser.error('unknown groups: ' + ', '.join(sorted(unknown)))
+
+    # Configure the app before it is imported, as config.py reads the environment at import time
+    db_path = args.db or os.path.join(tempfile.gettempdir(), 'ridetime-microbench-{}.db'.format(args.db_routes))
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.abspath(db_path)
+    os.environ.setdefault('ORS_KEY', 'benchmark')  # Importing the app creates an ORS client, though we never call it
+    os.environ['METRICS_DIR'] = ''  # Don't leave metrics files behind
+
+    from app import create_app, db
+    from app.models import User, Route
+
+    app = create_app()
+    with app.app_context():
+        routes = synthetic_routes(Route)
+
+    benchmarks = []
+    if 'polyline' in groups:
+        benchmarks += polyline_benchmarks(routes)
+    if 'gpx' in groups:
+        benchmarks += gpx_benchmarks(routes)
+    if 'pages' in groups:
+        benchmarks += page_benchmarks(app, routes)
+    if 'routetable' in groups:
+        benchmarks += routetable_benchmarks(app, routes, Route)
+    if 'saved' in groups:
+        benchmarks += saved_benchmarks(app, db, User, Route, routes, args.db_routes)
+
+    results = {}
+    for name, func in benchmarks:
+        if args.filter and args.filter not in name:
+            continue
+        results[name] = measure(func, args.repeat, args.min_time)
+        print('{:<40} {best_ms:>12.4f} ms  (median {median_ms:.4f} ms, {calls} calls)'.format(name, **results[name]))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'settings': vars(args), 'python': platform.python_version(), 'machine': platform.platform(),
+                       'timestamp': datetime.utcnow().isoformat() + 'Z', 'results': results}, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        print()
+        if compare(baseline, results, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+# A local stand-in for the Openrouteservice API, so RideTime can be load tested without using
+# (or being limited by) our real ORS quota. Point the app at it with ORS_BASE_URL.
+#
+# In 'record' mode it acts as a proxy to the real ORS API, saving each 'directions' and
+# 'pelias_search' response to a fixtures file. In 'replay' mode it answers from those fixtures
+# (falling back to synthetic routes/locations when there are none), with configurable latency
+# and error rate so that we can see how the app behaves when ORS is slow or failing.
+#
+# Usage (from the repository root):
+#   python -m benchmarks.ors_standin record --key $ORS_KEY --fixtures benchmarks/fixtures/ors.json
+#   python -m benchmarks.ors_standin replay --fixtures benchmarks/fixtures/ors.json --latency 0.8 --error-rate 0.05
+
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import requests
+from benchmarks.synthetic import synthetic_directions, synthetic_geocode
+
+ORS_URL = 'https://api.openrouteservice.org'
+
+
+# Saved API responses, grouped by endpoint ('directions' or 'pelias_search')
+class Fixtures(object):
+
+    def __init__(self, path=None):
+        self.path = path
+        self.responses = {'directions': [], 'pelias_search': []}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.responses.update(json.load(f))
+
+    def add(self, endpoint, response):
+        with self._lock:
+            self.responses.setdefault(endpoint, []).append(response)
+            if self.path:
+                with open(self.path, 'w') as f:
+                    json.dump(self.responses, f)
+
+    def choose(self, endpoint):
+        responses = self.responses.get(endpoint)
+        return random.choice(responses) if responses else None
+
+
+# Settings shared by every request handled by the server
+class StandinSettings(object):
+
+    def __init__(self, fixtures, mode='replay', target=ORS_URL, key=None, latency=0.0, jitter=0.0,
+                 error_rate=0.0, error_status=503):
+        self.fixtures = fixtures
+        self.mode = mode
+        self.target = target  # Real ORS API, when recording
+        self.key = key  # Real ORS key, when recording
+        self.latency = latency  # Mean seconds added to each replayed response
+        self.jitter = jitter  # Standard deviation of that delay
+        self.error_rate = error_rate  # Fraction of replayed requests which fail
+        self.error_status = error_status
+
+
+def make_handler(settings):
+
+    class StandinHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # Keep-alive, as the real API supports
+
+        def do_GET(self):
+            self.handle_api()
+
+        def do_POST(self):
+            self.handle_api()
+
+        def handle_api(self):
+            url = urlparse(self.path)
+            length = int(self.headers.get('Content-Length') or 0)
+            body = json.loads(self.rfile.read(length)) if length else None
+            endpoint = 'directions' if '/directions/' in url.path else 'pelias_search'
+
+            if settings.mode == 'record':
+                status, response = self.forward(body)
+                if status == 200:
+                    settings.fixtures.add(endpoint, response)
+                return self.send_json(status, response)
+
+            delay = random.gauss(settings.latency, settings.jitter)
+            time.sleep(max(delay, 0))
+            if random.random() < settings.error_rate:
+                return self.send_json(settings.error_status, {'error': 'Simulated ORS failure'})
+
+            response = settings.fixtures.choose(endpoint)
+            if response is None:  # Nothing recorded, so make something up from the request
+                if endpoint == 'directions':
+                    round_trip = body['options']['round_trip']
+                    response = synthetic_directions(body['coordinates'][0], round_trip['length'],
+                                                    round_trip.get('seed', 0))
+                else:
+                    response = synthetic_geocode(parse_qs(url.query).get('text', ['Birmingham'])[0])
+            self.send_json(200, response)
+
+        # Passes the request on to the real ORS API, returning its status and JSON body
+        def forward(self, body):
+            headers = {'Authorization': settings.key, 'Content-Type': 'application/json'}
+            if body is None:
+                response = requests.get(settings.target + self.path, headers=headers, timeout=60)
+            else:
+                response = requests.post(settings.target + self.path, json=body, headers=headers, timeout=60)
+            try:
+                return response.status_code, response.json()
+            except ValueError:
+                return response.status_code, {'error': response.text}
+
+        def send_json(self, status, response):
+            payload = json.dumps(response).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass  # Logging every request would slow down load tests
+
+    return StandinHandler
+
+
+# Starts the stand-in on a background thread, returning the server (its URL is in 'server.url')
+def start_standin(settings, host='127.0.0.1', port=0):
+    server = ThreadingHTTPServer((host, port), make_handler(settings))
+    server.daemon_threads = True
+    server.url = 'http://{}:{}'.format(host, server.server_port)
+    threading.Thread(target=server.serve_forever, name='ors-standin', daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the Openrouteservice API')
+    parser.add_argument('mode', choices=['record', 'replay'])
+    parser.add_argument('--fixtures', help='JSON file of recorded responses')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--target', default=ORS_URL, help='ORS API to record from')
+    parser.add_argument('--key', default=os.environ.get('ORS_KEY'), help='ORS API key to record with')
+    parser.add_argument('--latency', type=float, default=0.0, help='mean seconds added to each response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='standard deviation of the added latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests which fail')
+    parser.add_argument('--error-status', type=int, default=503, help='HTTP status of failed requests')
+    args = parser.parse_args()
+
+    settings = StandinSettings(Fixtures(args.fixtures), mode=args.mode, target=args.target, key=args.key,
+                               latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                               error_status=args.error_status)
+    server = start_standin(settings, args.host, args.port)
+    print('ORS stand-in ({}) listening on {}. Set ORS_BASE_URL to use it.'.format(args.mode, server.url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+# Synthetic test data for the benchmarks: plausible-looking circular routes (and ORS-style
+# API responses containing them), so that performance can be measured without calling ORS.
+
+import math
+import random
+
+EARTH_RADIUS = 6371008.8  # Mean radius of the Earth in metres
+
+
+# Encodes a list of [longitude, latitude] pairs as a polyline string (precision 5, as used by ORS)
+def encode_polyline(coords):
+    result = []
+    prev_lat = prev_lng = 0
+    for lng, lat in coords:
+        lat, lng = int(round(lat * 1e5)), int(round(lng * 1e5))
+        for delta in (lat - prev_lat, lng - prev_lng):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                result.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            result.append(chr(value + 63))
+        prev_lat, prev_lng = lat, lng
+    return ''.join(result)
+
+
+# Great-circle distance in metres between two [longitude, latitude] points
+def haversine(a, b):
+    lng1, lat1, lng2, lat2 = map(math.radians, (a[0], a[1], b[0], b[1]))
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(h))
+
+
+# A wobbly loop of roughly 'km_distance' which starts and ends at 'start', with a point every
+# 'spacing' metres or so - similar in shape and density to a route returned by ORS.
+def synthetic_loop(start, km_distance, seed=0, spacing=75):
+    rng = random.Random(seed)
+    length = km_distance * 1000
+    radius = length / (2 * math.pi)
+    bearing = rng.uniform(0, 2 * math.pi)  # Direction of the loop's centre from the start
+    points = max(int(length / spacing), 8)
+    metres_per_degree_lat = math.pi * EARTH_RADIUS / 180
+    metres_per_degree_lng = metres_per_degree_lat * math.cos(math.radians(start[1]))
+    wobble = [rng.uniform(-0.08, 0.08) for _ in range(6)]
+
+    coords = []
+    for i in range(points + 1):
+        angle = bearing + math.pi + 2 * math.pi * i / points
+        r = radius * (1 + sum(w * math.sin((k + 1) * 2 * math.pi * i / points) for k, w in enumerate(wobble)))
+        x = radius * math.sin(bearing) + r * math.sin(angle)
+        y = radius * math.cos(bearing) + r * math.cos(angle)
+        coords.append([round(start[0] + x / metres_per_degree_lng, 5), round(start[1] + y / metres_per_degree_lat, 5)])
+    coords[-1] = coords[0]  # Loops finish where they start
+    return coords
+
+
+# An ORS 'directions' response for a round trip, in the same shape as the real API returns
+def synthetic_directions(start, length, seed=0):
+    coords = synthetic_loop(start, length / 1000.0, seed)
+    distance = sum(haversine(a, b) for a, b in zip(coords, coords[1:]))
+    lngs, lats = [c[0] for c in coords], [c[1] for c in coords]
+    bbox = [min(lngs), min(lats), max(lngs), max(lats)]
+    return {'bbox': bbox,
+            'routes': [{'summary': {'distance': round(distance, 1), 'duration': round(distance / 6.1, 1)},
+                        'bbox': bbox, 'geometry': encode_polyline(coords)}]}
+
+
+# An ORS 'pelias_search' response with a single match at the given coordinates
+def synthetic_geocode(text, coords=(-1.930556, 52.450556)):
+    return {'type': 'FeatureCollection',
+            'features': [{'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': list(coords)},
+                          'properties': {'name': text.title(), 'country_a': 'GBR'}}]}
@@ -4,6 +4,7 @@
 # from the OS environment (i.e. Heroku) during production.
 
 import os
+import tempfile
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
@@ -14,6 +15,69 @@ class Config(object):
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     MAPBOX_KEY = os.environ.get('MAPBOX_KEY')
     ORS_KEY = os.environ.get('ORS_KEY')
+    ORS_BASE_URL = os.environ.get('ORS_BASE_URL') or 'https://api.openrouteservice.org'  # Or a local stand-in
+    ORS_TIMEOUT = int(os.environ.get('ORS_TIMEOUT') or 20)  # Seconds to wait for each ORS response
+    ORS_POOL_SIZE = int(os.environ.get('ORS_POOL_SIZE') or 10)  # Keep-alive connections to ORS per worker
+    ORS_RATE_LIMIT = int(os.environ.get('ORS_RATE_LIMIT') or 40)  # Max ORS calls per minute, per worker
+    ORS_RATE_BURST = int(os.environ.get('ORS_RATE_BURST') or 10)  # Calls allowed in a burst above that rate
+    ORS_RATE_WAIT = float(os.environ.get('ORS_RATE_WAIT') or 5)  # Seconds a call may queue for the rate limit
+    ORS_MAX_RETRIES = int(os.environ.get('ORS_MAX_RETRIES') or 2)  # Retries after a 429/5xx response
+    ORS_BREAKER_THRESHOLD = int(os.environ.get('ORS_BREAKER_THRESHOLD') or 5)  # Failures in a row before failing fast
+    ORS_BREAKER_RESET = int(os.environ.get('ORS_BREAKER_RESET') or 30)  # Seconds before trying ORS again
+    ROUTES_PER_PAGE = int(os.environ.get('ROUTES_PER_PAGE') or 25)  # Routes in each list on the 'Saved Routes' page
+    GEOCODE_CACHE_SIZE = int(os.environ.get('GEOCODE_CACHE_SIZE') or 5000)  # Location searches held in memory
+    GEOCODE_CACHE_TTL = int(os.environ.get('GEOCODE_CACHE_TTL') or 30 * 24 * 3600)  # Seconds to trust a match
+    GEOCODE_NEGATIVE_TTL = int(os.environ.get('GEOCODE_NEGATIVE_TTL') or 24 * 3600)  # Seconds to trust a 'not found'
+    PLACE_INDEX = os.environ.get('PLACE_INDEX') or os.path.join(basedir, 'place-index')  # See placeindex.py
+    PLACE_SUGGESTIONS = int(os.environ.get('PLACE_SUGGESTIONS') or 8)  # Most suggestions for a partial search
+    COORDS_CACHE_SIZE = int(os.environ.get('COORDS_CACHE_SIZE') or 500)  # Decoded routes held in memory
+    GEOJSON_CACHE_SIZE = int(os.environ.get('GEOJSON_CACHE_SIZE') or 1000)  # Route geometries held in memory
+    PAGE_CACHE_SIZE = int(os.environ.get('PAGE_CACHE_SIZE') or 500)  # Rendered route pages held in memory
+    PAGE_CACHE_TTL = int(os.environ.get('PAGE_CACHE_TTL') or 300)  # Seconds to keep them ('Created 5 minutes ago')
+    USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE') or 5000)  # Signed in users held in memory
+    USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL') or 60)  # Seconds before reloading a user from the DB
+    ROUTE_POOL_ENABLED = os.environ.get('ROUTE_POOL_ENABLED', '1') != '0'  # Pre-generate routes for popular starts
+    ROUTE_POOL_SIZE = int(os.environ.get('ROUTE_POOL_SIZE') or 3)  # Routes kept ready per start area and distance
+    ROUTE_POOL_TTL = int(os.environ.get('ROUTE_POOL_TTL') or 3600)  # Seconds before a pooled route is discarded
+    ROUTE_POOL_REFILL_INTERVAL = float(os.environ.get('ROUTE_POOL_REFILL_INTERVAL') or 2)  # Seconds between refills
+    ROUTE_POOL_MAX_CELLS = int(os.environ.get('ROUTE_POOL_MAX_CELLS') or 50)  # Start areas/distances kept stocked
+    ROUTE_POOL_PRECISION = int(os.environ.get('ROUTE_POOL_PRECISION') or 3)  # Decimal places, 3 is roughly 100m
+    ROUTE_POOL_MIN_DEMAND = int(os.environ.get('ROUTE_POOL_MIN_DEMAND') or 3)  # Requests before a start is stocked
+    ROUTE_POOL_DECAY_INTERVAL = float(os.environ.get('ROUTE_POOL_DECAY_INTERVAL') or 600)  # Seconds to halve demand
+    ROUTE_CANDIDATES = int(os.environ.get('ROUTE_CANDIDATES') or 3)  # Seeds tried at once for each new route
+    ROUTE_TOLERANCE = float(os.environ.get('ROUTE_TOLERANCE') or 0.1)  # Accept a route within 10% of the distance
+    ROUTE_DEADLINE = float(os.environ.get('ROUTE_DEADLINE') or 8)  # Seconds to wait for a route within tolerance
+    ROUTE_CANDIDATE_THREADS = int(os.environ.get('ROUTE_CANDIDATE_THREADS') or 8)  # Max ORS calls in flight
+    DISTANCE_CALIBRATION = os.environ.get('DISTANCE_CALIBRATION', '1') != '0'  # Adjust lengths asked of ORS
+    CALIBRATION_PRECISION = int(os.environ.get('CALIBRATION_PRECISION') or 1)  # Decimal places, 1 is roughly 10km
+    CALIBRATION_MIN_SAMPLES = int(os.environ.get('CALIBRATION_MIN_SAMPLES') or 5)  # Routes needed to trust a cell
+    CALIBRATION_WINDOW = int(os.environ.get('CALIBRATION_WINDOW') or 100)  # Recent routes the average favours
+    CALIBRATION_MAX_ADJUST = float(os.environ.get('CALIBRATION_MAX_ADJUST') or 0.4)  # Most we change a length by
+    CALIBRATION_HISTORY = int(os.environ.get('CALIBRATION_HISTORY') or 20000)  # Stored routes to learn from at start
+    ROUTING_BACKEND = os.environ.get('ROUTING_BACKEND') or 'ors'  # Or 'local' to plan in-process, serially under gevent
+    ROUTING_GRAPH = os.environ.get('ROUTING_GRAPH') or os.path.join(basedir, 'road-graph')  # For 'local' (roadgraph.py)
+    NEARBY_RADIUS = float(os.environ.get('NEARBY_RADIUS') or 3)  # km from the start to look for existing routes
+    NEARBY_TOLERANCE = float(os.environ.get('NEARBY_TOLERANCE') or 0.2)  # How far off the distance they may be
+    NEARBY_LIMIT = int(os.environ.get('NEARBY_LIMIT') or 3)  # Existing routes to suggest
+    UNSAVED_ROUTE_STORE = os.environ.get('UNSAVED_ROUTE_STORE') or \
+        'sqlite:///' + os.path.join(tempfile.gettempdir(), 'ridetime-unsaved.db')  # Or 'memory' or 'database'
+    UNSAVED_ROUTE_TTL = int(os.environ.get('UNSAVED_ROUTE_TTL') or 24 * 3600)  # Seconds an unsaved route is kept
+    UNSAVED_ROUTE_LIMIT = int(os.environ.get('UNSAVED_ROUTE_LIMIT') or 20000)  # Max unsaved routes kept at once
+    SESSION_STORE = os.environ.get('SESSION_STORE') or 'database'  # Or 'sqlite:///<path>', 'memory' or 'cookie'
+    SESSION_TTL = int(os.environ.get('SESSION_TTL') or 14 * 24 * 3600)  # Seconds an unused session is kept
+    SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE') or 5000)  # Sessions held in memory per worker
+    EXPORT_PROCESSES = int(os.environ.get('EXPORT_PROCESSES') or
+                           min((os.cpu_count() or 1) - 1, 4))  # Processes making GPX files for '/export', 0 for none
+    EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE') or 100)  # Routes read from the DB at a time
+    JOB_MAX_ROUTES = int(os.environ.get('JOB_MAX_ROUTES') or 200)  # Most routes one batch job may ask for
+    JOB_WORKER_THREADS = int(os.environ.get('JOB_WORKER_THREADS') or 4)  # Routes each job worker makes at once
+    JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL') or 2)  # Seconds between checks for new tasks
+    JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS') or 3)  # Tries at a route before giving up on it
+    JOB_RETRY_DELAY = int(os.environ.get('JOB_RETRY_DELAY') or 30)  # Seconds before retrying a failed route
+    JOB_TASK_TIMEOUT = int(os.environ.get('JOB_TASK_TIMEOUT') or 300)  # Seconds before a claimed task is retaken
+    METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'ridetime-metrics'))  # Or ''
+    METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL') or 5)  # Seconds between worker updates
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')  # Required to read '/metrics', which is off until it is set
     OAUTH_CREDENTIALS =  {
         'facebook': {
             'id': os.environ.get('FB_ID'),
@@ -0,0 +1,69 @@
+# Settings for gunicorn, which serves the app in production (see Procfile). gunicorn reads this
+# file by itself when started from this directory.
+#
+# Most of the time spent generating a route is waiting on the ORS API. With gunicorn's default
+# 'sync' workers, each worker process is stuck until ORS replies, so a handful of slow route
+# requests can leave no workers free for anything else. Instead, we run 'gevent' workers: gevent
+# patches the standard library (sockets, threads, locks, sleep) so that whenever a request waits
+# on the network, the worker switches to another request. One worker process can then have
+# hundreds of route requests waiting on ORS, while still serving every other page.
+#
+# Set GUNICORN_WORKER_CLASS=sync to go back to sync workers (also used if gevent isn't installed).
+#
+# The app is loaded once, in the master process, before the workers are forked ('preload'), so
+# starting (or restarting) a worker doesn't mean importing everything again, and the workers share
+# the memory holding the loaded code. Nothing opens a DB connection or starts a thread while the
+# app loads (they all wait for first use, in each worker), so nothing is shared that shouldn't be.
+# Set GUNICORN_PRELOAD=0 to have each worker load the app itself.
+
+import os
+
+try:
+    import gevent  # noqa: F401
+    default_worker_class = 'gevent'
+except ImportError:
+    default_worker_class = 'sync'
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS') or default_worker_class
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS') or 500)  # Requests each gevent worker takes at once
+timeout = int(os.environ.get('GUNICORN_TIMEOUT') or 30)  # Seconds before a stuck worker is restarted
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') != '0'
+
+if worker_class == 'gevent':
+    # Threads are only greenlets here, so we can afford many more ORS calls in flight (ORS_RATE_LIMIT still applies).
+    # Routes planned in-process (ROUTING_BACKEND=local) can't share a worker like that, as they never wait on the
+    # network, so their candidates are planned one at a time instead (see 'best_local_roundroute' in routefinder.py)
+    os.environ.setdefault('ROUTE_CANDIDATE_THREADS', '64')
+    os.environ.setdefault('ORS_POOL_SIZE', '50')
+    # Worker processes for '/export' don't mix with gevent's patched threads, so make GPX files in the request
+    os.environ.setdefault('EXPORT_PROCESSES', '0')
+    if preload_app:
+        # Workers patch the standard library when they start, which is too late for an app loaded before
+        # forking: locks and sockets it created would be left unpatched. So patch this process first.
+        from gevent import monkey
+        monkey.patch_all()
+
+
+# Runs in the master process as the server starts. Empties METRICS_DIR of counts left by earlier
+# servers (see metrics.py), so they aren't added to this one's.
+def on_starting(server):
+    from config import Config
+    if not Config.METRICS_DIR or not os.path.isdir(Config.METRICS_DIR):
+        return
+    for filename in os.listdir(Config.METRICS_DIR):
+        if filename.startswith('worker-'):
+            try:
+                os.remove(os.path.join(Config.METRICS_DIR, filename))
+            except OSError:  # Already removed
+                pass
+
+
+# Runs in each new worker, before it handles any requests
+def post_fork(server, worker):
+    if worker_class != 'gevent':
+        return
+    try:
+        from psycogreen.gevent import patch_psycopg
+    except ImportError:  # Not using Postgres (e.g. SQLite locally), so nothing to patch
+        return
+    patch_psycopg()  # psycopg2 talks to Postgres in C, so needs this to let other requests run while it waits
@@ -1,10 +1,18 @@
 # Initialises the RideTime app by calling the code in the 'app' module
 
-from app import app, db
-from app.models import User, Route
+from app import create_app
 
+app = create_app()
 
-# For development purposes: Allows handling of User and Route objects and DB operations from the shell
+
+# For development purposes: Allows handling of User and Route objects and DB operations from the shell.
+# What it offers is only imported when the shell starts, rather than whenever the app is loaded.
 @app.shell_context_processor
 def make_shell_context():
-    return {'db': db, 'User': User, 'Route': Route}
+    from app import db
+    from app.models import User, Route
+    from app.datafeeds import geocode_cache_stats
+    from app.routepool import route_pool
+    from app.unsaved import unsaved_routes
+    return {'db': db, 'User': User, 'Route': Route, 'geocode_cache_stats': geocode_cache_stats,
+            'route_pool': route_pool, 'unsaved_routes': unsaved_routes}